@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import os.path
+import re
+from Common import CommonVariables, DeviceItem
+from CommandExecutor import ProcessCommunicator
+
+
+class BlockDeviceInventory(object):
+    """
+    lists the block devices like lsblk -P does, in the same tree order, from sysfs, the udev database and mountinfo.
+    lsblk is only run for the file system fields of the devices udev has no entry for.
+    """
+    def __init__(self, logger, command_executor, udev_database):
+        self.logger = logger
+        self.command_executor = command_executor
+        self.udev_database = udev_database
+        self.sys_block_path = '/sys/block'
+        self.sys_class_block_path = '/sys/class/block'
+        self.mountinfo_path = '/proc/self/mountinfo'
+        self.swaps_path = '/proc/swaps'
+
+    def read_attribute(self, name, attribute):
+        attribute_path = os.path.join(self.sys_class_block_path, name, attribute)
+        if not os.path.exists(attribute_path):
+            return None
+        with open(attribute_path, 'r') as f:
+            return f.read().strip()
+
+    def list_attribute_dir(self, name, attribute):
+        # in directory order, like lsblk
+        attribute_path = os.path.join(self.sys_class_block_path, name, attribute)
+        if not os.path.isdir(attribute_path):
+            return []
+        return os.listdir(attribute_path)
+
+    @staticmethod
+    def unescape_mountinfo(value):
+        return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), value)
+
+    @staticmethod
+    def split_lvm_name(dm_name):
+        """
+        returns (vg_name, lv_name) of the device mapper name of a logical volume, where the dashes in the names are doubled.
+        """
+        parts = ['']
+        position = 0
+        while position < len(dm_name):
+            if dm_name[position] == '-':
+                if dm_name[position + 1:position + 2] == '-':
+                    parts[-1] += '-'
+                    position += 2
+                    continue
+                parts.append('')
+            else:
+                parts[-1] += dm_name[position]
+            position += 1
+        return tuple(parts) if len(parts) == 2 and all(parts) else None
+
+    def read_mount_points(self):
+        """
+        returns the first mount point of every device, by major:minor and by source path, and [SWAP] for the swap devices.
+        """
+        mount_points = {}
+        if os.path.exists(self.mountinfo_path):
+            with open(self.mountinfo_path, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if ' - ' not in line or len(fields) < 5:
+                        continue
+                    source = line.split(' - ', 1)[1].split()
+                    mount_point = self.unescape_mountinfo(fields[4])
+                    mount_points.setdefault(fields[2], mount_point)
+                    if len(source) > 1 and source[1].startswith('/dev/'):
+                        mount_points.setdefault(os.path.realpath(self.unescape_mountinfo(source[1])), mount_point)
+        if os.path.exists(self.swaps_path):
+            with open(self.swaps_path, 'r') as f:
+                for line in f.readlines()[1:]:
+                    fields = line.split()
+                    if fields:
+                        mount_points.setdefault(os.path.realpath(self.unescape_mountinfo(fields[0])), '[SWAP]')
+        return mount_points
+
+    def get_type(self, name):
+        if self.read_attribute(name, 'partition') is not None:
+            return 'part'
+        dm_uuid = self.read_attribute(name, 'dm/uuid')
+        if dm_uuid is not None:
+            prefix = dm_uuid.split('-', 1)[0]
+            if prefix == 'CRYPT':
+                return 'crypt'
+            if prefix == 'LVM':
+                return 'lvm'
+            if prefix == 'mpath':
+                return 'mpath'
+            if re.match(r'^part\d+$', prefix):
+                return 'part'
+            return 'dm'
+        md_level = self.read_attribute(name, 'md/level')
+        if md_level is not None:
+            return md_level
+        if name.startswith('loop'):
+            return 'loop'
+        if self.read_attribute(name, 'device/type') == '5':
+            return 'rom'
+        return 'disk'
+
+    def is_listed(self, name):
+        """
+        lsblk leaves out the RAM disks and the loop devices without a backing file.
+        """
+        majmin = self.read_attribute(name, 'dev')
+        if majmin is None or majmin.split(':')[0] == '1':
+            return False
+        if name.startswith('loop') and self.read_attribute(name, 'loop/backing_file') is None:
+            return False
+        return True
+
+    def get_children(self, name):
+        """
+        the partitions of a disk in partition order, then the devices built on top of it.
+        """
+        partitions = [entry for entry in self.list_attribute_dir(name, '')
+                      if os.path.exists(os.path.join(self.sys_class_block_path, name, entry, 'partition'))]
+        partitions.sort(key=lambda partition: int(self.read_attribute(partition, 'partition') or 0))
+        return partitions + self.list_attribute_dir(name, 'holders')
+
+    def get_kernel_name(self, dev_path):
+        name = os.path.basename(os.path.realpath(dev_path))
+        if os.path.exists(os.path.join(self.sys_class_block_path, name, 'dev')):
+            return name
+        return None
+
+    def create_device_item(self, name, mount_points, missing_udev_items):
+        device_item = DeviceItem()
+        device_item.majmin = self.read_attribute(name, 'dev')
+        device_item.type = self.get_type(name)
+        device_item.size = int(self.read_attribute(name, 'size') or 0) * CommonVariables.sector_size
+        device_item.model = self.read_attribute(name, 'device/model') or ''
+        device_item.name = self.read_attribute(name, 'dm/name') or name
+        if device_item.type == 'lvm':
+            lvm_names = self.split_lvm_name(device_item.name)
+            if lvm_names is not None:
+                device_item.name = lvm_names[0] + '/' + lvm_names[1]
+
+        device_item.mount_point = mount_points.get(device_item.majmin) or mount_points.get(os.path.realpath('/dev/' + name)) or ''
+        udev_properties = self.udev_database.get_properties(device_item.majmin)
+        if udev_properties is None:
+            missing_udev_items.setdefault(name, []).append(device_item)
+            udev_properties = {}
+        device_item.file_system = udev_properties.get('ID_FS_TYPE', '')
+        label = udev_properties.get('ID_FS_LABEL_ENC')
+        device_item.label = re.sub(r'\\x([0-9a-fA-F]{2})', lambda match: chr(int(match.group(1), 16)), label) if label is not None \
+            else udev_properties.get('ID_FS_LABEL', '')
+        device_item.uuid = udev_properties.get('ID_FS_UUID', '')
+        return device_item
+
+    def fill_from_lsblk(self, missing_udev_items):
+        """
+        reads the file system fields of the devices udev has no entry for, with one lsblk for all of them.
+        """
+        lsblk_command = 'lsblk -b -n -P -d -o KNAME,FSTYPE,LABEL,UUID ' + ' '.join('/dev/' + name for name in sorted(missing_udev_items))
+        proc_comm = ProcessCommunicator()
+        self.command_executor.Execute(lsblk_command, communicator=proc_comm, raise_exception_on_failure=True, suppress_logging=True)
+        for line in proc_comm.stdout.splitlines():
+            properties = dict(re.findall(r'([A-Z:_]+)="([^"]*)"', line))
+            for device_item in missing_udev_items.get(properties.get('KNAME'), []):
+                device_item.file_system = properties.get('FSTYPE', '')
+                device_item.label = properties.get('LABEL', '')
+                device_item.uuid = properties.get('UUID', '')
+
+    def get_device_items(self, dev_path):
+        """
+        returns the device at dev_path and the ones on top of it, or every device if dev_path is None.
+        returns None when sysfs does not know the device, for lsblk to be asked instead.
+        """
+        try:
+            if dev_path is None:
+                if not os.path.isdir(self.sys_block_path):
+                    return None
+                roots = [name for name in os.listdir(self.sys_block_path)
+                         if not self.list_attribute_dir(name, 'slaves') and self.is_listed(name)]
+            else:
+                name = self.get_kernel_name(dev_path)
+                if name is None:
+                    return None
+                roots = [name]
+
+            mount_points = self.read_mount_points()
+            missing_udev_items = {}
+            device_items = []
+            pending = list(reversed(roots))
+            while pending:
+                name = pending.pop()
+                device_items.append(self.create_device_item(name, mount_points, missing_udev_items))
+                pending.extend(reversed(self.get_children(name)))
+
+            if missing_udev_items:
+                self.fill_from_lsblk(missing_udev_items)
+            return device_items
+        except (IOError, OSError, ValueError) as e:
+            self.logger.log(msg="failed to list the block devices from sysfs: {0}".format(e), level=CommonVariables.WarningLevel)
+            return None
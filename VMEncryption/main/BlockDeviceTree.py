@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+
+
+class BlockDeviceTree(object):
+    """
+    the block devices as a tree read once from sysfs, where the children of a device are its partitions and its
+    holders, the devices like dm-crypt, LVM or RAID built on top of it. every device knows all of its descendants,
+    itself included, by its path in /dev.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.sys_class_block_path = '/sys/class/block'
+        self.children = {}
+        self.descendants = {}
+
+    @staticmethod
+    def get_dev_path(name):
+        # sysfs spells the slashes of names like cciss/c0d0 as !
+        return '/dev/' + name.replace('!', '/')
+
+    def list_dir(self, path):
+        if not os.path.isdir(path):
+            return []
+        return os.listdir(path)
+
+    def load(self):
+        self.children = {}
+        names = self.list_dir(self.sys_class_block_path)
+        for name in names:
+            self.children.setdefault(name, set())
+            device_path = os.path.join(self.sys_class_block_path, name)
+            for holder in self.list_dir(os.path.join(device_path, 'holders')):
+                self.children[name].add(holder)
+            if os.path.exists(os.path.join(device_path, 'partition')):
+                # /sys/class/block/sda1 links into the directory of sda
+                disk = os.path.basename(os.path.dirname(os.path.realpath(device_path)))
+                self.children.setdefault(disk, set()).add(name)
+            for slave in self.list_dir(os.path.join(device_path, 'slaves')):
+                self.children.setdefault(slave, set()).add(name)
+
+        descendant_names = {}
+
+        def get_descendant_names(name):
+            if name not in descendant_names:
+                # a device is never its own descendant, so the recursion ends at the leaves
+                names = set([name])
+                for child in self.children.get(name, []):
+                    names |= get_descendant_names(child)
+                descendant_names[name] = names
+            return descendant_names[name]
+
+        for name in self.children:
+            get_descendant_names(name)
+
+        self.descendants = dict((self.get_dev_path(name), set(self.get_dev_path(descendant) for descendant in names))
+                                for name, names in descendant_names.items())
+
+    def get_descendants(self, dev_path):
+        """
+        returns the paths of the device at dev_path and of the devices on top of it, or None if sysfs does not know it.
+        """
+        return self.descendants.get(os.path.realpath(dev_path))
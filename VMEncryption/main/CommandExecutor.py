@@ -23,6 +23,7 @@ import shlex
 from threading import Timer
 from subprocess import Popen, PIPE
 import traceback
+from DeviceTopologyCache import DeviceTopologyCache
 
 class ProcessCommunicator(object):
     def __init__(self):
@@ -77,6 +78,7 @@ class CommandExecutor(object):
             if timer is not None:
                 timer.cancel()
             return_code = proc.returncode
+            DeviceTopologyCache.note_command(args)
 
         if isinstance(communicator, ProcessCommunicator):
             # for python2 and python3 compatibility, first decode 
@@ -124,6 +124,72 @@ class CommonVariables:
     disk_by_partuuid_root = '/dev/disk/by-partuuid'
     nvme_device_identifier = '/dev/nvme'
     nvme_device_name_identifier = 'nvme'
+    # commands after which the cached device topology is read again, unless their first argument is one of their read only arguments
+    topology_mutating_commands = ['cryptsetup', 'mount', 'umount', 'swapon', 'swapoff', 'mkswap', 'wipefs',
+                                  'parted', 'sgdisk', 'sfdisk', 'fdisk', 'partprobe', 'mdadm', 'resize2fs', 'xfs_growfs',
+                                  'tune2fs', 'e2label', 'pvcreate', 'pvremove', 'pvmove', 'pvresize', 'vgcreate', 'vgremove',
+                                  'vgextend', 'vgchange', 'lvcreate', 'lvremove', 'lvextend', 'lvresize', 'lvchange', 'lvrename',
+                                  'dmsetup', 'losetup', 'udevadm']
+    topology_read_only_arguments = {'cryptsetup': ['isLuks', 'luksDump', 'luksUUID', 'status', '--version', '--help'],
+                                    'dmsetup': ['deps', 'info', 'ls', 'table', 'status', '--version', '--help'],
+                                    'udevadm': ['info', '--version', '--help'],
+                                    'tune2fs': ['-l'],
+                                    'fdisk': ['-l', '--list', '--version', '--help'],
+                                    'sfdisk': ['-l', '--list', '-d', '--dump', '-J', '--json', '--version', '--help'],
+                                    'mdadm': ['-D', '--detail', '-E', '--examine', '-Q', '--query', '--version', '--help'],
+                                    'mount': ['-l', '--version', '--help']}
+
+    """
+    data copy engine related
+    """
+    CopyEngineKey = 'CopyEngine'
+    CopyEngineNative = 'native'
+    CopyEngineDd = 'dd'
+    SupportedCopyEngines = [CopyEngineNative, CopyEngineDd]
+    CopyIOModeKey = 'CopyIOMode'
+    CopyIOModeBuffered = 'buffered'
+    CopyIOModeDirect = 'direct'
+    SupportedCopyIOModes = [CopyIOModeBuffered, CopyIOModeDirect]
+    CopyReadAheadKey = 'CopyReadAhead'
+    CopyCacheNeutralKey = 'CopyCacheNeutral'
+    CopyVectoredIOKey = 'CopyVectoredIO'
+    CopyDirtyLimitMBKey = 'CopyDirtyLimitMB'
+    copy_dirty_limit_mb = 64
+    CopySliceSizeAutotuneKey = 'CopySliceSizeAutotune'
+    autotune_min_slice_count = 64
+    # off unless set to true, a skipped free block keeps whatever deleted plain text it held
+    CopySkipFreeSpaceKey = 'CopySkipFreeSpace'
+    CopyZeroDetectKey = 'CopyZeroDetect'
+    zero_chunk_size = 1048576
+    # dd reads its input from a pipe in chunks of this size when the slice is fed from the process buffer
+    dd_pipe_block_size = 65536
+    # _IO(0x12, 127) from linux/fs.h
+    BLKZEROOUT = 0x127f
+    # from linux/fs.h
+    SYNC_FILE_RANGE_WAIT_BEFORE = 1
+    SYNC_FILE_RANGE_WRITE = 2
+    SYNC_FILE_RANGE_WAIT_AFTER = 4
+    journal_record_size = 512
+    CopyVerifySampleCountKey = 'CopyVerifySampleCount'
+    copy_verify_sample_count = 4
+    CopyCheckpointIntervalSlicesKey = 'CopyCheckpointIntervalSlices'
+    copy_checkpoint_interval_slices = 32
+    CopyCheckpointIntervalSecondsKey = 'CopyCheckpointIntervalSeconds'
+    copy_checkpoint_interval_seconds = 30
+    CopyMaxMBPerSecondKey = 'CopyMaxMBPerSecond'
+    CopyBurstMBKey = 'CopyBurstMB'
+    CopyAdaptiveThrottleKey = 'CopyAdaptiveThrottle'
+    CopyThrottleTargetLatencyMsKey = 'CopyThrottleTargetLatencyMs'
+    copy_throttle_target_latency_ms = 50
+    CopyThrottleTargetQueueDepthKey = 'CopyThrottleTargetQueueDepth'
+    copy_throttle_target_queue_depth = 64
+    CopyStripeWorkersKey = 'CopyStripeWorkers'
+    copy_stripe_workers = 4
+    copy_stripes_per_worker = 2
+    copy_stripe_min_size = 1024 * 1024 * 1024
+    EncryptionParallelVolumesKey = 'EncryptionParallelVolumes'
+    # opt-in, the volumes are encrypted one at a time unless EncryptionParallelVolumes asks for more
+    encryption_parallel_volumes = 1
 
     """
     parameter key names
@@ -193,6 +259,8 @@ class CommonVariables:
     EncryptionPhaseKey = 'EncryptionPhase'
     EncryptionModeOnline = 'Online'
     EncryptionPhaseResume = 'Resume'
+    # public setting, the volumes are decrypted offline unless it is set to true
+    OnlineDecryptionKey = 'OnlineDecryption'
 
     """
     crypt ongoing item config keys
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import time
+
+
+class CopyProgress(object):
+    """
+    Moving average throughput and time left of a data copy, from samples taken after every slice.
+    The rates are taken over the last window_seconds only, so they follow the copy when it speeds up
+    or slows down, e.g. over a run of free space or while it is throttled.
+    """
+    window_seconds = 60
+
+    def __init__(self, total_bytes):
+        self.total_bytes = total_bytes
+        # (time, processed bytes, copied bytes)
+        self.samples = collections.deque()
+
+    def add_sample(self, processed_bytes, copied_bytes):
+        """
+        processed_bytes is how far the copy is through the device, skipped free space included.
+        """
+        now = time.time()
+        self.samples.append((now, processed_bytes, copied_bytes))
+        # the newest sample older than the window stays as the base of the rates
+        while len(self.samples) > 2 and now - self.samples[1][0] >= CopyProgress.window_seconds:
+            self.samples.popleft()
+
+    def get_rate(self, field_index):
+        if len(self.samples) < 2:
+            return None
+        elapsed_seconds = self.samples[-1][0] - self.samples[0][0]
+        if elapsed_seconds <= 0:
+            return None
+        return (self.samples[-1][field_index] - self.samples[0][field_index]) / elapsed_seconds
+
+    def get_copy_rate(self):
+        """
+        returns the bytes per second written to the destination, or None before there are two samples.
+        """
+        return self.get_rate(2)
+
+    def get_eta_seconds(self):
+        """
+        returns the seconds left at the current pace through the device, or None while it is unknown.
+        """
+        if not self.samples:
+            return None
+        remaining_bytes = self.total_bytes - self.samples[-1][1]
+        if remaining_bytes <= 0:
+            return 0
+        processed_rate = self.get_rate(1)
+        if not processed_rate or processed_rate <= 0:
+            return None
+        return remaining_bytes / processed_rate
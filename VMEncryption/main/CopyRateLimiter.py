@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+
+class CopyRateLimiter(object):
+    """
+    Token bucket over the bytes a data copy reads from and writes to the disks.
+    The bucket fills at rate bytes per second up to burst bytes and every I/O takes its size out of it.
+    An I/O bigger than what is left runs the bucket into debt and waits until the debt is paid off,
+    so slices larger than the burst are paced as well.
+    """
+
+    def __init__(self, logger, rate, burst):
+        self.logger = logger
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.start_time = time.time()
+        self.last_fill_time = self.start_time
+        self.consumed_bytes = 0
+        self.waited_seconds = 0.0
+        # the read ahead thread and the copy loop share the bucket
+        self.lock = threading.Lock()
+        self.logger.log("copy rate limited to {0} bytes per second, burst {1} bytes".format(int(self.rate), int(self.burst)))
+
+    def fill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_fill_time) * self.rate)
+        self.last_fill_time = now
+
+    def consume(self, size):
+        """
+        takes size bytes out of the bucket, sleeps while it is in debt and returns the seconds slept.
+        """
+        with self.lock:
+            self.fill(time.time())
+            self.tokens -= size
+            self.consumed_bytes += size
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited_seconds += wait_seconds
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+    def get_achieved_rate(self):
+        """
+        returns the bytes per second of disk I/O since the limiter was created.
+        """
+        elapsed_seconds = time.time() - self.start_time
+        return self.consumed_bytes / elapsed_seconds if elapsed_seconds > 0 else 0.0
@@ -29,6 +29,7 @@ class DecryptionMarkConfig(object):
         self.encryption_environment = encryption_environment
         self.command = None
         self.volume_type = None
+        self.decryption_mode = None
         self.decryption_mark_config = ConfigUtil(self.encryption_environment.azure_decrypt_request_queue_path,
                                                  'decryption_request_queue',
                                                  self.logger)
@@ -36,6 +37,9 @@ class DecryptionMarkConfig(object):
     def get_current_command(self):
         return self.decryption_mark_config.get_config(CommonVariables.EncryptionEncryptionOperationKey)
 
+    def get_decryption_mode(self):
+        return self.decryption_mark_config.get_config(CommonVariables.EncryptionModeKey)
+
     def config_file_exists(self):
         return self.decryption_mark_config.config_file_exists()
     
@@ -48,6 +52,9 @@ class DecryptionMarkConfig(object):
         volume_type = ConfigKeyValuePair(CommonVariables.EncryptionVolumeTypeKey, self.volume_type)
         key_value_pairs.append(volume_type)
 
+        decryption_mode = ConfigKeyValuePair(CommonVariables.EncryptionModeKey, self.decryption_mode)
+        key_value_pairs.append(decryption_mode)
+
         self.decryption_mark_config.save_configs(key_value_pairs)
 
     def clear_config(self):
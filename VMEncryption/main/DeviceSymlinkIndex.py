@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+
+
+class DeviceSymlinkIndex(object):
+    """
+    maps the devices back to the links that name them under directories like /dev/disk/by-uuid, read in one pass.
+    the links of a device come in the order the directory lists them, and the links in the subdirectories of a
+    directory come with it, as /dev/disk/azure/scsi1/lun0 comes with /dev/disk/azure.
+    """
+    def __init__(self, logger, link_roots):
+        self.logger = logger
+        self.link_roots = link_roots
+        self.links = {}
+        self.realpaths = {}
+
+    def load(self):
+        self.links = {}
+        self.realpaths = {}
+        for link_root in self.link_roots:
+            root_links = {}
+            self.links[link_root] = root_links
+            if not os.path.exists(link_root):
+                continue
+            for entry in os.listdir(link_root):
+                entry_path = os.path.join(link_root, entry)
+                if os.path.isdir(entry_path):
+                    for sub_entry in os.listdir(entry_path):
+                        self.add(root_links, os.path.join(entry_path, sub_entry))
+                else:
+                    self.add(root_links, entry_path)
+
+    def add(self, root_links, link_path):
+        realpath = os.path.realpath(link_path)
+        self.realpaths[link_path] = realpath
+        root_links.setdefault(realpath, []).append(link_path)
+
+    def get_links(self, link_root, realpath):
+        """
+        returns the links under link_root that resolve to realpath.
+        """
+        return list(self.links.get(link_root, {}).get(realpath, []))
+
+    def get_realpath(self, link_path):
+        """
+        returns what the link resolves to, or None if it is not under one of the directories.
+        """
+        return self.realpaths.get(link_path)
+
+    def get_table(self, link_root):
+        """
+        returns the last link under link_root of every device, by the realpath of the device.
+        """
+        return dict((realpath, links[-1]) for realpath, links in self.links.get(link_root, {}).items())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+import re
+import shlex
+import threading
+from Common import CommonVariables
+
+
+class DeviceTopologyCache(object):
+    """
+    keeps what was read about the block devices until they may have changed, that is until the kernel sent a uevent,
+    udev updated its database or this process ran a command that changes the devices.
+    the commands run by any CommandExecutor are seen, so a cache is never served across a luksOpen, mount or mkfs.
+    """
+    # bumped whenever this process runs a command that changes the devices
+    generation = 0
+    generation_lock = threading.Lock()
+    # words in front of the command they run
+    command_wrappers = ['sudo', 'env', 'xargs', 'nohup', 'nice', 'ionice', 'timeout', 'stdbuf', 'exec', 'command', 'time']
+
+    def __init__(self, logger, udev_database):
+        self.logger = logger
+        self.udev_database = udev_database
+        self.uevent_seqnum_path = '/sys/kernel/uevent_seqnum'
+        self.stamp = None
+        self.entries = {}
+        # the volumes encrypted at once share the DiskUtil and its cache
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def invalidate_all():
+        with DeviceTopologyCache.generation_lock:
+            DeviceTopologyCache.generation += 1
+
+    @staticmethod
+    def split_script(script):
+        """
+        returns the commands of a shell script as lists of words, split at ; & | ( ) and new lines outside of quotes,
+        or None if the commands cannot be told apart, like with command substitutions or here documents.
+        """
+        if '`' in script or '$(' in script or '<<' in script:
+            return None
+        commands = []
+        command = ''
+        quote = None
+        escaped = False
+        for char in script:
+            if escaped:
+                escaped = False
+            elif char == '\\' and quote != "'":
+                escaped = True
+            elif quote is not None:
+                if char == quote:
+                    quote = None
+            elif char in '\'"':
+                quote = char
+            elif char in ';&|()\n':
+                commands.append(command)
+                command = ''
+                continue
+            command += char
+        if quote is not None or escaped:
+            return None
+        commands.append(command)
+        try:
+            return [shlex.split(command) for command in commands if command.strip()]
+        except ValueError:
+            return None
+
+    @staticmethod
+    def strip_command_wrappers(words):
+        """
+        drops the variable assignments and the wrappers like sudo or xargs, with their options, in front of a command.
+        """
+        position = 0
+        in_wrapper = False
+        while position < len(words):
+            word = words[position]
+            if re.match(r'^[A-Za-z_][A-Za-z0-9_]*=', word):
+                pass
+            elif os.path.basename(word) in DeviceTopologyCache.command_wrappers:
+                in_wrapper = True
+            elif not (in_wrapper and (word.startswith('-') or word.isdigit())):
+                break
+            position += 1
+        return words[position:]
+
+    @staticmethod
+    def is_mutating_command(args):
+        """
+        args are the arguments of a command as it is executed. the script of bash -c is split into its commands, and it
+        is mutating if any of them is, or if it cannot be split. a mutating command is read only when its first argument
+        is one of its read only arguments, like cryptsetup isLuks.
+        """
+        words = DeviceTopologyCache.strip_command_wrappers(list(args))
+        if not words:
+            return False
+        name = os.path.basename(words[0])
+        if name in ('bash', 'sh') and '-c' in words:
+            script_position = words.index('-c') + 1
+            if script_position >= len(words):
+                return False
+            commands = DeviceTopologyCache.split_script(words[script_position])
+            if commands is None:
+                return True
+            return any(DeviceTopologyCache.is_mutating_command(command) for command in commands)
+        if name in CommonVariables.topology_mutating_commands or name.startswith('mkfs'):
+            return len(words) < 2 or words[1] not in CommonVariables.topology_read_only_arguments.get(name, [])
+        return False
+
+    @staticmethod
+    def note_command(args):
+        if DeviceTopologyCache.is_mutating_command(args):
+            DeviceTopologyCache.invalidate_all()
+
+    def get_uevent_seqnum(self):
+        try:
+            with open(self.uevent_seqnum_path, 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def get_stamp(self):
+        return (DeviceTopologyCache.generation, self.get_uevent_seqnum(), self.udev_database.get_mtime())
+
+    def invalidate(self):
+        with self.lock:
+            self.stamp = None
+            self.entries = {}
+
+    def get(self, key, compute):
+        """
+        returns what compute returned for key since the devices last changed, calling it if there is none.
+        the stamp is taken before compute runs, and what it returns is only kept if the devices did not change meanwhile.
+        compute may get other keys, the lock is reentrant.
+        """
+        with self.lock:
+            stamp = self.get_stamp()
+            if stamp != self.stamp:
+                self.entries = {}
+                self.stamp = stamp
+            if key in self.entries:
+                return self.entries[key]
+            value = compute()
+            if self.get_stamp() == stamp and self.stamp == stamp:
+                self.entries[key] = value
+            return value
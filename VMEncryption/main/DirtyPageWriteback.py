@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import threading
+from Common import CommonVariables
+
+
+class DirtyPageWriteback(object):
+    """
+    Keeps the data a copy has written to a device and the kernel has not written back under limit bytes.
+    Once half of the limit is written, its writeback is started with sync_file_range and the half started
+    before it is waited for, so the disk is written steadily instead of in bursts when the kernel flushes.
+    Without sync_file_range the device is synced with fdatasync when the limit is reached.
+    This only bounds the dirty pages, the copy still syncs the device before it commits the slice index.
+    """
+
+    def __init__(self, logger, limit):
+        self.logger = logger
+        self.limit = int(limit)
+        self.sync_file_range = DirtyPageWriteback.load_sync_file_range()
+        # fd: [ranges written, bytes written, ranges in writeback]
+        self.pending = {}
+        self.written_back_bytes = 0
+        # the stripe workers write to the same device
+        self.lock = threading.Lock()
+        self.logger.log("dirty pages of the copy limited to {0} bytes, with {1}".format(
+            self.limit, 'sync_file_range' if self.sync_file_range is not None else 'fdatasync'))
+
+    @staticmethod
+    def load_sync_file_range():
+        try:
+            import ctypes
+            libc = ctypes.CDLL("libc.so.6", use_errno=True)
+            sync_file_range = libc.sync_file_range
+            sync_file_range.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_uint]
+            return sync_file_range
+        except (ImportError, OSError, AttributeError):
+            return None
+
+    @staticmethod
+    def merge_ranges(ranges):
+        merged = []
+        for offset, length in sorted(ranges):
+            if merged and offset <= merged[-1][0] + merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], offset + length - merged[-1][0])
+            else:
+                merged.append([offset, length])
+        return merged
+
+    def call_sync_file_range(self, fd, ranges, flags):
+        for offset, length in ranges:
+            if self.sync_file_range(fd, offset, length, flags) != 0:
+                import ctypes
+                error = ctypes.get_errno()
+                raise OSError(error, "sync_file_range failed: {0}".format(os.strerror(error)))
+
+    def get_chunk_size(self):
+        """
+        the writes are added in chunks of this size at most for the limit to hold.
+        """
+        return max(self.limit // 2, 1)
+
+    def add(self, fd, offset, length):
+        """
+        records a buffered write to fd, and writes back the device once enough of it is dirty.
+        """
+        with self.lock:
+            pending = self.pending.setdefault(fd, [[], 0, []])
+            pending[0].append((offset, length))
+            pending[1] += length
+            if self.sync_file_range is not None:
+                if pending[1] < self.get_chunk_size():
+                    return
+                ranges = DirtyPageWriteback.merge_ranges(pending[0])
+                self.call_sync_file_range(fd, ranges, CommonVariables.SYNC_FILE_RANGE_WRITE)
+                self.call_sync_file_range(fd, pending[2], CommonVariables.SYNC_FILE_RANGE_WAIT_BEFORE
+                                          | CommonVariables.SYNC_FILE_RANGE_WRITE | CommonVariables.SYNC_FILE_RANGE_WAIT_AFTER)
+                self.pending[fd] = [[], 0, ranges]
+            else:
+                if pending[1] < self.limit:
+                    return
+                os.fdatasync(fd)
+                self.pending[fd] = [[], 0, []]
+            self.written_back_bytes += pending[1]
+
+    def synced(self, fd):
+        """
+        everything written to fd before an fdatasync of it is written back.
+        """
+        with self.lock:
+            self.pending.pop(fd, None)
@@ -17,6 +17,7 @@
 # limitations under the License.
 
 import subprocess
+import copy
 import json
 import os
 import os.path
@@ -29,6 +30,11 @@ from EncryptionConfig import EncryptionConfig
 from DecryptionMarkConfig import DecryptionMarkConfig
 from EncryptionMarkConfig import EncryptionMarkConfig
 from TransactionalCopyTask import TransactionalCopyTask
+from BlockDeviceInventory import BlockDeviceInventory
+from UdevDatabase import UdevDatabase
+from DeviceTopologyCache import DeviceTopologyCache
+from DeviceSymlinkIndex import DeviceSymlinkIndex
+from BlockDeviceTree import BlockDeviceTree
 from CommandExecutor import CommandExecutor, ProcessCommunicator
 from Common import CommonVariables, LvmItem, DeviceItem
 from io import open
@@ -40,7 +46,8 @@ class DiskUtil(object):
     # TBD Add support for custom VG and LV with online encryption
     os_lvm_vg = 'rootvg'
     os_lvm_lv = 'rootlv'
-    sles_cache = {}
+    # shared by the DiskUtil instances of a handler run
+    udev_database = None
 
     def __init__(self, hutil, patching, logger, encryption_environment):
         self.encryption_environment = encryption_environment
@@ -51,6 +58,10 @@ class DiskUtil(object):
         self.vmbus_sys_path = '/sys/bus/vmbus/devices'
 
         self.command_executor = CommandExecutor(self.logger)
+        if DiskUtil.udev_database is None:
+            DiskUtil.udev_database = UdevDatabase(self.logger)
+        self.block_device_inventory = BlockDeviceInventory(self.logger, self.command_executor, DiskUtil.udev_database)
+        self.topology_cache = DeviceTopologyCache(self.logger, DiskUtil.udev_database)
         self._LUN_PREFIX = "lun"
         self._SCSI_PREFIX = "scsi"
     
@@ -63,25 +74,20 @@ class DiskUtil(object):
     def get_osmapper_path(self):
         return os.path.join(CommonVariables.dev_mapper_root, CommonVariables.osmapper_name)
 
-    def copy(self, ongoing_item_config, status_prefix=''):
+    def copy(self, ongoing_item_config, status_prefix='', public_settings=None, encryption_environment=None, hutil=None):
         copy_task = TransactionalCopyTask(logger=self.logger,
                                           disk_util=self,
-                                          hutil=self.hutil,
+                                          hutil=hutil or self.hutil,
                                           ongoing_item_config=ongoing_item_config,
                                           patching=self.distro_patcher,
-                                          encryption_environment=self.encryption_environment,
-                                          status_prefix=status_prefix)
+                                          encryption_environment=encryption_environment or self.encryption_environment,
+                                          status_prefix=status_prefix,
+                                          public_settings=public_settings)
         try:
-            mem_fs_result = copy_task.prepare_mem_fs()
-            if mem_fs_result != CommonVariables.process_success:
-                return CommonVariables.tmpfs_error
-            else:
-                return copy_task.begin_copy()
+            return copy_task.begin_copy()
         except Exception as e:
             message = "Failed to perform dd copy: {0}, stack trace: {1}".format(e, traceback.format_exc())
             self.logger.log(msg=message, level=CommonVariables.ErrorLevel)
-        finally:
-            copy_task.clear_mem_fs()
 
     def format_disk(self, dev_path, file_system):
         mkfs_command = ""
@@ -485,6 +491,15 @@ class DiskUtil(object):
             keyslots = ["enabled" in l.lower() for l in lines]
             return keyslots
 
+    def get_luks_version(self, dev_path, header_file):
+        return self._extract_luks_version_from_dump(self._luks_get_header_dump(header_file or dev_path))
+
+    def supports_online_decryption(self, header_file=None):
+        # cryptsetup decrypts a LUKS2 volume with a detached header online from 2.2.0 on,
+        # moving a header out of the device and shifting the data back needs 2.6.0
+        cryptsetup_ver = self._get_cryptsetup_version()
+        return LooseVersion(cryptsetup_ver) >= LooseVersion('cryptsetup 2.2.0' if header_file else 'cryptsetup 2.6.0')
+
     def luks_check_reencryption(self, dev_path, header_file):
         device_header = None
         if header_file is None:
@@ -724,11 +739,9 @@ class DiskUtil(object):
         return /dev/disk/by-id that maps to the sdx_path, otherwise return the original path
         """
         desired_uuid_path = os.path.join(CommonVariables.disk_by_uuid_root, uuid)
-        for disk_by_uuid in os.listdir(CommonVariables.disk_by_uuid_root):
-            disk_by_uuid_path = os.path.join(CommonVariables.disk_by_uuid_root, disk_by_uuid)
-
-            if disk_by_uuid_path == desired_uuid_path:
-                return os.path.realpath(disk_by_uuid_path)
+        realpath = self.get_device_symlink_index().get_realpath(desired_uuid_path)
+        if realpath is not None:
+            return realpath
 
         return desired_uuid_path
 
@@ -738,10 +751,9 @@ class DiskUtil(object):
         Update: now we have realised that by-id is not a good way to refer to devices (they can change on reallocations or resizes).
         Try not to use this- use get_persistent_path_by_sdx_path instead
         """
-        for disk_by_id in os.listdir(CommonVariables.disk_by_id_root):
-            disk_by_id_path = os.path.join(CommonVariables.disk_by_id_root, disk_by_id)
-            if os.path.realpath(disk_by_id_path) == sdx_path:
-                return disk_by_id_path
+        disk_by_id_paths = self.get_device_symlink_index().get_links(CommonVariables.disk_by_id_root, sdx_path)
+        if disk_by_id_paths:
+            return disk_by_id_paths[0]
 
         return sdx_path
 
@@ -750,24 +762,22 @@ class DiskUtil(object):
         return a stable path for this /dev/sdx device
         """
         sdx_realpath = os.path.realpath(sdx_path)
+        symlink_index = self.get_device_symlink_index()
 
         # First try finding an Azure symlink
-        azure_name_table = self.get_block_device_to_azure_udev_table()
-        if sdx_realpath in azure_name_table:
-            return azure_name_table[sdx_realpath]
+        azure_paths = symlink_index.get_links(CommonVariables.azure_symlinks_dir, sdx_realpath)
+        if azure_paths:
+            return azure_paths[-1]
 
         # A mapper path is also pretty good (especially for raid or lvm)
-        for mapper_name in os.listdir(CommonVariables.dev_mapper_root):
-            mapper_path = os.path.join(CommonVariables.dev_mapper_root, mapper_name)
-            if os.path.realpath(mapper_path) == sdx_realpath:
-                return mapper_path
+        mapper_paths = symlink_index.get_links(CommonVariables.dev_mapper_root, sdx_realpath)
+        if mapper_paths:
+            return mapper_paths[0]
 
         # Then try matching a uuid symlink. Those are probably the best
-        for disk_by_uuid in os.listdir(CommonVariables.disk_by_uuid_root):
-            disk_by_uuid_path = os.path.join(CommonVariables.disk_by_uuid_root, disk_by_uuid)
-
-            if os.path.realpath(disk_by_uuid_path) == sdx_realpath:
-                return disk_by_uuid_path
+        disk_by_uuid_paths = symlink_index.get_links(CommonVariables.disk_by_uuid_root, sdx_realpath)
+        if disk_by_uuid_paths:
+            return disk_by_uuid_paths[0]
 
         # Found nothing very persistent. Just return the original sdx path.
         # And Log it.
@@ -788,16 +798,20 @@ class DiskUtil(object):
         return device_path
 
     def get_device_id(self, dev_path):
-        udev_cmd = "udevadm info -a -p $(udevadm info -q path -n {0}) | grep device_id".format(dev_path)
-        proc_comm = ProcessCommunicator()
-        self.command_executor.ExecuteInBash(udev_cmd, communicator=proc_comm, suppress_logging=True)
-        match = re.findall(r'"{(.*)}"', proc_comm.stdout.strip())
-        return match[0] if match else ""
+        return DiskUtil.udev_database.get_device_id(self.get_majmin(dev_path))
+
+    def get_majmin(self, dev_path):
+        try:
+            rdev = os.stat(dev_path).st_rdev
+        except (OSError, TypeError):
+            return None
+        return "{0}:{1}".format(os.major(rdev), os.minor(rdev))
 
     def get_device_items_property(self, dev_name, property_name):
-        if (dev_name, property_name) in DiskUtil.sles_cache:
-            return DiskUtil.sles_cache[(dev_name, property_name)]
+        return self.topology_cache.get(('property', dev_name, property_name),
+                                       lambda: self.read_device_items_property(dev_name, property_name))
 
+    def read_device_items_property(self, dev_name, property_name):
         self.logger.log("getting property of device {0}".format(dev_name))
 
         device_path = self.get_device_path(dev_name)
@@ -821,32 +835,41 @@ class DiskUtil(object):
                         if len(disk_info_item_array) > 1:
                             property_value = disk_info_item_array[1]
 
-        DiskUtil.sles_cache[(dev_name, property_name)] = property_value
         return property_value
 
     def get_block_device_to_azure_udev_table(self):
-        table = {}
-        azure_links_dir = CommonVariables.azure_symlinks_dir
+        return self.get_device_symlink_index().get_table(CommonVariables.azure_symlinks_dir)
 
-        if not os.path.exists(azure_links_dir):
-            return table
+    def get_block_device_tree(self):
+        return self.topology_cache.get('block_device_tree', self.read_block_device_tree)
 
-        for top_level_item in os.listdir(azure_links_dir):
-            top_level_item_full_path = os.path.join(azure_links_dir, top_level_item)
-            if os.path.isdir(top_level_item_full_path):
-                scsi_path = os.path.join(azure_links_dir, top_level_item)
-                for symlink in os.listdir(scsi_path):
-                    symlink_full_path = os.path.join(scsi_path, symlink)
-                    table[os.path.realpath(symlink_full_path)] = symlink_full_path
-            else:
-                table[os.path.realpath(top_level_item_full_path)] = top_level_item_full_path
-        return table
+    def read_block_device_tree(self):
+        block_device_tree = BlockDeviceTree(self.logger)
+        block_device_tree.load()
+        return block_device_tree
+
+    def get_device_symlink_index(self):
+        # udev changes the links along with its database, so the index is read again with the topology
+        return self.topology_cache.get('device_symlink_index', self.read_device_symlink_index)
+
+    def read_device_symlink_index(self):
+        symlink_index = DeviceSymlinkIndex(self.logger, [CommonVariables.azure_symlinks_dir,
+                                                         CommonVariables.dev_mapper_root,
+                                                         CommonVariables.disk_by_uuid_root,
+                                                         CommonVariables.disk_by_id_root])
+        symlink_index.load()
+        return symlink_index
 
     def is_parent_of_any(self, parent_dev_path, children_dev_path_set):
         """
         check if the device whose path is parent_dev_path is actually a parent of any of the children in children_dev_path_set
         All the paths need to be "realpaths" (not symlinks)
         """
+        actual_children_dev_path_set = self.get_block_device_tree().get_descendants(parent_dev_path)
+        if actual_children_dev_path_set is not None:
+            return not actual_children_dev_path_set.isdisjoint(children_dev_path_set)
+
+        # sysfs does not know the device, ask lsblk
         actual_children_dev_items = self.get_device_items(parent_dev_path)
         actual_children_dev_path_set = set([os.path.realpath(self.get_device_path(di.name)) for di in actual_children_dev_items])
         # the sets being disjoint would mean the candidate parent is not parent of any of the candidate children. So we return the opposite of that
@@ -1002,72 +1025,88 @@ class DiskUtil(object):
         return device_items_to_return
 
     def get_device_items(self, dev_path):
+        # the callers get their own copies, they change the items they get
+        return [copy.copy(device_item) for device_item in self.topology_cache.get(('device_items', dev_path), lambda: self.read_device_items(dev_path))]
+
+    def read_device_items(self, dev_path):
         if self.distro_patcher.distro_info[0].lower() == 'suse' and self.distro_patcher.distro_info[1] == '11':
             return self.get_device_items_sles(dev_path)
         else:
             if dev_path:
                 self.logger.log(msg=("getting blk info for: " + str(dev_path)))
 
-            if dev_path is None:
-                lsblk_command = 'lsblk -b -n -P -o NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE,MAJ:MIN'
-            else:
-                lsblk_command = 'lsblk -b -n -P -o NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE,MAJ:MIN ' + dev_path
+            # sysfs lists the devices without forking lsblk and lvs for every call
+            device_items = self.block_device_inventory.get_device_items(dev_path)
+            if device_items is None:
+                return self.get_device_items_lsblk(dev_path)
+            for device_item in device_items:
+                device_item.device_id = DiskUtil.udev_database.get_device_id(device_item.majmin)
+            return device_items
 
-            proc_comm = ProcessCommunicator()
-            self.command_executor.Execute(lsblk_command, communicator=proc_comm, raise_exception_on_failure=True, suppress_logging=True)
+    def get_device_items_lsblk(self, dev_path):
+        if dev_path is None:
+            lsblk_command = 'lsblk -b -n -P -o NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE,MAJ:MIN'
+        else:
+            lsblk_command = 'lsblk -b -n -P -o NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE,MAJ:MIN ' + dev_path
 
-            device_items = []
-            lvm_items = self.get_lvm_items()
-            for line in proc_comm.stdout.splitlines():
-                if line:
-                    device_item = DeviceItem()
+        proc_comm = ProcessCommunicator()
+        self.command_executor.Execute(lsblk_command, communicator=proc_comm, raise_exception_on_failure=True, suppress_logging=True)
+
+        device_items = []
+        lvm_items = self.get_lvm_items()
+        for line in proc_comm.stdout.splitlines():
+            if line:
+                device_item = DeviceItem()
 
-                    for disk_info_property in str(line).split():
-                        property_item_pair = disk_info_property.split('=')
-                        if property_item_pair[0] == 'SIZE':
-                            device_item.size = int(property_item_pair[1].strip('"'))
+                for disk_info_property in str(line).split():
+                    property_item_pair = disk_info_property.split('=')
+                    if property_item_pair[0] == 'SIZE':
+                        device_item.size = int(property_item_pair[1].strip('"'))
 
-                        if property_item_pair[0] == 'NAME':
-                            device_item.name = property_item_pair[1].strip('"')
+                    if property_item_pair[0] == 'NAME':
+                        device_item.name = property_item_pair[1].strip('"')
 
-                        if property_item_pair[0] == 'TYPE':
-                            device_item.type = property_item_pair[1].strip('"')
+                    if property_item_pair[0] == 'TYPE':
+                        device_item.type = property_item_pair[1].strip('"')
 
-                        if property_item_pair[0] == 'FSTYPE':
-                            device_item.file_system = property_item_pair[1].strip('"')
+                    if property_item_pair[0] == 'FSTYPE':
+                        device_item.file_system = property_item_pair[1].strip('"')
 
-                        if property_item_pair[0] == 'MOUNTPOINT':
-                            device_item.mount_point = property_item_pair[1].strip('"')
+                    if property_item_pair[0] == 'MOUNTPOINT':
+                        device_item.mount_point = property_item_pair[1].strip('"')
 
-                        if property_item_pair[0] == 'LABEL':
-                            device_item.label = property_item_pair[1].strip('"')
+                    if property_item_pair[0] == 'LABEL':
+                        device_item.label = property_item_pair[1].strip('"')
 
-                        if property_item_pair[0] == 'UUID':
-                            device_item.uuid = property_item_pair[1].strip('"')
+                    if property_item_pair[0] == 'UUID':
+                        device_item.uuid = property_item_pair[1].strip('"')
 
-                        if property_item_pair[0] == 'MODEL':
-                            device_item.model = property_item_pair[1].strip('"')
+                    if property_item_pair[0] == 'MODEL':
+                        device_item.model = property_item_pair[1].strip('"')
 
-                        if property_item_pair[0] == 'MAJ:MIN' or property_item_pair[0] == "MAJ_MIN":
-                            device_item.majmin = property_item_pair[1].strip('"')
+                    if property_item_pair[0] == 'MAJ:MIN' or property_item_pair[0] == "MAJ_MIN":
+                        device_item.majmin = property_item_pair[1].strip('"')
 
-                    device_item.device_id = self.get_device_id(self.get_device_path(device_item.name))
+                device_item.device_id = DiskUtil.udev_database.get_device_id(device_item.majmin)
 
-                    if device_item.type is None:
-                        device_item.type = ''
+                if device_item.type is None:
+                    device_item.type = ''
 
-                    if device_item.type.lower() == 'lvm':
-                        for lvm_item in lvm_items:
-                            majmin = lvm_item.lv_kernel_major + ':' + lvm_item.lv_kernel_minor
+                if device_item.type.lower() == 'lvm':
+                    for lvm_item in lvm_items:
+                        majmin = lvm_item.lv_kernel_major + ':' + lvm_item.lv_kernel_minor
 
-                            if majmin == device_item.majmin:
-                                device_item.name = lvm_item.vg_name + '/' + lvm_item.lv_name
+                        if majmin == device_item.majmin:
+                            device_item.name = lvm_item.vg_name + '/' + lvm_item.lv_name
 
-                    device_items.append(device_item)
+                device_items.append(device_item)
 
-            return device_items
+        return device_items
 
     def get_lvm_items(self):
+        return [copy.copy(lvm_item) for lvm_item in self.topology_cache.get('lvm_items', self.read_lvm_items)]
+
+    def read_lvm_items(self):
         lvs_command = 'lvs --noheadings --nameprefixes --unquoted -o lv_name,vg_name,lv_kernel_major,lv_kernel_minor'
         proc_comm = ProcessCommunicator()
 
@@ -16,6 +16,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import os
 import os.path
 import subprocess
@@ -42,10 +43,48 @@ class EncryptionEnvironment(object):
         self.cleartext_key_base_path = os.path.join(self.encryption_config_path, 'cleartext_key')
         self.copy_header_slice_file_path = os.path.join(self.encryption_config_path, 'copy_header_slice_file')
         self.copy_slice_item_backup_file = os.path.join(self.encryption_config_path, 'copy_slice_item.bak')
+        self.copy_slice_item_journal_file = os.path.join(self.encryption_config_path, 'copy_slice_item.journal')
+        self.copy_slice_checksum_file = os.path.join(self.encryption_config_path, 'copy_slice_checksums')
+        self.copy_stripe_journal_file = os.path.join(self.encryption_config_path, 'copy_stripes.journal')
+        self.copy_stripe_guard_file = os.path.join(self.encryption_config_path, 'copy_stripe_guards')
+        self.copy_used_ranges_file_path = os.path.join(self.encryption_config_path, 'copy_used_ranges.json')
+        self.copy_progress_file_path = os.path.join(self.encryption_config_path, 'copy_progress.json')
+        self.ongoing_items_path = os.path.join(self.encryption_config_path, 'ongoing_items')
         self.os_encryption_markers_path = os.path.join(self.encryption_config_path, 'os_encryption_markers')
         self.bek_backup_path = os.path.join(self.encryption_config_path, 'bek_backup')
         self.default_bek_filename = "LinuxPassPhraseFileName"
 
+    def get_item_environment(self, item_id):
+        """
+        returns a copy of this environment that keeps the state of one in-flight device under its own folder,
+        so that several devices can be encrypted and resumed independently.
+        """
+        item_path = os.path.join(self.ongoing_items_path, item_id.replace('/', '_'))
+        if not os.path.exists(item_path):
+            os.makedirs(item_path)
+        item_environment = copy.copy(self)
+        item_environment.azure_crypt_ongoing_item_config_path = os.path.join(item_path, 'azure_crypt_ongoing_item.ini')
+        item_environment.copy_header_slice_file_path = os.path.join(item_path, 'copy_header_slice_file')
+        item_environment.copy_slice_item_backup_file = os.path.join(item_path, 'copy_slice_item.bak')
+        item_environment.copy_slice_item_journal_file = os.path.join(item_path, 'copy_slice_item.journal')
+        item_environment.copy_slice_checksum_file = os.path.join(item_path, 'copy_slice_checksums')
+        item_environment.copy_stripe_journal_file = os.path.join(item_path, 'copy_stripes.journal')
+        item_environment.copy_stripe_guard_file = os.path.join(item_path, 'copy_stripe_guards')
+        item_environment.copy_used_ranges_file_path = os.path.join(item_path, 'copy_used_ranges.json')
+        item_environment.copy_progress_file_path = os.path.join(item_path, 'copy_progress.json')
+        return item_environment
+
+    def get_ongoing_item_environments(self):
+        """
+        returns the environments of the devices whose encryption was started and not finished yet.
+        """
+        item_environments = []
+        if os.path.isdir(self.ongoing_items_path):
+            for item_id in sorted(os.listdir(self.ongoing_items_path)):
+                if os.path.exists(os.path.join(self.ongoing_items_path, item_id, 'azure_crypt_ongoing_item.ini')):
+                    item_environments.append(self.get_item_environment(item_id))
+        return item_environments
+
     def get_se_linux(self):
         proc = Popen([self.patching.getenforce_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         identity, err = proc.communicate()
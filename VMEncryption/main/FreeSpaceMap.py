@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import binascii
+import bisect
+import json
+import os
+import os.path
+import re
+import struct
+import traceback
+from Common import CommonVariables
+from CommandExecutor import CommandExecutor, ProcessCommunicator
+
+
+class FreeSpaceMap(object):
+    """
+    Reads the allocation metadata of an unmounted ext2/3/4 or xfs file system and builds the list of
+    byte ranges the file system uses, so that the data copy can leave the free space alone.
+    Anything the parser is not sure about is reported as used, and a file system that was not cleanly unmounted
+    is not read at all, since its allocation metadata may be older than its journal.
+    """
+    ext_superblock_offset = 1024
+    ext_magic = 0xEF53
+    ext_feature_compat_sparse_super2 = 0x200
+    ext_state_valid = 0x1
+    ext_state_error = 0x2
+    ext_feature_incompat_recover = 0x4
+    ext_feature_incompat_meta_bg = 0x10
+    ext_feature_incompat_64bit = 0x80
+    ext_feature_ro_compat_sparse_super = 0x1
+    ext_feature_ro_compat_gdt_csum = 0x10
+    ext_feature_ro_compat_bigalloc = 0x200
+    ext_feature_ro_compat_metadata_csum = 0x400
+    ext_bg_block_uninit = 0x2
+
+    xfs_magic = b'XFSB'
+    xfs_agf_magic = b'XAGF'
+    xfs_bnobt_magics = [b'ABTB', b'AB3B']
+
+    def __init__(self, logger, dev_path, file_system):
+        self.logger = logger
+        self.dev_path = dev_path
+        self.file_system = file_system
+        self.command_executor = CommandExecutor(logger)
+
+    def read_at(self, f, offset, size):
+        f.seek(offset)
+        data = f.read(size)
+        if len(data) != size:
+            raise IOError("short read of {0} bytes at offset {1} of {2}".format(size, offset, self.dev_path))
+        return data
+
+    def get_used_ranges(self):
+        """
+        returns the sorted, merged list of [offset, length] byte ranges in use, or None if the file system is not supported
+        or was not cleanly unmounted.
+        """
+        file_system = (self.file_system or '').lower()
+        used_ranges = None
+        with open(self.dev_path, 'rb') as f:
+            if file_system in ['ext2', 'ext3', 'ext4']:
+                used_ranges = self.get_ext_used_ranges(f)
+            elif file_system == 'xfs':
+                used_ranges = self.get_xfs_used_ranges(f)
+        if used_ranges is None:
+            return None
+        return self.merge_ranges(used_ranges)
+
+    @staticmethod
+    def merge_ranges(ranges):
+        merged = []
+        for offset, length in sorted(ranges):
+            if length <= 0:
+                continue
+            if merged and offset <= merged[-1][0] + merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], offset + length - merged[-1][0])
+            else:
+                merged.append([offset, length])
+        return merged
+
+    @staticmethod
+    def count_set_bits(data):
+        if not data:
+            return 0
+        return bin(int(binascii.hexlify(data), 16)).count('1')
+
+    def get_ext_used_ranges(self, f):
+        sb = self.read_at(f, FreeSpaceMap.ext_superblock_offset, 1024)
+        if struct.unpack_from('<H', sb, 0x38)[0] != FreeSpaceMap.ext_magic:
+            raise ValueError("{0} has no ext superblock".format(self.dev_path))
+
+        blocks_count_lo, _, _, _, first_data_block, log_block_size, log_cluster_size, blocks_per_group, \
+            clusters_per_group, inodes_per_group = struct.unpack_from('<10I', sb, 0x4)
+        inode_size = struct.unpack_from('<H', sb, 0x58)[0] if struct.unpack_from('<I', sb, 0x4C)[0] > 0 else 128
+        feature_compat, feature_incompat, feature_ro_compat = struct.unpack_from('<3I', sb, 0x5C)
+        state = struct.unpack_from('<H', sb, 0x3A)[0]
+        if feature_incompat & FreeSpaceMap.ext_feature_incompat_recover or not state & FreeSpaceMap.ext_state_valid \
+                or state & FreeSpaceMap.ext_state_error:
+            # the journal has not been replayed or the file system has errors, the bitmaps may miss blocks in use
+            self.logger.log(msg="{0} was not cleanly unmounted (state {1:#x}, incompat features {2:#x}), it will be copied whole"
+                            .format(self.dev_path, state, feature_incompat),
+                            level=CommonVariables.WarningLevel)
+            return None
+        reserved_gdt_blocks = struct.unpack_from('<H', sb, 0xCE)[0]
+        first_meta_bg = struct.unpack_from('<I', sb, 0x104)[0]
+        backup_bgs = struct.unpack_from('<2I', sb, 0x24C)
+
+        block_size = 1024 << log_block_size
+        blocks_count = blocks_count_lo
+        desc_size = 32
+        if feature_incompat & FreeSpaceMap.ext_feature_incompat_64bit:
+            blocks_count |= struct.unpack_from('<I', sb, 0x150)[0] << 32
+            desc_size = max(struct.unpack_from('<H', sb, 0xFE)[0], 32)
+        # with bigalloc the bitmaps track clusters instead of blocks
+        blocks_per_bit = 1
+        if feature_ro_compat & FreeSpaceMap.ext_feature_ro_compat_bigalloc:
+            blocks_per_bit = 1 << (log_cluster_size - log_block_size)
+            blocks_per_group = clusters_per_group * blocks_per_bit
+        group_count = (blocks_count - first_data_block + blocks_per_group - 1) // blocks_per_group
+        descs_per_block = block_size // desc_size
+        gdt_blocks = (group_count + descs_per_block - 1) // descs_per_block
+        inode_table_blocks = (inodes_per_group * inode_size + block_size - 1) // block_size
+        uninit_flags_valid = feature_ro_compat & (FreeSpaceMap.ext_feature_ro_compat_gdt_csum | FreeSpaceMap.ext_feature_ro_compat_metadata_csum)
+        meta_bg = feature_incompat & FreeSpaceMap.ext_feature_incompat_meta_bg
+
+        def group_first_block(group):
+            return first_data_block + group * blocks_per_group
+
+        def group_has_super(group):
+            if group == 0:
+                return True
+            if feature_compat & FreeSpaceMap.ext_feature_compat_sparse_super2:
+                return group in backup_bgs
+            if not feature_ro_compat & FreeSpaceMap.ext_feature_ro_compat_sparse_super or group == 1:
+                return True
+            for base in [3, 5, 7]:
+                power = base
+                while power < group:
+                    power *= base
+                if power == group:
+                    return True
+            return False
+
+        def descriptor_block(index):
+            if not meta_bg or index < first_meta_bg:
+                return first_data_block + 1 + index
+            group = index * descs_per_block
+            return group_first_block(group) + (1 if group_has_super(group) else 0)
+
+        def group_base_metadata_blocks(group):
+            """
+            superblock backup and group descriptor blocks at the start of a group, like ext4_num_base_meta_clusters.
+            """
+            has_super = 1 if group_has_super(group) else 0
+            if not meta_bg or group < first_meta_bg * descs_per_block:
+                if not has_super:
+                    return 0
+                return has_super + (first_meta_bg if meta_bg else gdt_blocks) + reserved_gdt_blocks
+            return has_super + (1 if group % descs_per_block in [0, 1, descs_per_block - 1] else 0)
+
+        descriptors = []
+        for index in range(gdt_blocks):
+            data = self.read_at(f, descriptor_block(index) * block_size, block_size)
+            for position in range(descs_per_block):
+                if len(descriptors) == group_count:
+                    break
+                desc = data[position * desc_size:(position + 1) * desc_size]
+                block_bitmap, inode_bitmap, inode_table, free_blocks = struct.unpack_from('<3IH', desc, 0)
+                flags = struct.unpack_from('<H', desc, 0x12)[0]
+                if desc_size >= 64:
+                    block_bitmap |= struct.unpack_from('<I', desc, 0x20)[0] << 32
+                    inode_bitmap |= struct.unpack_from('<I', desc, 0x24)[0] << 32
+                    inode_table |= struct.unpack_from('<I', desc, 0x28)[0] << 32
+                    free_blocks |= struct.unpack_from('<H', desc, 0x2C)[0] << 16
+                descriptors.append((block_bitmap, inode_bitmap, inode_table, free_blocks, flags))
+
+        # the bitmaps and inode tables of a group can live in other groups, e.g. with flex_bg
+        metadata_by_group = {}
+        for block_bitmap, inode_bitmap, inode_table, _, _ in descriptors:
+            for start, length in [(block_bitmap, 1), (inode_bitmap, 1), (inode_table, inode_table_blocks)]:
+                for group in range((start - first_data_block) // blocks_per_group, (start + length - 1 - first_data_block) // blocks_per_group + 1):
+                    metadata_by_group.setdefault(group, []).append((start, length))
+
+        used_blocks = []
+        if first_data_block > 0:
+            used_blocks.append((0, first_data_block))
+        for group, (block_bitmap, _, _, free_blocks, flags) in enumerate(descriptors):
+            first_block = group_first_block(group)
+            group_blocks = min(blocks_per_group, blocks_count - first_block)
+            group_bits = (group_blocks + blocks_per_bit - 1) // blocks_per_bit
+
+            if uninit_flags_valid and flags & FreeSpaceMap.ext_bg_block_uninit:
+                if blocks_per_bit > 1:
+                    group_used = [(first_block, group_blocks)]
+                    free_bits = free_blocks
+                else:
+                    group_used = list(metadata_by_group.get(group, []))
+                    group_used.append((first_block, group_base_metadata_blocks(group)))
+                    group_used = [(max(start, first_block), min(start + length, first_block + group_blocks) - max(start, first_block))
+                                  for start, length in FreeSpaceMap.merge_ranges(group_used)]
+                    free_bits = group_bits - sum(length for _, length in group_used if length > 0)
+            else:
+                bitmap = self.read_at(f, block_bitmap * block_size, (group_bits + 7) // 8)
+                group_used = []
+                # a byte with any bit set counts as 8 used bits, which keeps the scan in C code
+                for match in re.finditer(b'[^\\x00]+', bitmap):
+                    start = first_block + match.start() * 8 * blocks_per_bit
+                    end = min(first_block + match.end() * 8 * blocks_per_bit, first_block + group_blocks)
+                    group_used.append((start, end - start))
+                used_bits = self.count_set_bits(bitmap[:group_bits // 8])
+                if group_bits % 8:
+                    used_bits += self.count_set_bits(struct.pack('B', bytearray(bitmap)[group_bits // 8] & ((1 << (group_bits % 8)) - 1)))
+                free_bits = group_bits - used_bits
+
+            if free_bits != free_blocks:
+                self.logger.log(msg="block group {0} of {1} has {2} free blocks in its bitmap but {3} in its descriptor, treating it as used"
+                                .format(group, self.dev_path, free_bits, free_blocks),
+                                level=CommonVariables.WarningLevel)
+                group_used = [(first_block, group_blocks)]
+            used_blocks.extend(group_used)
+
+        return [(start * block_size, length * block_size) for start, length in used_blocks]
+
+    def get_xfs_used_ranges(self, f):
+        sb = self.read_at(f, 0, 512)
+        if sb[0:4] != FreeSpaceMap.xfs_magic:
+            raise ValueError("{0} has no xfs superblock".format(self.dev_path))
+
+        block_size, = struct.unpack_from('>I', sb, 0x4)
+        data_blocks, = struct.unpack_from('>Q', sb, 0x8)
+        ag_blocks, ag_count = struct.unpack_from('>2I', sb, 0x54)
+        version, sector_size = struct.unpack_from('>2H', sb, 0x64)
+        # v5 file systems have the longer self describing btree block header
+        btree_header_size = 56 if version & 0xf == 5 else 16
+
+        if not self.is_xfs_log_clean():
+            # the free space btrees may miss allocations that are only in the log
+            self.logger.log(msg="the log of {0} is dirty or could not be read, it will be copied whole".format(self.dev_path),
+                            level=CommonVariables.WarningLevel)
+            return None
+
+        free_extents = []
+        for ag in range(ag_count):
+            ag_offset = ag * ag_blocks * block_size
+            agf = self.read_at(f, ag_offset + sector_size, sector_size)
+            if agf[0:4] != FreeSpaceMap.xfs_agf_magic:
+                raise ValueError("allocation group {0} of {1} has no AGF".format(ag, self.dev_path))
+            bno_root, = struct.unpack_from('>I', agf, 0x10)
+            bno_level, = struct.unpack_from('>I', agf, 0x1C)
+
+            self.walk_xfs_bnobt(f, ag_offset, block_size, btree_header_size, bno_root, bno_level, free_extents)
+
+        used_blocks = []
+        next_block = 0
+        for start, length in sorted(free_extents):
+            if start > next_block:
+                used_blocks.append((next_block, start - next_block))
+            next_block = max(next_block, start + length)
+        if next_block < data_blocks:
+            used_blocks.append((next_block, data_blocks - next_block))
+
+        return [(start * block_size, length * block_size) for start, length in used_blocks]
+
+    def is_xfs_log_clean(self):
+        """
+        xfs_logprint -t reports the log as <CLEAN> when its head is an unmount record, anything else counts as dirty.
+        """
+        proc_comm = ProcessCommunicator()
+        return_code = self.command_executor.Execute('xfs_logprint -t ' + self.dev_path, communicator=proc_comm, suppress_logging=True)
+        return return_code == 0 and '<CLEAN>' in (proc_comm.stdout or '')
+
+    def walk_xfs_bnobt(self, f, ag_offset, block_size, header_size, ag_block, level, free_extents):
+        """
+        collects the (file system block, length) free extents of the by-block-number free space btree of one allocation group.
+        """
+        block = self.read_at(f, ag_offset + ag_block * block_size, block_size)
+        if block[0:4] not in FreeSpaceMap.xfs_bnobt_magics:
+            raise ValueError("bad free space btree block {0} in {1}".format(ag_block, self.dev_path))
+        block_level, record_count = struct.unpack_from('>2H', block, 4)
+        if block_level != level - 1:
+            raise ValueError("unexpected free space btree level {0} in {1}".format(block_level, self.dev_path))
+
+        ag_start = ag_offset // block_size
+        if block_level == 0:
+            for i in range(record_count):
+                start, length = struct.unpack_from('>2I', block, header_size + i * 8)
+                free_extents.append((ag_start + start, length))
+        else:
+            max_records = (block_size - header_size) // 12
+            for i in range(record_count):
+                child, = struct.unpack_from('>I', block, header_size + max_records * 8 + i * 4)
+                self.walk_xfs_bnobt(f, ag_offset, block_size, header_size, child, block_level, free_extents)
+
+    def save(self, file_path):
+        """
+        writes the used ranges next to the ongoing item config. on any failure the file is removed,
+        so the data copy falls back to copying the whole device.
+        """
+        try:
+            used_ranges = self.get_used_ranges()
+        except Exception as e:
+            self.logger.log(msg="failed to read the free space map of {0}: {1}, stack trace: {2}".format(self.dev_path, e, traceback.format_exc()),
+                            level=CommonVariables.WarningLevel)
+            used_ranges = None
+
+        if used_ranges is None:
+            FreeSpaceMap.remove(file_path)
+            return False
+
+        used_size = sum(length for _, length in used_ranges)
+        self.logger.log("{0} file system on {1} uses {2} bytes in {3} ranges".format(self.file_system, self.dev_path, used_size, len(used_ranges)))
+        with open(file_path, 'w') as f:
+            json.dump({'source_path': self.dev_path, 'used_ranges': used_ranges}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    @staticmethod
+    def load(file_path, source_path):
+        """
+        returns the used ranges saved for source_path, or None.
+        """
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, 'r') as f:
+            saved = json.load(f)
+        if saved.get('source_path') != source_path:
+            return None
+        return UsedRanges(saved['used_ranges'])
+
+    @staticmethod
+    def remove(file_path):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+class UsedRanges(object):
+    """
+    sorted, non overlapping [offset, length] byte ranges with a fast overlap check.
+    """
+    def __init__(self, ranges):
+        self.starts = [int(r[0]) for r in ranges]
+        self.ends = [int(r[0]) + int(r[1]) for r in ranges]
+
+    def is_used(self, offset, size):
+        if size <= 0:
+            return False
+        index = bisect.bisect_right(self.starts, offset + size - 1) - 1
+        return index >= 0 and self.ends[index] > offset
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+import os.path
+import time
+
+from Common import CommonVariables
+
+
+class IOLoadThrottle(object):
+    """
+    Slows a data copy down while the disks under it are busy and speeds it up again when they are idle.
+    Every sample_interval seconds the counters in /sys/block/<disk>/stat of the disks holding the copied devices,
+    which include the sibling partitions, give the average I/O latency and queue depth since the last sample.
+    The counters include the copy itself, so the requests it made, from the bytes its processes read and wrote
+    in /proc/<pid>/io, are taken off first: the disk only counts as loaded by the requests of the others.
+    The duty cycle, the share of time the copy may run, is halved when either is over its target
+    and raised by increase_step when both are under half of it.
+    """
+    sample_interval = 10
+    min_duty_cycle = 0.05
+    increase_step = 0.1
+    decrease_factor = 0.5
+    sector_size = 512
+    default_max_request_bytes = 512 * 1024
+
+    def __init__(self, logger, device_paths, target_latency_ms, target_queue_depth, sys_block_path='/sys/block', log_lock=None,
+                 proc_path='/proc'):
+        self.logger = logger
+        self.log_lock = log_lock
+        self.sys_block_path = sys_block_path
+        self.proc_path = proc_path
+        # the processes doing the copy, the threads of this one or the cryptsetup it runs
+        self.own_pids = [os.getpid()]
+        self.last_own_bytes = {}
+        self.reported_own_bytes = 0
+        self.target_latency_ms = target_latency_ms
+        self.target_queue_depth = target_queue_depth
+        self.duty_cycle = 1.0
+        self.throttled_seconds = 0.0
+        self.last_stats = None
+        self.last_sample_time = None
+        self.disk_names = []
+        for device_path in device_paths:
+            for disk_name in self.get_disk_names(os.path.basename(os.path.realpath(device_path))):
+                if disk_name not in self.disk_names:
+                    self.disk_names.append(disk_name)
+        self.max_request_bytes = self.get_max_request_bytes()
+        self.log("io throttle: watching {0} for {1}, target latency {2} ms, target queue depth {3}"
+                 .format(self.disk_names, device_paths, target_latency_ms, target_queue_depth))
+
+    @staticmethod
+    def create(logger, public_settings, device_paths, log_lock=None):
+        """
+        returns the throttle when CopyAdaptiveThrottle is enabled in the public settings, None otherwise.
+        """
+        if not public_settings or str(public_settings.get(CommonVariables.CopyAdaptiveThrottleKey)).lower() != 'true':
+            return None
+        targets = []
+        for key, default_target in [(CommonVariables.CopyThrottleTargetLatencyMsKey, CommonVariables.copy_throttle_target_latency_ms),
+                                    (CommonVariables.CopyThrottleTargetQueueDepthKey, CommonVariables.copy_throttle_target_queue_depth)]:
+            target = default_target
+            if public_settings.get(key) is not None:
+                try:
+                    target = max(float(public_settings.get(key)), 0)
+                except ValueError:
+                    logger.log(msg="invalid {0}, using {1}".format(key, default_target), level=CommonVariables.WarningLevel)
+            targets.append(target)
+        io_throttle = IOLoadThrottle(logger, device_paths, targets[0], targets[1], log_lock=log_lock)
+        if not io_throttle.disk_names:
+            io_throttle.log("io throttle: no disk statistics for {0}, not throttling".format(device_paths))
+            return None
+        return io_throttle
+
+    def log(self, msg):
+        if self.log_lock is None:
+            self.logger.log(msg)
+        else:
+            with self.log_lock:
+                self.logger.log(msg)
+
+    def get_disk_names(self, name):
+        """
+        a partition resolves to its disk, a device mapper device to the disks under it.
+        """
+        disk_path = os.path.join(self.sys_block_path, name)
+        if os.path.isdir(disk_path):
+            slaves_path = os.path.join(disk_path, 'slaves')
+            slaves = sorted(os.listdir(slaves_path)) if os.path.isdir(slaves_path) else []
+            if not slaves:
+                return [name]
+            disk_names = []
+            for slave in slaves:
+                disk_names.extend(self.get_disk_names(slave))
+            return disk_names
+        if os.path.isdir(self.sys_block_path):
+            for disk_name in sorted(os.listdir(self.sys_block_path)):
+                if os.path.isdir(os.path.join(self.sys_block_path, disk_name, name)):
+                    return [disk_name]
+        return []
+
+    def get_max_request_bytes(self):
+        """
+        the block layer splits the copy into requests of at most max_sectors_kb.
+        """
+        max_request_bytes = None
+        for disk_name in self.disk_names:
+            try:
+                with open(os.path.join(self.sys_block_path, disk_name, 'queue', 'max_sectors_kb'), 'r') as f:
+                    disk_max_request_bytes = int(f.read().strip()) * 1024
+            except (IOError, OSError, ValueError):
+                continue
+            if disk_max_request_bytes > 0 and (max_request_bytes is None or disk_max_request_bytes < max_request_bytes):
+                max_request_bytes = disk_max_request_bytes
+        return max_request_bytes or IOLoadThrottle.default_max_request_bytes
+
+    def watch_process(self, pid):
+        """
+        the copy is done by pid, like the cryptsetup that reencrypts the device, instead of this process.
+        """
+        self.own_pids = [pid]
+
+    def add_own_io(self, size):
+        """
+        counts the bytes of a process that is gone before the next sample, like a dd of the copy.
+        """
+        self.reported_own_bytes += size
+
+    def read_own_bytes(self):
+        own_bytes = {}
+        for pid in self.own_pids:
+            try:
+                with open(os.path.join(self.proc_path, str(pid), 'io'), 'r') as f:
+                    fields = dict(line.split(':', 1) for line in f.read().splitlines() if ':' in line)
+                own_bytes[pid] = int(fields['read_bytes']) + int(fields['write_bytes'])
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+        return own_bytes
+
+    def get_own_bytes_since_last_sample(self):
+        own_bytes = self.read_own_bytes()
+        # a process started after the last sample did all of its I/O since then
+        own_bytes_delta = sum(max(0, size - self.last_own_bytes.get(pid, 0)) for pid, size in own_bytes.items())
+        own_bytes_delta += self.reported_own_bytes
+        self.last_own_bytes = own_bytes
+        self.reported_own_bytes = 0
+        return own_bytes_delta
+
+    def read_stats(self):
+        stats = {}
+        for disk_name in self.disk_names:
+            try:
+                with open(os.path.join(self.sys_block_path, disk_name, 'stat'), 'r') as f:
+                    fields = [int(field) for field in f.read().split()]
+            except (IOError, OSError, ValueError):
+                continue
+            if len(fields) >= 11:
+                stats[disk_name] = fields
+        return stats
+
+    def get_load(self, stats, elapsed_seconds, own_bytes=0):
+        """
+        returns the highest average latency in ms and the highest average queue depth among the disks that served requests
+        other than the copy's. own_bytes is spread over the disks by the sectors they moved and taken off their completed
+        requests in requests of max_request_bytes, so a disk that only served the copy counts as idle. the queue depth is
+        the share of the time in queue of the other requests, the latency the average of all of them, the copy's requests
+        cannot be told apart there.
+        """
+        latency_ms = 0.0
+        queue_depth = 0.0
+        deltas = {}
+        for disk_name, fields in stats.items():
+            if disk_name in self.last_stats:
+                deltas[disk_name] = [field - last_field for field, last_field in zip(fields, self.last_stats[disk_name])]
+        total_sectors = sum(delta[2] + delta[6] for delta in deltas.values())
+        for delta in deltas.values():
+            # reads and writes completed, and the ms they took
+            completed_ios = delta[0] + delta[4]
+            if completed_ios <= 0:
+                continue
+            own_ios = 0
+            if own_bytes > 0 and total_sectors > 0:
+                disk_own_bytes = own_bytes * (delta[2] + delta[6]) / float(total_sectors)
+                own_ios = int(math.ceil(disk_own_bytes / self.max_request_bytes))
+            other_ios = completed_ios - own_ios
+            if other_ios <= 0:
+                continue
+            latency_ms = max(latency_ms, (delta[3] + delta[7]) / float(completed_ios))
+            # time_in_queue is the ms of I/O in flight summed over all requests
+            queue_depth = max(queue_depth, delta[10] * other_ios / float(completed_ios) / (elapsed_seconds * 1000.0))
+        return latency_ms, queue_depth
+
+    def update(self):
+        """
+        takes a sample once sample_interval has passed, logs the decision and returns the duty cycle.
+        """
+        now = time.time()
+        if self.last_sample_time is not None and now - self.last_sample_time < IOLoadThrottle.sample_interval:
+            return self.duty_cycle
+        stats = self.read_stats()
+        own_bytes = self.get_own_bytes_since_last_sample()
+        if self.last_stats is not None and now > self.last_sample_time:
+            latency_ms, queue_depth = self.get_load(stats, now - self.last_sample_time, own_bytes)
+            duty_cycle = self.duty_cycle
+            if latency_ms > self.target_latency_ms or (self.target_queue_depth > 0 and queue_depth > self.target_queue_depth):
+                decision = "backing off"
+                duty_cycle = max(IOLoadThrottle.min_duty_cycle, duty_cycle * IOLoadThrottle.decrease_factor)
+            elif latency_ms <= self.target_latency_ms / 2 and (self.target_queue_depth <= 0 or queue_depth <= self.target_queue_depth / 2):
+                decision = "speeding up"
+                duty_cycle = min(1.0, duty_cycle + IOLoadThrottle.increase_step)
+            else:
+                decision = "holding"
+            self.log("io throttle: latency {0:.1f} ms, queue depth {1:.1f} on {2}, {3}, duty cycle {4:.2f} -> {5:.2f}"
+                     .format(latency_ms, queue_depth, self.disk_names, decision, self.duty_cycle, duty_cycle))
+            self.duty_cycle = duty_cycle
+        self.last_stats = stats
+        self.last_sample_time = now
+        return self.duty_cycle
+
+    def get_pause(self, busy_seconds):
+        """
+        returns how long to pause after busy_seconds of copying to keep to the duty cycle.
+        """
+        duty_cycle = self.update()
+        return busy_seconds * (1.0 / duty_cycle - 1.0)
+
+    def take_pause(self, busy_seconds):
+        """
+        returns the pause after busy_seconds of copying and counts it as throttled, for the callers that sleep it themselves.
+        """
+        pause_seconds = self.get_pause(busy_seconds)
+        if pause_seconds > 0:
+            self.throttled_seconds += pause_seconds
+        return pause_seconds
+
+    def pace(self, busy_seconds):
+        pause_seconds = self.take_pause(busy_seconds)
+        if pause_seconds > 0:
+            time.sleep(pause_seconds)
+        return pause_seconds
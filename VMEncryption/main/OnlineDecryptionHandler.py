@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import os.path
+import threading
+try:
+    from queue import Queue # Python 3
+except ImportError:
+    from Queue import Queue # Python 2
+
+from Common import CommonVariables
+from CommandExecutor import CommandExecutor
+from OnlineEncryptionHandler import OnlineEncryptionItem
+from OnlineEncryptionResumer import OnlineEncryptionResumer
+
+
+class OnlineDecryptionHandler:
+    """
+    decrypts LUKS2 data volumes in place with cryptsetup reencrypt --decrypt while they stay mounted.
+    a header in the device is moved out to a file first, and the data is shifted back to the start of the device.
+    the volumes are decrypted in the background, and resumed after a restart like the online encryption.
+    """
+    def __init__(self, logger, encryption_environment, public_setting=None):
+        self.devices = Queue()
+        self.logger = logger
+        self.encryption_environment = encryption_environment
+        self.command_executor = CommandExecutor(self.logger)
+        self.public_setting = public_setting
+        self.results_lock = threading.Lock()
+        self.decrypted_items = []
+        self.failed_items = []
+
+    def get_moved_header_path(self, crypt_item):
+        return self.encryption_environment.luks_header_base_path + crypt_item.mapper_name
+
+    def get_header_path(self, crypt_item):
+        """
+        the header of the volume, or the one moved out of it if the decryption was started before the crypt item was updated.
+        """
+        if crypt_item.luks_header_path:
+            return crypt_item.luks_header_path
+        if os.path.exists(self.get_moved_header_path(crypt_item)):
+            return self.get_moved_header_path(crypt_item)
+        return None
+
+    def get_key_file(self, crypt_item):
+        # the volumes were made unlockable with a cleartext key when the decryption was requested
+        return self.encryption_environment.cleartext_key_base_path + crypt_item.mapper_name
+
+    def handle(self, crypt_items, disk_util, crypt_mount_config_util):
+        """
+        starts the decryption of the volumes that are not in reencryption yet, and queues every volume left to decrypt.
+        returns the crypt item that could not be started, or None.
+        """
+        for crypt_item in crypt_items:
+            self.logger.log("Setting up decryption of " + crypt_item.dev_path)
+            header_path = self.get_header_path(crypt_item)
+            if disk_util.luks_check_reencryption(crypt_item.dev_path, header_path):
+                self.logger.log("Device {0} needs resume decryption.".format(crypt_item.dev_path))
+                if crypt_item.luks_header_path is None and header_path is not None:
+                    self.use_moved_header(crypt_item, header_path, crypt_mount_config_util)
+            elif not disk_util.is_luks_device(crypt_item.dev_path, header_path):
+                # cryptsetup wipes the header once it is done, the crypt item is all that is left
+                self.logger.log("Device {0} is decrypted already.".format(crypt_item.dev_path))
+                self.decrypted_items.append(crypt_item)
+                continue
+            elif disk_util.get_luks_version(crypt_item.dev_path, header_path) != "2":
+                self.logger.log(msg="Online decryption needs a LUKS2 header on {0}".format(crypt_item.dev_path),
+                                level=CommonVariables.ErrorLevel)
+                return crypt_item
+            elif not disk_util.supports_online_decryption(header_path):
+                self.logger.log(msg="cryptsetup cannot decrypt {0} online".format(crypt_item.dev_path),
+                                level=CommonVariables.ErrorLevel)
+                return crypt_item
+            elif not self.init_decryption(crypt_item, crypt_mount_config_util):
+                return crypt_item
+            self.devices.put(OnlineEncryptionItem(crypt_item, self.get_key_file(crypt_item)))
+        return None
+
+    def init_decryption(self, crypt_item, crypt_mount_config_util):
+        header_path = crypt_item.luks_header_path
+        if header_path is None:
+            header_path = self.get_moved_header_path(crypt_item)
+            if os.path.exists(header_path):
+                self.logger.log(msg="{0} already exists, not moving the header of {1} there".format(header_path, crypt_item.dev_path),
+                                level=CommonVariables.ErrorLevel)
+                return False
+
+        init_status_code = self.command_executor.ExecuteInBash('cryptsetup reencrypt --decrypt --init-only --header {0} {1} -d {2} -q'.format(header_path,
+                                                                                                                                        crypt_item.dev_path,
+                                                                                                                                        self.get_key_file(crypt_item)))
+        if init_status_code != CommonVariables.success:
+            self.logger.log(msg="Failed to start the decryption of device: " + crypt_item.dev_path,
+                            level=CommonVariables.ErrorLevel)
+            return False
+
+        if crypt_item.luks_header_path is None:
+            self.use_moved_header(crypt_item, header_path, crypt_mount_config_util)
+        return True
+
+    def use_moved_header(self, crypt_item, header_path, crypt_mount_config_util):
+        # the volume is opened with the header moved out of it until it is decrypted
+        crypt_item.luks_header_path = header_path
+        crypt_mount_config_util.update_crypt_item(crypt_item)
+
+    def get_online_decryption_item(self, queue_lock, log_lock):
+        online_decryption_item = None
+        queue_lock.acquire()
+        try:
+            if not self.devices.empty():
+                online_decryption_item = self.devices.get()
+            else:
+                self.update_log("No more devices to decrypt.", log_lock)
+        finally:
+            queue_lock.release()
+        return online_decryption_item
+
+    def resume_decryption(self, disk_util, log_lock, queue_lock):
+        online_decryption_item = self.get_online_decryption_item(queue_lock, log_lock)
+        while online_decryption_item is not None:
+            self.update_log("Picked up device " + online_decryption_item.crypt_item.dev_path, log_lock)
+            decrypted = OnlineEncryptionResumer(online_decryption_item.crypt_item, disk_util, online_decryption_item.bek_file_path,
+                                                self.logger, None, decrypt=True).begin_resume(False, log_lock, public_setting=self.public_setting)
+            with self.results_lock:
+                if decrypted:
+                    self.decrypted_items.append(online_decryption_item.crypt_item)
+                else:
+                    self.failed_items.append(online_decryption_item.crypt_item)
+            online_decryption_item = self.get_online_decryption_item(queue_lock, log_lock)
+
+    def update_log(self, msg, log_lock):
+        log_lock.acquire()
+        self.logger.log(msg)
+        log_lock.release()
+
+    def handle_resume_decryption(self, disk_util):
+        max_threads = self.devices.qsize() # a thread for each volume, like the online encryption
+        # from the main thread, before the throttled threads stop cryptsetup
+        handlers_installed = OnlineEncryptionResumer.install_resume_handlers()
+        threads = []
+        log_lock = threading.Lock()
+        queue_lock = threading.Lock()
+        try:
+            for _ in range(max_threads):
+                thread = threading.Thread(target=self.resume_decryption, args=(disk_util, log_lock, queue_lock))
+                threads.append(thread)
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+        finally:
+            if handlers_installed:
+                OnlineEncryptionResumer.restore_resume_handlers()
+
+    def finish_decryption(self, crypt_mount_config_util):
+        """
+        puts the decrypted volumes back in fstab and drops their crypt items, one at a time once every thread is done.
+        the volumes stay mounted on their mappers, which map the decrypted devices straight until they are unmounted.
+        returns the first crypt item that failed to decrypt, or None.
+        """
+        for crypt_item in self.decrypted_items:
+            mount_point = crypt_item.mount_point
+            if mount_point and mount_point != "None":
+                self.logger.log(msg="restoring entry for unencrypted drive from fstab", level=CommonVariables.InfoLevel)
+                crypt_mount_config_util.restore_mount_info(mount_point)
+            elif crypt_item.mapper_name:
+                crypt_mount_config_util.restore_mount_info(crypt_item.mapper_name)
+
+            backup_folder = os.path.join(crypt_item.mount_point, ".azure_ade_backup_mount_info/") if crypt_item.mount_point else None
+            crypt_mount_config_util.remove_crypt_item(crypt_item, backup_folder)
+
+            moved_header_path = self.get_moved_header_path(crypt_item)
+            if crypt_item.luks_header_path == moved_header_path and os.path.exists(moved_header_path):
+                os.remove(moved_header_path)
+            self.logger.log("Decrypted {0} online".format(crypt_item.dev_path))
+
+        return self.failed_items[0] if self.failed_items else None
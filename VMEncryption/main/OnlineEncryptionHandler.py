@@ -156,16 +156,22 @@ class OnlineEncryptionHandler:
 
     def handle_resume_encryption(self, disk_util):
         max_threads = self.devices.qsize() #For now there will be a thread for each volume
+        # from the main thread, before the throttled threads stop cryptsetup
+        handlers_installed = OnlineEncryptionResumer.install_resume_handlers()
         threads = []
         log_lock = threading.Lock()
         queue_lock = threading.Lock()
-        for thr in range(max_threads):
-            thread = threading.Thread(target=self.resume_encryption, args=(disk_util, log_lock, queue_lock))
-            threads.append(thread)
-            threads[thr].start()
+        try:
+            for thr in range(max_threads):
+                thread = threading.Thread(target=self.resume_encryption, args=(disk_util, log_lock, queue_lock))
+                threads.append(thread)
+                threads[thr].start()
 
-        for thr in range(max_threads):
-            threads[thr].join()
+            for thr in range(max_threads):
+                threads[thr].join()
+        finally:
+            if handlers_installed:
+                OnlineEncryptionResumer.restore_resume_handlers()
 
 
 
@@ -15,28 +15,112 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import atexit
+import glob
 import shlex
+import signal
 import subprocess
 import os
 import os.path
-from time import sleep
-from threading import Lock
+from time import sleep, time
+from threading import RLock
 
 from Common import CommonVariables
+from DeviceTopologyCache import DeviceTopologyCache
+from IOLoadThrottle import IOLoadThrottle
 
 
 class OnlineEncryptionResumer:
-    def __init__(self, crypt_item, disk_util, bek_file_path, logger, hutil):
+    # the cryptsetup processes stopped by wait_throttled right now, continued by whatever ends this process
+    stopped_pids = set()
+    stopped_pids_lock = RLock()
+    exit_handler_registered = False
+    # the signal handlers that were set before the resume handlers, and how many resumes still need them
+    previous_signal_handlers = {}
+    resume_handlers_users = 0
+
+    def __init__(self, crypt_item, disk_util, bek_file_path, logger, hutil, decrypt=False):
         self.STATUS_INTERVAL = 15
+        self.THROTTLE_PERIOD = 1
+        self.sys_block_path = '/sys/block'
+        self.proc_path = '/proc'
         self.crypt_item = crypt_item
         self.disk_util = disk_util
         self.bek_file_path = bek_file_path
         self.logger = logger
         self.hutil = hutil
+        # the same background reencryption, resumed for an online decryption
+        self.decrypt = decrypt
 
     def _get_status_file(self):
         return self.disk_util.encryption_environment.resume_daemon_status_file_path + self.crypt_item.mapper_name + ".txt"
 
+    @staticmethod
+    def continue_stopped_processes():
+        with OnlineEncryptionResumer.stopped_pids_lock:
+            pids = list(OnlineEncryptionResumer.stopped_pids)
+            OnlineEncryptionResumer.stopped_pids.clear()
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGCONT)
+            except OSError:
+                pass
+
+    @staticmethod
+    def get_resume_signal_handler(previous_handler):
+        def resume_signal_handler(signum, frame):
+            OnlineEncryptionResumer.continue_stopped_processes()
+            if callable(previous_handler):
+                previous_handler(signum, frame)
+            elif previous_handler != signal.SIG_IGN:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+        return resume_signal_handler
+
+    @staticmethod
+    def install_resume_handlers():
+        """
+        continues the stopped cryptsetup processes when this process exits or is terminated, before the handlers that were set.
+        signal handlers can only be set from the main thread, the online handlers install them before they start their threads.
+        returns True if the handlers are installed, and restore_resume_handlers is to be called once the resume ends.
+        """
+        with OnlineEncryptionResumer.stopped_pids_lock:
+            if not OnlineEncryptionResumer.exit_handler_registered:
+                atexit.register(OnlineEncryptionResumer.continue_stopped_processes)
+                OnlineEncryptionResumer.exit_handler_registered = True
+            if OnlineEncryptionResumer.resume_handlers_users > 0:
+                OnlineEncryptionResumer.resume_handlers_users += 1
+                return True
+            previous_signal_handlers = {}
+            try:
+                for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+                    previous_signal_handlers[signum] = signal.getsignal(signum)
+                    signal.signal(signum, OnlineEncryptionResumer.get_resume_signal_handler(previous_signal_handlers[signum]))
+            except ValueError:
+                # not the main thread, the first call fails before any handler is set
+                return False
+            OnlineEncryptionResumer.previous_signal_handlers = previous_signal_handlers
+            OnlineEncryptionResumer.resume_handlers_users = 1
+            return True
+
+    @staticmethod
+    def restore_resume_handlers():
+        """
+        puts the signal handlers back once the last resume that installed the resume handlers ends.
+        """
+        with OnlineEncryptionResumer.stopped_pids_lock:
+            OnlineEncryptionResumer.resume_handlers_users -= 1
+            if OnlineEncryptionResumer.resume_handlers_users > 0:
+                return
+            for signum, previous_handler in OnlineEncryptionResumer.previous_signal_handlers.items():
+                try:
+                    # None is a handler that was not set from python
+                    signal.signal(signum, previous_handler if previous_handler is not None else signal.SIG_DFL)
+                except ValueError:
+                    OnlineEncryptionResumer.resume_handlers_users = 1
+                    return
+            OnlineEncryptionResumer.previous_signal_handlers = {}
+
     def update_log(self, msg, lock):
         if lock is None:
             self.logger.log(msg)
@@ -46,38 +130,153 @@ class OnlineEncryptionResumer:
             self.logger.log(msg)
             lock.release()
 
+    def get_suspended_devices(self):
+        """
+        returns the names of the suspended device mapper devices of this volume, with the overlays cryptsetup adds while reencrypting.
+        """
+        suspended_devices = []
+        for dm_path in sorted(glob.glob(os.path.join(self.sys_block_path, 'dm-*'))):
+            try:
+                with open(os.path.join(dm_path, 'dm', 'name'), 'r') as f:
+                    name = f.read().strip()
+                with open(os.path.join(dm_path, 'dm', 'suspended'), 'r') as f:
+                    suspended = f.read().strip() == '1'
+            except (IOError, OSError):
+                continue
+            if suspended and name.startswith(self.crypt_item.mapper_name):
+                suspended_devices.append(name)
+        return suspended_devices
+
+    def wait_stopped(self, pid):
+        """
+        SIGSTOP is delivered asynchronously, the process is stopped once its state in /proc turns to T.
+        """
+        for _ in range(100):
+            try:
+                with open(os.path.join(self.proc_path, str(pid), 'stat'), 'r') as f:
+                    state = f.read().rsplit(')', 1)[1].split()[0]
+            except (IOError, OSError, IndexError):
+                return False
+            if state in ['T', 't']:
+                return True
+            sleep(0.01)
+        return False
+
+    def continue_orphaned_processes(self, lock):
+        """
+        continues the cryptsetup of this volume left stopped by an earlier run of the extension that was killed while it was paused,
+        the volume hangs until it is. returns the pids that were continued.
+        """
+        pids = []
+        for stat_path in glob.glob(os.path.join(self.proc_path, '[0-9]*', 'stat')):
+            pid_path = os.path.dirname(stat_path)
+            try:
+                with open(stat_path, 'r') as f:
+                    state = f.read().rsplit(')', 1)[1].split()[0]
+                with open(os.path.join(pid_path, 'cmdline'), 'r') as f:
+                    args = f.read().split('\0')
+            except (IOError, OSError, IndexError):
+                continue
+            if state not in ['T', 't'] or os.path.basename(args[0]) != 'cryptsetup' or 'reencrypt' not in args or self.crypt_item.mapper_name not in args:
+                continue
+            self.update_log("continuing the stopped reencryption of {0}: {1}".format(self.crypt_item.dev_path, ' '.join(args).strip()), lock)
+            pid = int(os.path.basename(pid_path))
+            try:
+                os.kill(pid, signal.SIGCONT)
+            except OSError:
+                continue
+            pids.append(pid)
+        return pids
+
+    def wait_throttled(self, child, io_throttle, seconds, lock):
+        """
+        lets cryptsetup run for the duty cycle of every THROTTLE_PERIOD and stops it for the rest.
+        cryptsetup suspends the volume while it switches the hotzone, and stopped then the volume would hang,
+        so it is resumed right away if it was caught with a device suspended.
+        cryptsetup is continued on the way out of every pause, and by the resume handlers if this process ends during one.
+        """
+        handlers_installed = OnlineEncryptionResumer.install_resume_handlers()
+        try:
+            deadline = time() + seconds
+            while child.poll() is None and time() < deadline:
+                run_seconds = self.THROTTLE_PERIOD * io_throttle.update()
+                sleep(run_seconds)
+                pause_seconds = self.THROTTLE_PERIOD - run_seconds
+                if pause_seconds <= 0 or child.poll() is not None:
+                    continue
+                with OnlineEncryptionResumer.stopped_pids_lock:
+                    OnlineEncryptionResumer.stopped_pids.add(child.pid)
+                os.kill(child.pid, signal.SIGSTOP)
+                try:
+                    suspended_devices = self.get_suspended_devices() if self.wait_stopped(child.pid) else None
+                    if suspended_devices is None or suspended_devices:
+                        self.update_log("not pausing the reencryption of {0}, suspended devices: {1}".format(self.crypt_item.dev_path, suspended_devices), lock)
+                        continue
+                    io_throttle.throttled_seconds += pause_seconds
+                    sleep(pause_seconds)
+                finally:
+                    try:
+                        os.kill(child.pid, signal.SIGCONT)
+                    except OSError:
+                        pass
+                    with OnlineEncryptionResumer.stopped_pids_lock:
+                        OnlineEncryptionResumer.stopped_pids.discard(child.pid)
+        finally:
+            if handlers_installed:
+                OnlineEncryptionResumer.restore_resume_handlers()
+
     def begin_resume(self, log_status=True, lock=None, import_token = False, public_setting=None):
-        self.logger.log("Starting background resume encrytion for device: " + self.crypt_item.dev_path)
+        """
+        returns True once the reencryption is done, and False if it could not be run to the end.
+        """
+        operation = "decryption" if self.decrypt else "encryption"
+        self.logger.log("Starting background resume {0} for device: {1}".format(operation, self.crypt_item.dev_path))
         mapper_path = os.path.join(CommonVariables.dev_mapper_root, self.crypt_item.mapper_name)
         if not os.path.exists(mapper_path):
-            self.update_log("{0} does not exist. Exiting Resume encryption daemon.".format(mapper_path), lock)
-            return
+            self.update_log("{0} does not exist. Exiting Resume {1} daemon.".format(mapper_path, operation), lock)
+            return False
+
+        # the continued cryptsetup holds the reencryption lock, it is left to finish what it was doing
+        orphaned_pids = self.continue_orphaned_processes(lock)
+        while any(os.path.exists(os.path.join(self.proc_path, str(pid))) for pid in orphaned_pids):
+            sleep(self.STATUS_INTERVAL)
 
         if not self.disk_util.luks_check_reencryption(self.crypt_item.dev_path, self.crypt_item.luks_header_path):
             self.update_log("{0} is not in reencryption.".format(mapper_path), lock)
-            return
+            return True
 
         resume_cmd = None
-        if self.crypt_item.luks_header_path is None:
+        if self.decrypt:
+            # the decryption keeps the resilience it was started with, the data shift for a header moved out of the device
+            resume_cmd = "cryptsetup reencrypt --resume-only --active-name {0} --header {1} -d {2}".format(self.crypt_item.mapper_name, self.crypt_item.luks_header_path, self.bek_file_path)
+        elif self.crypt_item.luks_header_path is None:
             resume_cmd = "cryptsetup reencrypt --resume-only --active-name {0} -d {1}".format(self.crypt_item.mapper_name, self.bek_file_path)
         else:
             resume_cmd = "cryptsetup reencrypt --resume-only --active-name {0} --header {1} -d {2} --resilience journal".format(self.crypt_item.mapper_name, self.crypt_item.luks_header_path, self.bek_file_path)
+        io_throttle = IOLoadThrottle.create(self.logger, public_setting, [mapper_path, self.crypt_item.dev_path], log_lock=lock)
         status_file_path = self._get_status_file()
         with open(status_file_path, "wb") as status_file_write:
             args = shlex.split(resume_cmd)
 
             # Run resume command but redirect it's stdout to a file
             child = subprocess.Popen(args, stdout=status_file_write, stderr=subprocess.PIPE)
+            # cryptsetup swaps the device mapper tables while it runs, it is not run by a CommandExecutor
+            DeviceTopologyCache.note_command(args)
+            if io_throttle is not None:
+                io_throttle.watch_process(child.pid)
 
             status_message = None
             while child.poll() is None:
-                sleep(self.STATUS_INTERVAL)
+                if io_throttle is None:
+                    sleep(self.STATUS_INTERVAL)
+                else:
+                    self.wait_throttled(child, io_throttle, self.STATUS_INTERVAL, lock)
                 with open(status_file_path, "r") as status_file_read:
                     lines = status_file_read.readlines()
                     if len(lines) > 0:
                         status_message = lines[-1].strip()
                 if status_message:
-                    full_message = "Background encrypting {0} - {1}".format(self.crypt_item.dev_path, status_message)
+                    full_message = "Background {0} {1} - {2}".format("decrypting" if self.decrypt else "encrypting", self.crypt_item.dev_path, status_message)
                     if log_status:
                         self.hutil.do_status_report(operation='DataCopy',
                                                     status=CommonVariables.extension_success_status,
@@ -85,8 +284,9 @@ class OnlineEncryptionResumer:
                                                     message=full_message)
                     else:
                         self.update_log(full_message, lock)
+            DeviceTopologyCache.note_command(args)
             if child.returncode == CommonVariables.success:
-                message = "Background encryption finished for {0}".format(self.crypt_item.dev_path)
+                message = "Background {0} finished for {1}".format(operation, self.crypt_item.dev_path)
                 if import_token and public_setting:
                     self.update_log("Background token update to device {0}".format(self.crypt_item.dev_path),lock)
                     self.disk_util.import_token(device_path=self.crypt_item.dev_path,
@@ -99,5 +299,10 @@ class OnlineEncryptionResumer:
                                                 message=message)
                 else:
                     self.update_log(message, lock)
+            else:
+                self.update_log("Background {0} of {1} failed with return code {2}: {3}".format(operation, self.crypt_item.dev_path, child.returncode, child.stderr.read()), lock)
+        if io_throttle is not None:
+            self.update_log("the io throttle paused the reencryption of {0} for {1:.1f} seconds".format(self.crypt_item.dev_path, io_throttle.throttled_seconds), lock)
         # Let's clean up after ourselves
         os.remove(status_file_path)
+        return child.returncode == CommonVariables.success
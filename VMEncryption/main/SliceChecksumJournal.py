@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import os.path
+import zlib
+from Common import CommonVariables
+
+
+class SliceChecksumJournal(object):
+    """
+    Keeps the checksum of every slice written to the destination, next to the ongoing item config.
+    The first line identifies the copy, every other line is "offset size checksum" for one slice,
+    so the records stay valid when the slice size changes. A torn last line is ignored.
+    """
+    algorithm = 'crc32'
+
+    def __init__(self, logger, file_path, source, destination):
+        self.logger = logger
+        self.file_path = file_path
+        self.header = {'source': source, 'destination': destination, 'algorithm': SliceChecksumJournal.algorithm}
+        self.checksums = {}
+        self.journal_file = None
+
+    @staticmethod
+    def checksum(buffer_view):
+        return zlib.crc32(buffer_view) & 0xffffffff
+
+    def load(self):
+        """
+        reads the records of the same copy, a journal of another copy is started over.
+        """
+        self.checksums = {}
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'r') as f:
+                content = f.read()
+            lines = content.split('\n')
+            try:
+                header = json.loads(lines[0])
+            except ValueError:
+                header = None
+            if header == self.header:
+                for line in lines[1:]:
+                    fields = line.split()
+                    if len(fields) == 3 and all(field.isdigit() for field in fields):
+                        self.checksums[(int(fields[0]), int(fields[1]))] = int(fields[2])
+                self.logger.log("loaded {0} slice checksums from {1}".format(len(self.checksums), self.file_path))
+                self.journal_file = open(self.file_path, 'a')
+                if not content.endswith('\n'):
+                    # end the torn record, so that the next one is read back
+                    self.journal_file.write('\n')
+                return
+            self.logger.log(msg="the slice checksums in {0} are for another copy, starting over".format(self.file_path),
+                            level=CommonVariables.WarningLevel)
+
+        self.journal_file = open(self.file_path, 'w')
+        self.journal_file.write(json.dumps(self.header) + '\n')
+        self.journal_file.flush()
+
+    def add(self, offset, size, checksum):
+        """
+        the record is made durable, because a slice may be skipped on resume once it is there.
+        """
+        if self.journal_file is None:
+            self.load()
+        self.checksums[(offset, size)] = checksum
+        self.journal_file.write("{0} {1} {2}\n".format(offset, size, checksum))
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+    def get(self, offset, size):
+        if self.journal_file is None:
+            self.load()
+        return self.checksums.get((offset, size))
+
+    def get_slices(self):
+        if self.journal_file is None:
+            self.load()
+        return sorted(self.checksums.keys())
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+
+    def clear(self):
+        self.close()
+        self.checksums = {}
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
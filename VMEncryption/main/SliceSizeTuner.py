@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os.path
+
+
+class SliceSizeTuner(object):
+    """
+    Picks the slice size of a data copy from the throughput measured over the first slices.
+    The size is doubled while that makes the copy faster, and halved if growing did not help,
+    always between min_block_size and a memory budget taken from /proc/meminfo.
+    Sizes only change by factors of two so the copied range stays a multiple of the new size.
+    """
+    min_block_size = 4 * 1024 * 1024
+    max_block_size = 512 * 1024 * 1024
+    samples_per_size = 3
+    min_improvement = 1.05
+    # share of MemAvailable the slice buffers may use
+    memory_budget_ratio = 0.25
+
+    def __init__(self, logger, block_size, buffer_count, meminfo_path='/proc/meminfo'):
+        self.logger = logger
+        self.meminfo_path = meminfo_path
+        self.max_block_size = self.get_max_block_size(buffer_count)
+        self.block_size = self.fit_block_size(block_size)
+        self.initial_block_size = self.block_size
+        self.best_block_size = None
+        self.best_throughput = None
+        self.growing = True
+        self.done = False
+        self.samples = []
+
+    def get_mem_available(self):
+        """
+        returns MemAvailable from /proc/meminfo in bytes, MemFree on kernels without MemAvailable, or None.
+        """
+        if not os.path.exists(self.meminfo_path):
+            return None
+        meminfo = {}
+        with open(self.meminfo_path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[1].isdigit():
+                    meminfo[fields[0].rstrip(':')] = int(fields[1]) * 1024
+        return meminfo.get('MemAvailable', meminfo.get('MemFree'))
+
+    def get_max_block_size(self, buffer_count):
+        max_block_size = SliceSizeTuner.max_block_size
+        mem_available = self.get_mem_available()
+        if mem_available is not None:
+            max_block_size = min(max_block_size, int(mem_available * SliceSizeTuner.memory_budget_ratio) // max(buffer_count, 1))
+        self.logger.log("slice size tuner: memory available {0}, max slice size {1}".format(mem_available, max_block_size))
+        return max_block_size
+
+    def fit_block_size(self, block_size):
+        while block_size > self.max_block_size and block_size % 2 == 0 and block_size // 2 >= SliceSizeTuner.min_block_size:
+            block_size //= 2
+        return block_size
+
+    def get_block_size(self):
+        return self.block_size
+
+    def record_slice(self, block_size, slice_bytes, elapsed_seconds):
+        """
+        records the throughput of one copied slice and returns the slice size to use from now on.
+        slices copied with another size than the proposed one are ignored, e.g. while the switch is pending.
+        """
+        if self.done or block_size != self.block_size or elapsed_seconds <= 0:
+            return self.block_size
+
+        self.samples.append((slice_bytes, elapsed_seconds))
+        if len(self.samples) < SliceSizeTuner.samples_per_size:
+            return self.block_size
+
+        throughput = sum(s[0] for s in self.samples) / sum(s[1] for s in self.samples)
+        self.samples = []
+        self.logger.log("slice size tuner: {0} bytes per slice gives {1:.1f} MB/s".format(self.block_size, throughput / (1024.0 * 1024.0)))
+
+        if self.best_throughput is None or throughput > self.best_throughput * SliceSizeTuner.min_improvement:
+            self.best_block_size = self.block_size
+            self.best_throughput = throughput
+        elif self.growing and self.best_block_size == self.initial_block_size and self.best_block_size % 2 == 0 \
+                and self.best_block_size // 2 >= SliceSizeTuner.min_block_size:
+            # growing did not help, try smaller slices instead
+            self.growing = False
+            self.block_size = self.best_block_size // 2
+            return self.block_size
+        else:
+            return self.finish(self.best_block_size)
+
+        if self.growing and self.block_size * 2 <= self.max_block_size:
+            self.block_size *= 2
+        elif not self.growing and self.block_size % 2 == 0 and self.block_size // 2 >= SliceSizeTuner.min_block_size:
+            self.block_size //= 2
+        else:
+            return self.finish(self.block_size)
+        return self.block_size
+
+    def finish(self, block_size):
+        self.done = True
+        self.block_size = block_size
+        self.logger.log("slice size tuner: settled on {0} bytes per slice".format(block_size))
+        return block_size
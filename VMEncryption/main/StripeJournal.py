@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import os.path
+import threading
+from Common import CommonVariables
+
+
+class StripeJournal(object):
+    """
+    Keeps the progress of a copy split into stripes that are copied concurrently, next to the ongoing item config.
+    The first header_size bytes describe the copy and its stripes, then one journal record per stripe says how far down
+    the stripe is copied. Each record fits in one sector, so it is replaced in a single write.
+    Every stripe but the lowest starts with a guard, the shift bytes the stripe below overwrites when it writes its top.
+    The guards are saved to the guard file before any stripe is written and read from there afterwards.
+    """
+    header_size = 4096
+
+    def __init__(self, logger, file_path, guard_file_path, source, destination):
+        self.logger = logger
+        self.file_path = file_path
+        self.guard_file_path = guard_file_path
+        self.source = source
+        self.destination = destination
+        self.shift = None
+        self.stripes = []
+        self.copied_offsets = []
+        self.journal_fd = None
+        self.lock = threading.Lock()
+
+    def get_header(self, total_size):
+        return {'source': self.source,
+                'destination': self.destination,
+                'total_size': total_size,
+                'shift': self.shift,
+                'stripes': [list(stripe) for stripe in self.stripes]}
+
+    def get_record_offset(self, stripe_index):
+        return StripeJournal.header_size + stripe_index * CommonVariables.journal_record_size
+
+    def load(self, total_size):
+        """
+        returns True when there is a journal of this copy, with the guards of its stripes saved.
+        """
+        if not os.path.exists(self.file_path):
+            return False
+        with open(self.file_path, 'rb') as f:
+            content = f.read()
+        try:
+            header = json.loads(content[:StripeJournal.header_size].decode('utf-8').strip())
+            self.shift = header['shift']
+            self.stripes = [tuple(stripe) for stripe in header['stripes']]
+            self.copied_offsets = []
+            for stripe_index in range(len(self.stripes)):
+                record_offset = self.get_record_offset(stripe_index)
+                record = content[record_offset:record_offset + CommonVariables.journal_record_size]
+                self.copied_offsets.append(int(json.loads(record.decode('utf-8').strip())['copied_offset']))
+        except (ValueError, KeyError, TypeError) as e:
+            self.logger.log(msg="ignoring the unreadable stripe journal: {0}".format(e), level=CommonVariables.WarningLevel)
+            return False
+        if header != self.get_header(total_size):
+            self.logger.log(msg="ignoring the stripe journal of {0}".format(header), level=CommonVariables.WarningLevel)
+            return False
+        if not os.path.exists(self.guard_file_path) or os.path.getsize(self.guard_file_path) < (len(self.stripes) - 1) * self.shift:
+            self.logger.log(msg="the stripe guards in {0} are missing".format(self.guard_file_path), level=CommonVariables.ErrorLevel)
+            return False
+        self.journal_fd = os.open(self.file_path, os.O_WRONLY)
+        self.logger.log("loaded the stripe journal, {0} stripes copied down to {1}".format(len(self.stripes), self.copied_offsets))
+        return True
+
+    def create(self, total_size, shift, stripes, read_source, buffer_view):
+        """
+        saves the guards, read with read_source(buffer_view, offset) through buffer_view, and then starts the journal.
+        until the journal is there, nothing is written to the destination, so a copy interrupted before starts over.
+        """
+        self.shift = shift
+        self.stripes = [tuple(stripe) for stripe in stripes]
+        self.copied_offsets = [end for _, end in self.stripes]
+        guard_fd = os.open(self.guard_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            for stripe_index, (start, _) in enumerate(self.stripes[1:]):
+                guard_offset = 0
+                while guard_offset < shift:
+                    chunk_view = buffer_view[:min(len(buffer_view), shift - guard_offset)]
+                    if read_source(chunk_view, start + guard_offset) != len(chunk_view):
+                        raise IOError("short read of the guard at offset {0}".format(start + guard_offset))
+                    os.lseek(guard_fd, stripe_index * shift + guard_offset, os.SEEK_SET)
+                    written = 0
+                    while written < len(chunk_view):
+                        written += os.write(guard_fd, chunk_view[written:])
+                    guard_offset += len(chunk_view)
+            os.fsync(guard_fd)
+        finally:
+            os.close(guard_fd)
+
+        content = json.dumps(self.get_header(total_size)).encode('utf-8').ljust(StripeJournal.header_size)
+        for copied_offset in self.copied_offsets:
+            content += json.dumps({'copied_offset': copied_offset}).encode('utf-8').ljust(CommonVariables.journal_record_size)
+        self.journal_fd = os.open(self.file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.write(self.journal_fd, content)
+        os.fsync(self.journal_fd)
+        directory_fd = os.open(os.path.dirname(self.file_path), os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+        self.logger.log("saved {0} stripe guards of {1} bytes, copying the stripes {2}".format(len(self.stripes) - 1, shift, self.stripes))
+
+    def read_guard(self, stripe_index, offset, buffer_view):
+        """
+        reads the guard of the stripe from offset on, relative to the start of the stripe, into buffer_view.
+        """
+        with open(self.guard_file_path, 'rb') as f:
+            f.seek((stripe_index - 1) * self.shift + offset)
+            data = f.read(len(buffer_view))
+        if len(data) != len(buffer_view):
+            raise IOError("short read of the guard of stripe {0}".format(stripe_index))
+        buffer_view[:] = data
+
+    def get_guard_end(self, stripe_index):
+        return self.stripes[stripe_index][0] + self.shift if stripe_index > 0 else self.stripes[0][0]
+
+    def update(self, stripe_index, copied_offset):
+        """
+        the caller makes the destination durable first, the stripes update their own records concurrently.
+        """
+        with self.lock:
+            if self.copied_offsets[stripe_index] == copied_offset:
+                return
+            record = json.dumps({'copied_offset': copied_offset}).encode('utf-8')
+            os.pwrite(self.journal_fd, record.ljust(CommonVariables.journal_record_size), self.get_record_offset(stripe_index))
+            os.fsync(self.journal_fd)
+            self.copied_offsets[stripe_index] = copied_offset
+
+    def close(self):
+        if self.journal_fd is not None:
+            os.close(self.journal_fd)
+            self.journal_fd = None
+
+    def clear(self):
+        self.close()
+        for file_path in [self.file_path, self.guard_file_path]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
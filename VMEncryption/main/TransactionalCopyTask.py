@@ -17,15 +17,40 @@
 # limitations under the License.
 
 import subprocess
+import json
 import os
 import os.path
 import sys
 import shlex
+import mmap
+import time
+import datetime
+import threading
+import random
+import stat
+import struct
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import queue # python3+
+except ImportError:
+    import Queue as queue # python2
 from subprocess import *
 from CommandExecutor import CommandExecutor
 from Common import CommonVariables
+from DeviceTopologyCache import DeviceTopologyCache
 from ConfigUtil import ConfigUtil
 from OnGoingItemConfig import *
+from SliceSizeTuner import SliceSizeTuner
+from FreeSpaceMap import FreeSpaceMap
+from SliceChecksumJournal import SliceChecksumJournal
+from CopyRateLimiter import CopyRateLimiter
+from DirtyPageWriteback import DirtyPageWriteback
+from IOLoadThrottle import IOLoadThrottle
+from CopyProgress import CopyProgress
+from StripeJournal import StripeJournal
 
 
 class TransactionalCopyTask(object):
@@ -33,7 +58,7 @@ class TransactionalCopyTask(object):
     copy_total_size is in byte, skip_target_size is also in byte
     slice_size is in byte 50M
     """
-    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix=''):
+    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix='', public_settings=None):
         """
         copy_total_size is in bytes.
         """
@@ -48,7 +73,7 @@ class TransactionalCopyTask(object):
 
         self.last_slice_size = self.total_size % self.block_size
         # we add 1 even the last_slice_size is zero.
-        self.total_slice_size = ((self.total_size - self.last_slice_size) / self.block_size) + 1
+        self.total_slice_size = ((self.total_size - self.last_slice_size) // self.block_size) + 1
 
         self.status_prefix = status_prefix
         self.encryption_environment = encryption_environment
@@ -56,39 +81,1055 @@ class TransactionalCopyTask(object):
         self.patching = patching
         self.disk_util = disk_util
         self.hutil = hutil
-        self.tmpfs_mount_point = "/mnt/azure_encrypt_tmpfs"
-        self.slice_file_path = self.tmpfs_mount_point + "/slice_file"
         self.copy_command = self.patching.dd_path
+        self.copy_engine = self.get_copy_engine(public_settings)
+        self.io_mode = self.get_io_mode(public_settings)
+        self.direct_io_alignment = mmap.PAGESIZE
+        self.direct_io_unsupported_paths = set()
+        self.read_ahead_enabled = self.get_read_ahead_enabled(public_settings)
+        self.cache_neutral = self.get_cache_neutral_enabled(public_settings)
+        self.vectored_io_enabled = self.get_vectored_io_enabled(public_settings)
+        self.uncached_ranges = []
+        self.slice_size_tuner = self.get_slice_size_tuner(public_settings)
+        self.slice_buffers = [None, None]
+        self.current_buffer_index = 0
+        self.read_ahead = None
+        self.next_read_ahead_range = None
+        self.opened_fds = {}
+        self.fd_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.throttle_lock = threading.Lock()
+        self.copied_bytes = 0
+        self.skipped_bytes = 0
+        self.zeroed_bytes = 0
+        self.zero_detect_enabled = self.get_zero_detect_enabled(public_settings)
+        self.zero_buffer = None
+        self.zero_out_unsupported_paths = set()
+        self.used_ranges = self.get_used_ranges()
+        self.overlap_window = self.get_overlap_window()
+        self.journal_offset = None
+        self.checksum_journal = None
+        if self.copy_engine == CommonVariables.CopyEngineNative:
+            self.checksum_journal = SliceChecksumJournal(self.logger, self.encryption_environment.copy_slice_checksum_file,
+                                                         self.source_dev_full_path, self.destination)
+        self.verify_sample_count = self.get_verify_sample_count(public_settings)
+        self.checkpoint_interval_slices, self.checkpoint_interval_seconds = self.get_checkpoint_intervals(public_settings)
+        self.rate_limiter = self.get_rate_limiter(public_settings)
+        self.dirty_writeback = self.get_dirty_writeback(public_settings)
+        self.io_throttle = IOLoadThrottle.create(self.logger, public_settings, [self.source_dev_full_path, self.destination])
+        self.progress = CopyProgress(self.total_size)
+        self.stripe_workers = self.get_stripe_workers(public_settings)
+        self.stripe_journal = None
+        self.stripe_progress = None
+
+    def get_copy_engine(self, public_settings):
+        """
+        the native engine copies with os.pread/os.pwrite through one reusable buffer,
+        dd is kept as a fallback for python versions without os.pread.
+        """
+        copy_engine = CommonVariables.CopyEngineNative
+        if public_settings and public_settings.get(CommonVariables.CopyEngineKey):
+            copy_engine = str(public_settings.get(CommonVariables.CopyEngineKey)).lower()
+
+        if copy_engine not in CommonVariables.SupportedCopyEngines:
+            self.logger.log(msg="unsupported copy engine {0}, using {1}".format(copy_engine, CommonVariables.CopyEngineNative),
+                            level=CommonVariables.WarningLevel)
+            copy_engine = CommonVariables.CopyEngineNative
+
+        if copy_engine == CommonVariables.CopyEngineNative and not hasattr(os, 'pread'):
+            self.logger.log(msg="os.pread is not available, falling back to the dd copy engine",
+                            level=CommonVariables.WarningLevel)
+            copy_engine = CommonVariables.CopyEngineDd
+
+        self.logger.log("copy engine is: {0}".format(copy_engine))
+        return copy_engine
+
+    def get_io_mode(self, public_settings):
+        """
+        direct I/O bypasses the page cache, it needs the native engine and os.preadv to read into the aligned buffer.
+        """
+        io_mode = CommonVariables.CopyIOModeBuffered
+        if public_settings and public_settings.get(CommonVariables.CopyIOModeKey):
+            io_mode = str(public_settings.get(CommonVariables.CopyIOModeKey)).lower()
+
+        if io_mode not in CommonVariables.SupportedCopyIOModes:
+            self.logger.log(msg="unsupported copy I/O mode {0}, using {1}".format(io_mode, CommonVariables.CopyIOModeBuffered),
+                            level=CommonVariables.WarningLevel)
+            io_mode = CommonVariables.CopyIOModeBuffered
+
+        if io_mode == CommonVariables.CopyIOModeDirect:
+            if self.copy_engine != CommonVariables.CopyEngineNative or not hasattr(os, 'O_DIRECT') or not hasattr(os, 'preadv'):
+                self.logger.log(msg="direct I/O is not available with the {0} copy engine, using buffered I/O".format(self.copy_engine),
+                                level=CommonVariables.WarningLevel)
+                io_mode = CommonVariables.CopyIOModeBuffered
+
+        self.logger.log("copy I/O mode is: {0}".format(io_mode))
+        return io_mode
+
+    def get_read_ahead_enabled(self, public_settings):
+        """
+        with read ahead the next slice is read into a second buffer while the current one is written.
+        the backup, write and commit of each slice stay in order, only the read of the next slice overlaps them.
+        """
+        read_ahead_enabled = True
+        if public_settings and public_settings.get(CommonVariables.CopyReadAheadKey) is not None:
+            read_ahead_enabled = str(public_settings.get(CommonVariables.CopyReadAheadKey)).lower() == 'true'
+
+        if read_ahead_enabled and self.copy_engine != CommonVariables.CopyEngineNative:
+            read_ahead_enabled = False
+
+        if read_ahead_enabled and self.ongoing_item_config.get_phase() == CommonVariables.DecryptionPhaseCopyData:
+            # with the header on the device the mapper starts luks header size bytes into the raw device,
+            # so mapper offset x is read from raw offset x + header and written back to raw offset x.
+            # copied from the end, the write of the slice at x covers raw [x, x + slice), and its first header bytes
+            # are the encrypted tail of the next slice, mapper [x - slice, x) on raw [x - slice + header, x + header).
+            # a read ahead of the next slice would race that write, so decryption reads each slice after the last write.
+            read_ahead_enabled = False
+
+        self.logger.log("copy read ahead enabled: {0}".format(read_ahead_enabled))
+        return read_ahead_enabled
+
+    def get_cache_neutral_enabled(self, public_settings):
+        """
+        a cache neutral copy drops the pages of the source once they are read and the pages of the destination once
+        they are written back, so that the copy does not push the data of the applications out of the page cache.
+        """
+        cache_neutral = True
+        if public_settings and public_settings.get(CommonVariables.CopyCacheNeutralKey) is not None:
+            cache_neutral = str(public_settings.get(CommonVariables.CopyCacheNeutralKey)).lower() == 'true'
+
+        if cache_neutral and (self.copy_engine != CommonVariables.CopyEngineNative or not hasattr(os, 'posix_fadvise')):
+            cache_neutral = False
+
+        self.logger.log("copy cache neutral: {0}".format(cache_neutral))
+        return cache_neutral
+
+    def get_vectored_io_enabled(self, public_settings):
+        """
+        the tail of the device and the resumed slice are copied with preadv into the slice buffer and written in one request,
+        the dd engine copies them in 512 byte blocks otherwise.
+        """
+        vectored_io_enabled = True
+        if public_settings and public_settings.get(CommonVariables.CopyVectoredIOKey) is not None:
+            vectored_io_enabled = str(public_settings.get(CommonVariables.CopyVectoredIOKey)).lower() == 'true'
+
+        if vectored_io_enabled and not hasattr(os, 'preadv'):
+            vectored_io_enabled = False
+
+        self.logger.log("copy vectored I/O enabled: {0}".format(vectored_io_enabled))
+        return vectored_io_enabled
+
+    def advise_source(self, fd):
+        """
+        the kernel reads ahead upwards, which a copy from the end has just read and dropped, so it is told not to.
+        the slices are read whole and the next one is read ahead by the copy itself.
+        """
+        if self.from_end.lower() == 'true':
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+        else:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def drop_cache(self, path, offset, length):
+        """
+        only clean pages are dropped, dirty ones stay until they are written back.
+        """
+        if self.cache_neutral and length > 0:
+            try:
+                os.posix_fadvise(self.get_fd(path, os.O_RDONLY), offset, length, os.POSIX_FADV_DONTNEED)
+            except OSError as e:
+                self.logger.log(msg="failed to drop the cached pages of {0}: {1}".format(path, e),
+                                level=CommonVariables.WarningLevel)
+
+    def get_slice_size_tuner(self, public_settings):
+        """
+        the slice size is tuned on long native copies only, dd copies with the slice size it was started with.
+        """
+        autotune_enabled = True
+        if public_settings and public_settings.get(CommonVariables.CopySliceSizeAutotuneKey) is not None:
+            autotune_enabled = str(public_settings.get(CommonVariables.CopySliceSizeAutotuneKey)).lower() == 'true'
+
+        if not autotune_enabled or self.copy_engine != CommonVariables.CopyEngineNative \
+                or self.total_slice_size - self.current_slice_index < CommonVariables.autotune_min_slice_count:
+            return None
+        return SliceSizeTuner(self.logger, self.block_size, 2 if self.read_ahead_enabled else 1)
+
+    def get_zero_detect_enabled(self, public_settings):
+        """
+        zero chunks of a slice are zeroed on the destination instead of written, and left as holes in the backup file.
+        """
+        zero_detect_enabled = True
+        if public_settings and public_settings.get(CommonVariables.CopyZeroDetectKey) is not None:
+            zero_detect_enabled = str(public_settings.get(CommonVariables.CopyZeroDetectKey)).lower() == 'true'
+        zero_detect_enabled = zero_detect_enabled and self.copy_engine == CommonVariables.CopyEngineNative
+        self.logger.log("copy zero detection enabled: {0}".format(zero_detect_enabled))
+        return zero_detect_enabled
+
+    def get_zero_ranges(self, buffer_view):
+        """
+        returns the (start, end) ranges of buffer_view made of all-zero chunks of zero_chunk_size bytes.
+        """
+        if not self.zero_detect_enabled:
+            return []
+        if self.zero_buffer is None:
+            # never written, so it reads as zeros. it is page aligned for direct I/O writes of zeros.
+            self.zero_buffer = mmap.mmap(-1, CommonVariables.zero_chunk_size)
+        zero_chunk = self.zero_buffer[:CommonVariables.zero_chunk_size]
+
+        zero_ranges = []
+        for start in range(0, len(buffer_view), CommonVariables.zero_chunk_size):
+            end = min(start + CommonVariables.zero_chunk_size, len(buffer_view))
+            if not self.is_zero_chunk(zero_chunk, buffer_view[start:end]):
+                continue
+            if zero_ranges and zero_ranges[-1][1] == start:
+                zero_ranges[-1] = (zero_ranges[-1][0], end)
+            else:
+                zero_ranges.append((start, end))
+        return zero_ranges
+
+    @staticmethod
+    def is_zero_chunk(zero_chunk, chunk_view):
+        """
+        startswith compares the chunk in the slice buffer without copying it out, python 2 only takes strings there.
+        """
+        try:
+            return zero_chunk.startswith(chunk_view)
+        except TypeError:
+            return chunk_view.tobytes() == zero_chunk[:len(chunk_view)]
+
+    def zero_device(self, path, offset, length):
+        """
+        BLKZEROOUT lets the kernel write the zeros, through dm-crypt for a mapper, or offloads them for a raw disk.
+        regular files and devices without the ioctl get zeros written from the zero buffer.
+        """
+        fd = self.get_fd(path, os.O_WRONLY | os.O_CREAT)
+        if fcntl is not None and path not in self.zero_out_unsupported_paths \
+                and offset % CommonVariables.sector_size == 0 and length % CommonVariables.sector_size == 0 \
+                and stat.S_ISBLK(os.fstat(fd).st_mode):
+            try:
+                fcntl.ioctl(fd, CommonVariables.BLKZEROOUT, struct.pack('QQ', offset, length))
+                return length
+            except (IOError, OSError) as e:
+                self.logger.log(msg="BLKZEROOUT is not supported on {0}, writing zeros: {1}".format(path, e),
+                                level=CommonVariables.WarningLevel)
+                self.zero_out_unsupported_paths.add(path)
+
+        total_written = 0
+        while total_written < length:
+            chunk_size = min(length - total_written, len(self.zero_buffer))
+            total_written += self.write_device(path, memoryview(self.zero_buffer)[:chunk_size], offset + total_written)
+        return total_written
+
+    def write_slice(self, path, buffer_view, offset, zero_ranges):
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(len(buffer_view))
+        position = 0
+        for zero_start, zero_end in zero_ranges:
+            if zero_start > position:
+                self.write_device(path, buffer_view[position:zero_start], offset + position)
+            zeroed_size = self.zero_device(path, offset + zero_start, zero_end - zero_start)
+            with self.stats_lock:
+                self.zeroed_bytes += zeroed_size
+            position = zero_end
+        if position < len(buffer_view):
+            self.write_device(path, buffer_view[position:], offset + position)
+        # what blkid reads from the written device changes, like after the commands of a CommandExecutor
+        DeviceTopologyCache.invalidate_all()
+        if self.cache_neutral:
+            with self.stats_lock:
+                self.uncached_ranges.append((path, offset, len(buffer_view)))
+
+    def get_percent(self):
+        if self.stripe_progress is not None:
+            return int(self.get_processed_bytes() / float(self.total_size) * 100.0)
+        return int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)
+
+    def get_processed_bytes(self):
+        """
+        returns how far the copy is through the device, skipped free space included.
+        """
+        if self.stripe_progress is not None:
+            return sum(end - copied_offset for (_, end), copied_offset in zip(self.stripe_journal.stripes, self.stripe_progress))
+        copied_offset = self.get_copied_offset(self.current_slice_index)
+        if self.from_end.lower() == 'true':
+            return self.total_size - copied_offset
+        else:
+            return copied_offset
+
+    def add_progress_sample(self):
+        self.progress.add_sample(self.get_processed_bytes(), self.copied_bytes)
+
+    def get_status_message(self):
+        msg = self.status_prefix + ': ' + str(self.get_percent()) + '%'
+        details = ["{0} MB copied".format(self.copied_bytes // (1024 * 1024))]
+        if self.zeroed_bytes > 0:
+            details.append("{0} MB zeroed without copying".format(self.zeroed_bytes // (1024 * 1024)))
+        if self.skipped_bytes > 0:
+            details.append("{0} MB of free space skipped".format(self.skipped_bytes // (1024 * 1024)))
+        copy_rate = self.progress.get_copy_rate()
+        if copy_rate is not None:
+            details.append("{0:.1f} MB/s".format(copy_rate / (1024 * 1024)))
+        eta_seconds = self.progress.get_eta_seconds()
+        if eta_seconds is not None:
+            details.append("about {0} left".format(datetime.timedelta(seconds=int(eta_seconds))))
+        if self.rate_limiter is not None:
+            details.append("disk I/O at {0:.1f} MB/s of {1:g} MB/s allowed".format(self.rate_limiter.get_achieved_rate() / (1024 * 1024),
+                                                                                   self.rate_limiter.rate / (1024 * 1024)))
+        msg += " (" + ", ".join(details) + ")"
+        return msg
+
+    def write_progress_file(self, state):
+        """
+        the numbers of the status message for tools, replaced atomically so a reader never sees half a file.
+        """
+        copy_rate = self.progress.get_copy_rate()
+        progress = {'operation': self.status_prefix,
+                    'state': state,
+                    'source': self.source_dev_full_path,
+                    'destination': self.destination,
+                    'percent': self.get_percent(),
+                    'total_bytes': self.total_size,
+                    'processed_bytes': self.get_processed_bytes(),
+                    'copied_bytes': self.copied_bytes,
+                    'zeroed_bytes': self.zeroed_bytes,
+                    'skipped_bytes': self.skipped_bytes,
+                    'mb_per_second': None if copy_rate is None else round(copy_rate / (1024 * 1024), 1),
+                    'eta_seconds': self.progress.get_eta_seconds(),
+                    'updated': int(time.time())}
+        progress_file_path = self.encryption_environment.copy_progress_file_path
+        try:
+            with open(progress_file_path + '.tmp', 'w') as f:
+                json.dump(progress, f)
+            os.rename(progress_file_path + '.tmp', progress_file_path)
+        except (IOError, OSError) as e:
+            self.logger.log(msg="failed to write {0}: {1}".format(progress_file_path, e), level=CommonVariables.WarningLevel)
+
+    def get_rate_limiter(self, public_settings):
+        """
+        CopyMaxMBPerSecond caps the reads and writes of the copy together, as the disk throughput cap of the VM counts both.
+        CopyBurstMB is how far the copy may run ahead of that rate, one second of it by default.
+        """
+        if not public_settings or public_settings.get(CommonVariables.CopyMaxMBPerSecondKey) is None:
+            return None
+        try:
+            max_mb_per_second = float(public_settings.get(CommonVariables.CopyMaxMBPerSecondKey))
+            burst_mb = max_mb_per_second
+            if public_settings.get(CommonVariables.CopyBurstMBKey) is not None:
+                burst_mb = float(public_settings.get(CommonVariables.CopyBurstMBKey))
+        except ValueError:
+            self.logger.log(msg="invalid {0} or {1}, the copy is not rate limited".format(CommonVariables.CopyMaxMBPerSecondKey,
+                                                                                        CommonVariables.CopyBurstMBKey),
+                            level=CommonVariables.WarningLevel)
+            return None
+        if max_mb_per_second <= 0:
+            return None
+        return CopyRateLimiter(self.logger, max_mb_per_second * 1024 * 1024, max(burst_mb, 0) * 1024 * 1024)
+
+    def get_dirty_writeback(self, public_settings):
+        """
+        CopyDirtyLimitMB caps the data written to the destination that is not written back yet, 0 leaves it to the kernel.
+        """
+        dirty_limit_mb = CommonVariables.copy_dirty_limit_mb
+        if public_settings and public_settings.get(CommonVariables.CopyDirtyLimitMBKey) is not None:
+            try:
+                dirty_limit_mb = int(public_settings.get(CommonVariables.CopyDirtyLimitMBKey))
+            except ValueError:
+                self.logger.log(msg="invalid {0}, using {1}".format(CommonVariables.CopyDirtyLimitMBKey, dirty_limit_mb),
+                                level=CommonVariables.WarningLevel)
+        if dirty_limit_mb <= 0:
+            return None
+        return DirtyPageWriteback(self.logger, dirty_limit_mb * 1024 * 1024)
+
+    def get_verify_sample_count(self, public_settings):
+        verify_sample_count = CommonVariables.copy_verify_sample_count
+        if public_settings and public_settings.get(CommonVariables.CopyVerifySampleCountKey) is not None:
+            try:
+                verify_sample_count = max(int(public_settings.get(CommonVariables.CopyVerifySampleCountKey)), 0)
+            except ValueError:
+                self.logger.log(msg="invalid {0}, using {1}".format(CommonVariables.CopyVerifySampleCountKey, verify_sample_count),
+                                level=CommonVariables.WarningLevel)
+        return verify_sample_count
+
+    def get_checkpoint_intervals(self, public_settings):
+        """
+        returns how many slices and how many seconds may pass before the slice index is committed again.
+        the native copy journals its progress before each slice, so the commit may lag behind,
+        the dd copy has no journal and commits after every slice.
+        """
+        if self.copy_engine != CommonVariables.CopyEngineNative:
+            return 1, 0
+        intervals = []
+        for key, default_interval in [(CommonVariables.CopyCheckpointIntervalSlicesKey, CommonVariables.copy_checkpoint_interval_slices),
+                                      (CommonVariables.CopyCheckpointIntervalSecondsKey, CommonVariables.copy_checkpoint_interval_seconds)]:
+            interval = default_interval
+            if public_settings and public_settings.get(key) is not None:
+                try:
+                    interval = max(int(public_settings.get(key)), 0)
+                except ValueError:
+                    self.logger.log(msg="invalid {0}, using {1}".format(key, default_interval),
+                                    level=CommonVariables.WarningLevel)
+            intervals.append(interval)
+        return max(intervals[0], 1), intervals[1]
+
+    def is_checkpoint_due(self, uncommitted_slices, last_checkpoint_time):
+        if uncommitted_slices >= self.checkpoint_interval_slices:
+            return True
+        return self.checkpoint_interval_seconds > 0 and time.time() - last_checkpoint_time >= self.checkpoint_interval_seconds
+
+    def checkpoint(self):
+        """
+        commits the slice index, after the destination it covers is made durable.
+        """
+        if self.copy_engine != CommonVariables.CopyEngineNative:
+            # dd has written the slices, a descriptor of our own syncs the same device
+            self.get_fd(self.destination, os.O_WRONLY | os.O_CREAT)
+        self.sync_device(self.destination)
+        if self.status_prefix:
+            self.hutil.do_status_report(operation='DataCopy',
+                                        status=CommonVariables.extension_success_status,
+                                        status_code=str(CommonVariables.success),
+                                        message=self.get_status_message())
+        self.write_progress_file('copying')
+        self.ongoing_item_config.current_slice_index = self.current_slice_index
+        self.ongoing_item_config.commit()
+
+    def record_checksum(self, offset, buffer_view):
+        if self.checksum_journal is not None:
+            checksum = SliceChecksumJournal.checksum(buffer_view)
+            with self.stats_lock:
+                self.checksum_journal.add(offset, len(buffer_view), checksum)
+
+    def destination_matches(self, offset, size, checksum):
+        """
+        reads the slice back from the destination, into the buffer the current slice is not in.
+        """
+        if checksum is None or size <= 0:
+            return False
+        buffer_view = self.get_slice_buffer(size, 1 - self.current_buffer_index)
+        try:
+            read_size = self.read_device(self.destination, buffer_view, offset)
+        except (IOError, OSError) as e:
+            self.logger.log(msg="failed to read back {0} bytes at offset {1} of {2}: {3}".format(size, offset, self.destination, e),
+                            level=CommonVariables.WarningLevel)
+            return False
+        return read_size == size and SliceChecksumJournal.checksum(buffer_view) == checksum
+
+    def skip_verified_slices(self):
+        """
+        slices after the committed slice index that are already on the destination, e.g. when the commit was lost, are not copied again.
+        """
+        if self.checksum_journal is None:
+            return
+        committed_slice_index = self.current_slice_index
+        while self.current_slice_index < self.total_slice_size and self.is_slice_used(self.current_slice_index):
+            slice_offset, slice_end = self.get_slice_range(self.current_slice_index)
+            if slice_end > slice_offset and not self.destination_matches(slice_offset, slice_end - slice_offset,
+                                                                         self.checksum_journal.get(slice_offset, slice_end - slice_offset)):
+                break
+            self.logger.log(msg="slice index {0} is already on the destination, skipping it".format(self.current_slice_index),
+                            level=CommonVariables.WarningLevel)
+            self.current_slice_index += 1
+        if self.current_slice_index != committed_slice_index:
+            self.ongoing_item_config.current_slice_index = self.current_slice_index
+            self.ongoing_item_config.commit()
+
+    def verify_sample(self, sample_count):
+        """
+        reads back sample_count random slices of this copy and returns the offsets of the ones that do not match their checksum.
+        """
+        self.wait_read_ahead()
+        slices = self.checksum_journal.get_slices()
+        mismatches = []
+        for offset, size in random.sample(slices, min(sample_count, len(slices))):
+            if not self.destination_matches(offset, size, self.checksum_journal.get(offset, size)):
+                mismatches.append(offset)
+        self.logger.log("verified {0} of {1} slices, {2} did not match".format(min(sample_count, len(slices)), len(slices), len(mismatches)))
+        return mismatches
+
+    def get_used_ranges(self):
+        """
+        the free space map is saved before luksFormat overwrites the file system metadata at the start of the device.
+        only the data copy of the encryption uses it, the destination keeps whatever the free space held.
+        """
+        if self.ongoing_item_config.get_phase() != CommonVariables.EncryptionPhaseCopyData:
+            return None
+        try:
+            used_ranges = FreeSpaceMap.load(self.encryption_environment.copy_used_ranges_file_path, self.source_dev_full_path)
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.log(msg="failed to load the free space map, copying the whole device: {0}".format(e),
+                            level=CommonVariables.WarningLevel)
+            return None
+        self.logger.log("copy only the used ranges of the file system: {0}".format(used_ranges is not None))
+        return used_ranges
+
+    def get_overlap_window(self):
+        """
+        the in-place encryption writes each byte luks header size bytes above where it was read.
+        written in chunks no larger than that shift, from the end down, a chunk never overwrites its own source,
+        only the source of the chunk above it, which is already on the destination.
+        so instead of a backup of each slice a journal records how far down the copy is, and is made durable,
+        together with the chunk above, before the next chunk is written.
+        returns the shift, or None to keep the slice backups.
+        """
+        if self.copy_engine != CommonVariables.CopyEngineNative \
+                or self.ongoing_item_config.get_phase() != CommonVariables.EncryptionPhaseCopyData \
+                or self.from_end.lower() != 'true' \
+                or self.ongoing_item_config.get_header_file_path() not in [None, '', 'None']:
+            return None
+        try:
+            overlap_window = self.disk_util.get_luks_header_size(self.source_dev_full_path)
+        except Exception as e:
+            self.logger.log(msg="failed to get the luks header size of {0}: {1}".format(self.source_dev_full_path, e),
+                            level=CommonVariables.WarningLevel)
+            overlap_window = None
+        if not isinstance(overlap_window, int) or overlap_window <= 0 or overlap_window % CommonVariables.sector_size != 0:
+            self.logger.log(msg="unknown data offset {0}, backing up every slice".format(overlap_window),
+                            level=CommonVariables.WarningLevel)
+            return None
+        self.logger.log("journaling the copy in chunks of {0} bytes instead of backing up every slice".format(overlap_window))
+        return overlap_window
+
+    def get_slice_range(self, slice_index):
+        slice_size = self.last_slice_size if self.is_last_slice(slice_index) else self.block_size
+        slice_offset = int(self.get_skip_block(slice_index) * self.block_size)
+        return (slice_offset, slice_offset + int(slice_size))
+
+    def get_copied_offset(self, slice_index):
+        """
+        returns the journal offset of the range copied by the slices before slice_index,
+        the copy from the end has copied everything from there up, the copy from the start everything below it.
+        """
+        if self.from_end.lower() == 'true':
+            return self.total_size if slice_index == 0 else self.get_slice_range(slice_index - 1)[0]
+        else:
+            return 0 if slice_index == 0 else self.get_slice_range(slice_index - 1)[1]
+
+    def is_copied_beyond(self, copied_offset, other_offset):
+        if self.from_end.lower() == 'true':
+            return copied_offset < other_offset
+        else:
+            return copied_offset > other_offset
+
+    def read_journal(self):
+        """
+        returns the offset the journal says the copy has reached, see get_copied_offset.
+        """
+        if not os.path.exists(self.encryption_environment.copy_slice_item_journal_file):
+            return None
+        with open(self.encryption_environment.copy_slice_item_journal_file, 'rb') as f:
+            record = f.read(CommonVariables.journal_record_size)
+        try:
+            journal = json.loads(record.decode('utf-8').strip())
+        except ValueError as e:
+            self.logger.log(msg="ignoring the unreadable copy journal: {0}".format(e), level=CommonVariables.WarningLevel)
+            return None
+        if journal.get('source') != self.source_dev_full_path or journal.get('destination') != self.destination:
+            self.logger.log(msg="ignoring the copy journal of {0}".format(journal), level=CommonVariables.WarningLevel)
+            return None
+        return int(journal['copied_offset'])
+
+    def write_journal(self, copied_offset):
+        """
+        makes the destination durable, then records that the copy has reached copied_offset.
+        the record fits in one sector, so it is replaced in a single write.
+        """
+        if self.journal_offset == copied_offset:
+            return
+        self.sync_device(self.destination)
+        journal_file = self.encryption_environment.copy_slice_item_journal_file
+        journal_created = not os.path.exists(journal_file)
+        record = json.dumps({'source': self.source_dev_full_path,
+                             'destination': self.destination,
+                             'copied_offset': copied_offset}).encode('utf-8')
+        journal_fd = self.get_fd(journal_file, os.O_WRONLY | os.O_CREAT)
+        os.pwrite(journal_fd, record.ljust(CommonVariables.journal_record_size), 0)
+        os.fsync(journal_fd)
+        if journal_created:
+            directory_fd = os.open(os.path.dirname(journal_file), os.O_RDONLY)
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
+        self.journal_offset = copied_offset
+
+    def clear_journal(self):
+        journal_file = self.encryption_environment.copy_slice_item_journal_file
+        for key in [key for key in self.opened_fds if key[0] == journal_file]:
+            os.close(self.opened_fds.pop(key))
+        if os.path.exists(journal_file):
+            os.remove(journal_file)
+        self.journal_offset = None
+
+    def sync_device(self, path):
+        """
+        the ranges written before the sync are clean after it, so their pages can be dropped.
+        """
+        with self.stats_lock:
+            written_ranges = [written_range for written_range in self.uncached_ranges if written_range[0] == path]
+            self.uncached_ranges = [written_range for written_range in self.uncached_ranges if written_range[0] != path]
+        with self.fd_lock:
+            opened_fds = list(self.opened_fds.items())
+        for (fd_path, flags), fd in opened_fds:
+            if fd_path == path and flags & os.O_WRONLY:
+                os.fdatasync(fd)
+                if self.dirty_writeback is not None:
+                    self.dirty_writeback.synced(fd)
+        for written_path, offset, length in written_ranges:
+            self.drop_cache(written_path, offset, length)
+
+    def write_slice_journaled(self, path, buffer_view, offset, write_journal=None):
+        """
+        the slice is durable and journaled when this returns, so the slice index can be committed after it.
+        """
+        if write_journal is None:
+            write_journal = self.write_journal
+        chunk_end = len(buffer_view)
+        while chunk_end > 0:
+            chunk_start = max(0, chunk_end - self.overlap_window)
+            write_journal(offset + chunk_end)
+            chunk_view = buffer_view[chunk_start:chunk_end]
+            self.write_slice(path, chunk_view, offset + chunk_start, self.get_zero_ranges(chunk_view))
+            chunk_end = chunk_start
+        write_journal(offset)
+
+    def resume_journal(self):
+        """
+        moves the slice index up to where the journal says the copy is, when the committed slice index lags behind it,
+        and finishes the slice the journal stopped in during an overlapping copy.
+        """
+        copied_offset = self.read_journal()
+        if copied_offset is None or not self.is_copied_beyond(copied_offset, self.get_copied_offset(self.current_slice_index)):
+            return CommonVariables.process_success
+
+        slice_index = self.current_slice_index
+        while slice_index < self.total_slice_size and not self.is_copied_beyond(self.get_copied_offset(slice_index + 1), copied_offset):
+            slice_index += 1
+        stopped_in_slice = slice_index < self.total_slice_size and copied_offset != self.get_copied_offset(slice_index)
+        if stopped_in_slice and self.overlap_window is None:
+            self.logger.log(msg="the copy journal offset {0} is not on the slice grid, ignoring it".format(copied_offset),
+                            level=CommonVariables.WarningLevel)
+            return CommonVariables.process_success
+        self.logger.log(msg="resuming the copy from the journal at offset {0}, slice index {1}".format(copied_offset, slice_index),
+                        level=CommonVariables.WarningLevel)
+
+        self.journal_offset = copied_offset
+        if stopped_in_slice:
+            slice_offset = self.get_slice_range(slice_index)[0]
+            try:
+                buffer_view = self.get_slice_buffer(copied_offset - slice_offset)
+                self.read_device(self.source_dev_full_path, buffer_view, slice_offset)
+                self.write_slice_journaled(self.destination, buffer_view, slice_offset)
+                self.copied_bytes += len(buffer_view)
+            except (IOError, OSError) as e:
+                self.logger.log(msg="failed to resume the copy from the journal: {0}".format(e), level=CommonVariables.ErrorLevel)
+                return CommonVariables.copy_data_error
+            slice_index += 1
+
+        self.current_slice_index = slice_index
+        self.ongoing_item_config.current_slice_index = self.current_slice_index
+        self.ongoing_item_config.commit()
+        return CommonVariables.process_success
+
+    def get_stripe_workers(self, public_settings):
+        """
+        how many stripes of the overlapping copy are copied at once, a single stream leaves the disk at queue depth 1.
+        """
+        stripe_workers = CommonVariables.copy_stripe_workers
+        if public_settings and public_settings.get(CommonVariables.CopyStripeWorkersKey) is not None:
+            try:
+                stripe_workers = max(int(public_settings.get(CommonVariables.CopyStripeWorkersKey)), 1)
+            except ValueError:
+                self.logger.log(msg="invalid {0}, using {1}".format(CommonVariables.CopyStripeWorkersKey, stripe_workers),
+                                level=CommonVariables.WarningLevel)
+        self.logger.log("copy stripe workers: {0}".format(stripe_workers))
+        return stripe_workers
+
+    def get_stripes(self):
+        """
+        returns the (start, end) ranges of the stripes, on the slice grid, or None if the device is too small to split.
+        """
+        stripe_count = min(self.stripe_workers * CommonVariables.copy_stripes_per_worker,
+                           self.total_size // CommonVariables.copy_stripe_min_size)
+        if stripe_count < 2:
+            return None
+        stripe_size = (self.total_size // stripe_count) // self.block_size * self.block_size
+        if stripe_size < max(2 * self.overlap_window, self.block_size):
+            return None
+        return [(stripe_index * stripe_size, (stripe_index + 1) * stripe_size if stripe_index < stripe_count - 1 else self.total_size)
+                for stripe_index in range(stripe_count)]
+
+    def prepare_stripes(self):
+        """
+        resumes a striped copy, or splits an overlapping copy that has not started into stripes.
+        a copy that has started on a single stream is finished that way.
+        returns True when the copy goes on in stripes.
+        """
+        stripe_journal = StripeJournal(self.logger, self.encryption_environment.copy_stripe_journal_file,
+                                       self.encryption_environment.copy_stripe_guard_file,
+                                       self.source_dev_full_path, self.destination)
+        if not stripe_journal.load(self.total_size):
+            if self.overlap_window is None or self.stripe_workers < 2 or self.current_slice_index != 0 \
+                    or self.read_journal() is not None or os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
+                return False
+            stripes = self.get_stripes()
+            if stripes is None:
+                return False
+            try:
+                stripe_journal.create(self.total_size, self.overlap_window, stripes,
+                                      lambda buffer_view, offset: self.read_device(self.source_dev_full_path, buffer_view, offset),
+                                      self.get_slice_buffer(self.block_size))
+            except (IOError, OSError) as e:
+                self.logger.log(msg="failed to save the stripe guards, copying on a single stream: {0}".format(e),
+                                level=CommonVariables.WarningLevel)
+                stripe_journal.clear()
+                return False
+
+        # the stripes are written in chunks no larger than the shift, like the overlapping copy on a single stream
+        self.overlap_window = stripe_journal.shift
+        self.slice_size_tuner = None
+        self.stripe_journal = stripe_journal
+        self.stripe_progress = list(stripe_journal.copied_offsets)
+        return True
+
+    def write_stripe_journal(self, stripe_index, copied_offset):
+        if self.stripe_journal.copied_offsets[stripe_index] == copied_offset:
+            return
+        self.sync_device(self.destination)
+        self.stripe_journal.update(stripe_index, copied_offset)
+
+    def copy_stripe(self, stripe_index, buffer_view, errors):
+        """
+        copies the stripe from where it stopped down to its start, a slice at a time, until it is done or another stripe failed.
+        """
+        start, _ = self.stripe_journal.stripes[stripe_index]
+        guard_end = self.stripe_journal.get_guard_end(stripe_index)
+        while self.stripe_progress[stripe_index] > start and not errors:
+            chunk_end = self.stripe_progress[stripe_index]
+            chunk_start = max(start, (chunk_end - 1) // self.block_size * self.block_size)
+            chunk_view = buffer_view[:chunk_end - chunk_start]
+            chunk_start_time = time.time()
+            if self.used_ranges is not None and not self.used_ranges.is_used(chunk_start, len(chunk_view)):
+                with self.stats_lock:
+                    self.skipped_bytes += len(chunk_view)
+            else:
+                read_size = self.read_device(self.source_dev_full_path, chunk_view, chunk_start)
+                if read_size != len(chunk_view):
+                    raise IOError("short read of {0} bytes at offset {1} of {2}".format(read_size, chunk_start, self.source_dev_full_path))
+                if chunk_start < guard_end:
+                    # the stripe below may have written over the guard already
+                    self.stripe_journal.read_guard(stripe_index, chunk_start - start, chunk_view[:min(guard_end, chunk_end) - chunk_start])
+                self.write_slice_journaled(self.destination, chunk_view, chunk_start,
+                                           lambda copied_offset: self.write_stripe_journal(stripe_index, copied_offset))
+                self.record_checksum(chunk_start, chunk_view)
+                with self.stats_lock:
+                    self.copied_bytes += len(chunk_view)
+                if self.io_throttle is not None:
+                    # the other stripes keep copying while this one pauses
+                    with self.throttle_lock:
+                        pause_seconds = self.io_throttle.take_pause(time.time() - chunk_start_time)
+                    if pause_seconds > 0:
+                        time.sleep(pause_seconds)
+            self.stripe_progress[stripe_index] = chunk_start
+
+    def report_stripe_progress(self):
+        self.add_progress_sample()
+        if self.status_prefix:
+            self.hutil.do_status_report(operation='DataCopy',
+                                        status=CommonVariables.extension_success_status,
+                                        status_code=str(CommonVariables.success),
+                                        message=self.get_status_message())
+        self.write_progress_file('copying')
+
+    def copy_stripes(self):
+        """
+        copies the stripes on a pool of stripe_workers threads, the largest stripes left first.
+        each stripe resumes from its own journal record, so the slice index is only committed when all are done.
+        """
+        stripe_queue = queue.Queue()
+        for stripe_index in sorted(range(len(self.stripe_progress)),
+                                   key=lambda i: self.stripe_progress[i] - self.stripe_journal.stripes[i][0], reverse=True):
+            stripe_queue.put(stripe_index)
+        errors = []
+
+        def stripe_worker():
+            # each worker has a slice buffer of its own
+            buffer_view = memoryview(mmap.mmap(-1, self.block_size))
+            while not errors:
+                try:
+                    stripe_index = stripe_queue.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.copy_stripe(stripe_index, buffer_view, errors)
+                except Exception as e:
+                    self.logger.log(msg="failed to copy stripe {0} {1}: {2}".format(stripe_index, self.stripe_journal.stripes[stripe_index], e),
+                                    level=CommonVariables.ErrorLevel)
+                    errors.append(e)
+
+        self.logger.log("copying {0} stripes on {1} workers".format(len(self.stripe_progress), self.stripe_workers))
+        workers = [threading.Thread(target=stripe_worker) for _ in range(min(self.stripe_workers, len(self.stripe_progress)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        report_interval = self.checkpoint_interval_seconds or CommonVariables.copy_checkpoint_interval_seconds
+        last_report_time = time.time()
+        self.add_progress_sample()
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(1)
+                if time.time() - last_report_time >= report_interval:
+                    self.report_stripe_progress()
+                    last_report_time = time.time()
+        if errors:
+            return CommonVariables.copy_data_error
+
+        self.sync_device(self.destination)
+        self.current_slice_index = self.total_slice_size
+        self.add_progress_sample()
+        self.checkpoint()
+        self.stripe_journal.clear()
+        return CommonVariables.process_success
+
+    def is_slice_used(self, slice_index):
+        if self.used_ranges is None:
+            return True
+        slice_size = self.last_slice_size if self.is_last_slice(slice_index) else self.block_size
+        return self.used_ranges.is_used(int(self.get_skip_block(slice_index) * self.block_size), int(slice_size))
+
+    def change_block_size(self, block_size):
+        """
+        switches to another slice size between two slices and rebases current_slice_index on the new slice grid,
+        so that the ongoing item config describes the same copied range for resume.
+        returns False if the range copied so far is not a multiple of the new size yet.
+        """
+        if self.from_end.lower() == 'true':
+            if self.current_slice_index == 0:
+                new_slice_index = 0
+            else:
+                left_size = (self.total_slice_size - self.current_slice_index) * self.block_size
+                if left_size % block_size != 0:
+                    return False
+                new_slice_index = (self.total_size // block_size) + 1 - (left_size // block_size)
+        else:
+            copied_size = self.current_slice_index * self.block_size
+            if copied_size % block_size != 0:
+                return False
+            new_slice_index = copied_size // block_size
+
+        self.logger.log("changing the slice size from {0} to {1}, slice index {2} becomes {3}"
+                        .format(self.block_size, block_size, self.current_slice_index, new_slice_index))
+        self.block_size = block_size
+        self.last_slice_size = self.total_size % self.block_size
+        self.total_slice_size = ((self.total_size - self.last_slice_size) // self.block_size) + 1
+        self.current_slice_index = new_slice_index
+        self.ongoing_item_config.current_block_size = self.block_size
+        self.ongoing_item_config.current_slice_index = self.current_slice_index
+        return True
+
+    def get_fd(self, path, flags):
+        with self.fd_lock:
+            if (path, flags) not in self.opened_fds:
+                self.opened_fds[(path, flags)] = os.open(path, flags, 0o600)
+                if self.cache_neutral and flags == os.O_RDONLY and path == self.source_dev_full_path:
+                    self.advise_source(self.opened_fds[(path, flags)])
+            return self.opened_fds[(path, flags)]
+
+    def close_fds(self):
+        self.wait_read_ahead()
+        for fd in self.opened_fds.values():
+            os.close(fd)
+            if self.dirty_writeback is not None:
+                self.dirty_writeback.synced(fd)
+        self.opened_fds = {}
+
+    def get_direct_fd(self, path, flags):
+        """
+        returns None when the path can not be opened with O_DIRECT, e.g. a file on tmpfs.
+        """
+        if path in self.direct_io_unsupported_paths:
+            return None
+        try:
+            return self.get_fd(path, flags | os.O_DIRECT)
+        except OSError as e:
+            self.logger.log(msg="failed to open {0} with O_DIRECT, using buffered I/O for it: {1}".format(path, e),
+                            level=CommonVariables.WarningLevel)
+            self.direct_io_unsupported_paths.add(path)
+            return None
+
+    def get_direct_io_size(self, buffer_view, offset):
+        """
+        O_DIRECT needs the offset and the length aligned, the unaligned tail of a request goes through the page cache.
+        """
+        if self.io_mode != CommonVariables.CopyIOModeDirect or offset % self.direct_io_alignment != 0:
+            return 0
+        return len(buffer_view) - (len(buffer_view) % self.direct_io_alignment)
+
+    def get_slice_buffer(self, size, buffer_index=None):
+        """
+        the slice buffers are allocated once and reused for every slice of the copy, the second one only with read ahead.
+        they are anonymous mappings so that they are page aligned, as direct I/O requires.
+        """
+        if buffer_index is None:
+            buffer_index = self.current_buffer_index
+        if self.slice_buffers[buffer_index] is None or len(self.slice_buffers[buffer_index]) < size:
+            self.slice_buffers[buffer_index] = mmap.mmap(-1, max(size, self.block_size))
+        return memoryview(self.slice_buffers[buffer_index])[:size]
+
+    def get_read_ahead_range(self, slice_index):
+        """
+        returns the (offset, size) of the slice to read ahead, or None if there is nothing to read.
+        """
+        if not self.read_ahead_enabled or slice_index >= self.total_slice_size or not self.is_slice_used(slice_index):
+            return None
+        if self.is_last_slice(slice_index):
+            if self.last_slice_size == 0:
+                return None
+            slice_size = self.last_slice_size
+        else:
+            slice_size = self.block_size
+        return (int(self.get_skip_block(slice_index) * self.block_size), int(slice_size))
+
+    def start_read_ahead(self, path, offset, size):
+        buffer_index = 1 - self.current_buffer_index
+        buffer_view = self.get_slice_buffer(size, buffer_index)
+        read_ahead = {'request': (path, offset, size), 'buffer_index': buffer_index, 'size': None, 'error': None}
+
+        def read_ahead_worker():
+            try:
+                read_ahead['size'] = self.read_device(path, buffer_view, offset)
+            except (IOError, OSError) as e:
+                read_ahead['error'] = e
+
+        read_ahead['thread'] = threading.Thread(target=read_ahead_worker)
+        read_ahead['thread'].daemon = True
+        self.read_ahead = read_ahead
+        read_ahead['thread'].start()
+
+    def wait_read_ahead(self):
+        read_ahead = self.read_ahead
+        self.read_ahead = None
+        if read_ahead is not None:
+            read_ahead['thread'].join()
+        return read_ahead
+
+    def take_read_ahead(self, path, offset, size):
+        """
+        returns the buffer and size of the slice if it was read ahead, otherwise (None, 0).
+        """
+        read_ahead = self.wait_read_ahead()
+        if read_ahead is None or read_ahead['request'] != (path, offset, size):
+            return None, 0
+        if read_ahead['error'] is not None:
+            self.logger.log(msg="read ahead of {0} at offset {1} failed, reading it again: {2}".format(path, offset, read_ahead['error']),
+                            level=CommonVariables.WarningLevel)
+            return None, 0
+        self.current_buffer_index = read_ahead['buffer_index']
+        return self.get_slice_buffer(size), read_ahead['size']
+
+    def read_device(self, path, buffer_view, offset):
+        """
+        buffer_view has to start at the beginning of the slice buffer for the direct part to be aligned.
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(len(buffer_view))
+        total_read = 0
+        direct_io_size = self.get_direct_io_size(buffer_view, offset)
+        if direct_io_size > 0:
+            direct_fd = self.get_direct_fd(path, os.O_RDONLY)
+            if direct_fd is not None:
+                total_read = self.read_fully(direct_fd, buffer_view[:direct_io_size], offset)
+                if total_read < direct_io_size:
+                    return total_read
+        buffered_offset = offset + total_read
+        buffered_read = self.read_fully(self.get_fd(path, os.O_RDONLY), buffer_view[total_read:], buffered_offset)
+        # the slice is in the buffer now, its pages are not read again
+        self.drop_cache(path, buffered_offset, buffered_read)
+        return total_read + buffered_read
+
+    def write_device(self, path, buffer_view, offset):
+        total_written = 0
+        direct_io_size = self.get_direct_io_size(buffer_view, offset)
+        if direct_io_size > 0:
+            direct_fd = self.get_direct_fd(path, os.O_WRONLY | os.O_CREAT)
+            if direct_fd is not None:
+                total_written = self.write_fully(direct_fd, buffer_view[:direct_io_size], offset)
+        fd = self.get_fd(path, os.O_WRONLY | os.O_CREAT)
+        if self.dirty_writeback is None:
+            return total_written + self.write_fully(fd, buffer_view[total_written:], offset + total_written)
+        # written in chunks of half the dirty limit, so that a slice larger than the limit is written back as it goes
+        chunk_size = self.dirty_writeback.get_chunk_size()
+        while total_written < len(buffer_view):
+            chunk_written = self.write_fully(fd, buffer_view[total_written:total_written + chunk_size], offset + total_written)
+            self.dirty_writeback.add(fd, offset + total_written, chunk_written)
+            total_written += chunk_written
+        return total_written
+
+    def log_throughput(self, elapsed_seconds):
+        throughput = (self.copied_bytes / (1024.0 * 1024.0)) / elapsed_seconds if elapsed_seconds > 0 else 0.0
+        self.logger.log("copied {0} bytes in {1:.1f} seconds, {2:.1f} MB/s with the {3} copy engine and {4} I/O, {5} of them zeroed, skipped {6} bytes of free space"
+                        .format(self.copied_bytes, elapsed_seconds, throughput, self.copy_engine, self.io_mode, self.zeroed_bytes, self.skipped_bytes))
+        if self.rate_limiter is not None:
+            self.logger.log("the rate limiter held the copy back for {0:.1f} seconds".format(self.rate_limiter.waited_seconds))
+        if self.io_throttle is not None:
+            self.logger.log("the io throttle paused the copy for {0:.1f} seconds".format(self.io_throttle.throttled_seconds))
+        if self.dirty_writeback is not None:
+            self.logger.log("{0} bytes were written back ahead of the syncs".format(self.dirty_writeback.written_back_bytes))
+
+    def read_fully(self, fd, buffer_view, offset):
+        """
+        returns the number of bytes read, which is less than the buffer size only at the end of the source.
+        """
+        total_read = 0
+        while total_read < len(buffer_view):
+            if hasattr(os, 'preadv'):
+                read_size = os.preadv(fd, [buffer_view[total_read:]], offset + total_read)
+            else:
+                data = os.pread(fd, len(buffer_view) - total_read, offset + total_read)
+                read_size = len(data)
+                buffer_view[total_read:total_read + read_size] = data
+            if read_size == 0:
+                break
+            total_read += read_size
+        return total_read
+
+    def write_fully(self, fd, buffer_view, offset):
+        total_written = 0
+        while total_written < len(buffer_view):
+            total_written += os.pwrite(fd, buffer_view[total_written:], offset + total_written)
+        return total_written
+
+    def write_slice_item_backup_file(self, buffer_view, zero_ranges=None):
+        """
+        zero ranges are left as holes, the file is extended to the slice size at the end so they read back as zeros.
+        the backup is durable when this returns, the slice it holds is overwritten next.
+        """
+        backup_file = self.encryption_environment.copy_slice_item_backup_file
+        backup_created = not os.path.exists(backup_file)
+        backup_fd = os.open(backup_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            position = 0
+            for zero_start, zero_end in zero_ranges or []:
+                self.write_fully(backup_fd, buffer_view[position:zero_start], position)
+                position = zero_end
+            self.write_fully(backup_fd, buffer_view[position:], position)
+            os.ftruncate(backup_fd, len(buffer_view))
+            os.fsync(backup_fd)
+        finally:
+            os.close(backup_fd)
+        if backup_created:
+            directory_fd = os.open(os.path.dirname(backup_file), os.O_RDONLY)
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
 
     def resume_copy_internal(self, copy_slice_item_backup_file_size, skip_block, original_total_copy_size):
-        block_size_of_slice_item_backup = 512
         #copy the left slice
         if copy_slice_item_backup_file_size <= original_total_copy_size:
-            skip_of_slice_item_backup_file = copy_slice_item_backup_file_size / block_size_of_slice_item_backup
-            left_count = ((original_total_copy_size - copy_slice_item_backup_file_size) / block_size_of_slice_item_backup)
-            total_count = original_total_copy_size / block_size_of_slice_item_backup
-            original_device_skip_count = (self.block_size * skip_block) / block_size_of_slice_item_backup 
-            if left_count != 0:
-                dd_cmd = str(self.copy_command) \
-                       + ' if=' + self.source_dev_full_path \
-                       + ' of=' + self.encryption_environment.copy_slice_item_backup_file \
-                       + ' bs=' + str(block_size_of_slice_item_backup) \
-                       + ' skip=' + str(int(original_device_skip_count + skip_of_slice_item_backup_file)) \
-                       + ' seek=' + str(int(skip_of_slice_item_backup_file)) \
-                       + ' count=' + str(int(left_count))
-
-                return_code = self.command_executer.Execute(dd_cmd)
-                if return_code != CommonVariables.process_success:
-                    return return_code
-
-            dd_cmd = str(self.copy_command) \
-                   + ' if=' + self.encryption_environment.copy_slice_item_backup_file \
-                   + ' of=' + self.destination \
-                   + ' bs=' + str(int(block_size_of_slice_item_backup)) \
-                   + ' seek=' + str(int(original_device_skip_count)) \
-                   + ' count=' + str(int(total_count))
+            if self.copy_engine == CommonVariables.CopyEngineNative or self.vectored_io_enabled:
+                return_code = self.resume_copy_internal_native(copy_slice_item_backup_file_size, skip_block, original_total_copy_size)
+            else:
+                return_code = self.resume_copy_internal_dd(copy_slice_item_backup_file_size, skip_block, original_total_copy_size)
 
-            return_code = self.command_executer.Execute(dd_cmd)
             if return_code != CommonVariables.process_success:
                 return return_code
             else:
@@ -103,6 +1144,65 @@ class TransactionalCopyTask(object):
                             level=CommonVariables.ErrorLevel)
             return CommonVariables.backup_slice_file_error
 
+    def resume_copy_internal_native(self, copy_slice_item_backup_file_size, skip_block, original_total_copy_size):
+        slice_offset = int(self.block_size * skip_block)
+        buffer_view = self.get_slice_buffer(int(original_total_copy_size))
+        try:
+            backup_fd = os.open(self.encryption_environment.copy_slice_item_backup_file, os.O_RDONLY)
+            try:
+                backup_read_size = self.read_fully(backup_fd, buffer_view[:copy_slice_item_backup_file_size], 0)
+            finally:
+                os.close(backup_fd)
+
+            if backup_read_size < len(buffer_view):
+                # the backup was interrupted before the destination was touched, so the rest is still in the source.
+                source_fd = self.get_fd(self.source_dev_full_path, os.O_RDONLY)
+                self.read_fully(source_fd, buffer_view[backup_read_size:], slice_offset + backup_read_size)
+                self.write_slice_item_backup_file(buffer_view, self.get_zero_ranges(buffer_view))
+
+            checksum = SliceChecksumJournal.checksum(buffer_view)
+            if self.destination_matches(slice_offset, len(buffer_view), checksum):
+                self.logger.log(msg="the destination already holds the slice at offset {0}".format(slice_offset),
+                                level=CommonVariables.WarningLevel)
+            else:
+                self.write_slice(self.destination, buffer_view, slice_offset, self.get_zero_ranges(buffer_view))
+                self.copied_bytes += len(buffer_view)
+            if self.checksum_journal is not None:
+                self.checksum_journal.add(slice_offset, len(buffer_view), checksum)
+        except (IOError, OSError) as e:
+            self.logger.log(msg="failed to resume the slice at offset {0}: {1}".format(slice_offset, e),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+        return CommonVariables.process_success
+
+    def resume_copy_internal_dd(self, copy_slice_item_backup_file_size, skip_block, original_total_copy_size):
+        block_size_of_slice_item_backup = 512
+        skip_of_slice_item_backup_file = copy_slice_item_backup_file_size / block_size_of_slice_item_backup
+        left_count = ((original_total_copy_size - copy_slice_item_backup_file_size) / block_size_of_slice_item_backup)
+        total_count = original_total_copy_size / block_size_of_slice_item_backup
+        original_device_skip_count = (self.block_size * skip_block) / block_size_of_slice_item_backup 
+        if left_count != 0:
+            dd_cmd = str(self.copy_command) \
+                   + ' if=' + self.source_dev_full_path \
+                   + ' of=' + self.encryption_environment.copy_slice_item_backup_file \
+                   + ' bs=' + str(block_size_of_slice_item_backup) \
+                   + ' skip=' + str(int(original_device_skip_count + skip_of_slice_item_backup_file)) \
+                   + ' seek=' + str(int(skip_of_slice_item_backup_file)) \
+                   + ' count=' + str(int(left_count))
+
+            return_code = self.command_executer.Execute(dd_cmd)
+            if return_code != CommonVariables.process_success:
+                return return_code
+
+        dd_cmd = str(self.copy_command) \
+               + ' if=' + self.encryption_environment.copy_slice_item_backup_file \
+               + ' of=' + self.destination \
+               + ' bs=' + str(int(block_size_of_slice_item_backup)) \
+               + ' seek=' + str(int(original_device_skip_count)) \
+               + ' count=' + str(int(total_count))
+
+        return self.command_executer.Execute(dd_cmd)
+
     def resume_copy(self):
         if self.from_end.lower() == 'true':
             skip_block = (self.total_slice_size - self.current_slice_index - 1)
@@ -134,6 +1234,12 @@ class TransactionalCopyTask(object):
         return return_code
 
     def copy_last_slice(self, skip_block):
+        if self.copy_engine != CommonVariables.CopyEngineNative and self.vectored_io_enabled:
+            return self.copy_slice_vectored(from_device=self.source_dev_full_path,
+                                            to_device=self.destination,
+                                            offset=int(skip_block * self.block_size),
+                                            size=self.last_slice_size)
+
         block_size_of_last_slice = 512
         skip_of_last_slice = (skip_block * self.block_size) / block_size_of_last_slice
         count_of_last_slice = self.last_slice_size / block_size_of_last_slice
@@ -146,59 +1252,84 @@ class TransactionalCopyTask(object):
                                          count = count_of_last_slice)
         return copy_result
 
-    def begin_copy(self):
+    def copy_slice_vectored(self, from_device, to_device, offset, size):
         """
-        check the device_item size first, cut it
+        copies a slice that dd would copy in 512 byte blocks, the tail of the device, in one read and one write.
+        it is backed up first like a dd slice, so that it resumes the same way.
         """
-        self.resume_copy()
-        if self.from_end.lower() == 'true':
-            while self.current_slice_index < self.total_slice_size:
-                skip_block = (self.total_slice_size - self.current_slice_index - 1)
+        try:
+            buffer_view = self.get_slice_buffer(int(size))
+            slice_size = self.read_device(from_device, buffer_view, offset)
+            self.logger.log(msg=("slice size is: {0}".format(slice_size)))
+            zero_ranges = self.get_zero_ranges(buffer_view[:slice_size])
+            self.write_slice_item_backup_file(buffer_view[:slice_size], zero_ranges)
+            self.write_slice(to_device, buffer_view[:slice_size], offset, zero_ranges)
+            self.copied_bytes += slice_size
+        except (IOError, OSError) as e:
+            self.logger.log(msg="failed to copy {0} bytes from {1} to {2}: {3}".format(size, from_device, to_device, e),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
 
-                if self.current_slice_index == 0:
-                    if self.last_slice_size > 0:
-                        copy_result = self.copy_last_slice(skip_block)
-                        if copy_result != CommonVariables.process_success:
-                            return copy_result
-                    else:
-                        self.logger.log(msg = "the last slice size is zero, so skip the 0 index.")
-                else:
-                    copy_result = self.copy_internal(from_device=self.source_dev_full_path,
-                                                     to_device=self.destination,
-                                                     skip=skip_block,
-                                                     seek=skip_block,
-                                                     block_size=self.block_size)
+        if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
+            os.remove(self.encryption_environment.copy_slice_item_backup_file)
+        return CommonVariables.process_success
 
-                    if copy_result != CommonVariables.process_success:
-                        return copy_result
+    def get_skip_block(self, slice_index):
+        if self.from_end.lower() == 'true':
+            return self.total_slice_size - slice_index - 1
+        else:
+            return slice_index
 
-                self.current_slice_index += 1
+    def is_last_slice(self, slice_index):
+        """
+        the last slice is the partial one at the end of the device, which is copied first when copying from the end.
+        """
+        if self.from_end.lower() == 'true':
+            return slice_index == 0
+        else:
+            return slice_index == (self.total_slice_size - 1)
 
-                if self.status_prefix:
-                    msg = self.status_prefix + ': ' \
-                        + str(int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)) \
-                        + '%'
+    def begin_copy(self):
+        """
+        check the device_item size first, cut it
+        """
+        copy_start_time = time.time()
+        try:
+            if self.copy_engine == CommonVariables.CopyEngineNative:
+                resume_result = self.resume_journal()
+                if resume_result != CommonVariables.process_success:
+                    return resume_result
 
-                    self.hutil.do_status_report(operation='DataCopy',
-                                                status=CommonVariables.extension_success_status,
-                                                status_code=str(CommonVariables.success),
-                                                message=msg)
+            resume_result = self.resume_copy()
+            if resume_result != CommonVariables.process_success:
+                return resume_result
+            if self.prepare_stripes():
+                copy_result = self.copy_stripes()
+                if copy_result != CommonVariables.process_success:
+                    return copy_result
+            self.skip_verified_slices()
 
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
+            if self.slice_size_tuner is not None and self.slice_size_tuner.get_block_size() != self.block_size:
+                if self.change_block_size(self.slice_size_tuner.get_block_size()):
+                    self.ongoing_item_config.commit()
 
-            return CommonVariables.process_success
-        else:
+            uncommitted_slices = 0
+            last_checkpoint_time = time.time()
+            self.add_progress_sample()
             while self.current_slice_index < self.total_slice_size:
-                skip_block = self.current_slice_index
+                skip_block = self.get_skip_block(self.current_slice_index)
+                self.next_read_ahead_range = self.get_read_ahead_range(self.current_slice_index + 1)
 
-                if self.current_slice_index == (self.total_slice_size - 1):
+                slice_start_time = time.time()
+                if not self.is_slice_used(self.current_slice_index):
+                    self.skipped_bytes += self.last_slice_size if self.is_last_slice(self.current_slice_index) else self.block_size
+                elif self.is_last_slice(self.current_slice_index):
                     if self.last_slice_size > 0:
                         copy_result = self.copy_last_slice(skip_block)
                         if copy_result != CommonVariables.process_success:
                             return copy_result
                     else:
-                        self.logger.log(msg = "the last slice size is zero, so skip the last slice index.")
+                        self.logger.log(msg = "the last slice size is zero, so skip the slice index {0}.".format(self.current_slice_index))
                 else:
                     copy_result = self.copy_internal(from_device=self.source_dev_full_path,
                                                      to_device=self.destination,
@@ -209,85 +1340,162 @@ class TransactionalCopyTask(object):
                     if copy_result != CommonVariables.process_success:
                         return copy_result
 
-                self.current_slice_index += 1
+                    if self.slice_size_tuner is not None:
+                        self.slice_size_tuner.record_slice(self.block_size, self.block_size, time.time() - slice_start_time)
 
-                if self.status_prefix:
-                    msg = self.status_prefix + ': ' \
-                        + str(int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)) \
-                        + '%'
+                if self.io_throttle is not None:
+                    self.io_throttle.pace(time.time() - slice_start_time)
 
-                    self.hutil.do_status_report(operation='DataCopy',
-                                                status=CommonVariables.extension_success_status,
-                                                status_code=str(CommonVariables.success),
-                                                message=msg)
+                self.current_slice_index += 1
+                uncommitted_slices += 1
+                self.add_progress_sample()
 
-                self.hutil.do_status_report(operation='DataCopy',
-                                            status=CommonVariables.extension_success_status,
-                                            status_code=str(CommonVariables.success),
-                                            message=msg)
+                # the resume maps the journal offset on the committed slice size, so a new size is committed right away
+                block_size_changed = False
+                if self.slice_size_tuner is not None and self.slice_size_tuner.get_block_size() != self.block_size \
+                        and self.current_slice_index < self.total_slice_size:
+                    block_size_changed = self.change_block_size(self.slice_size_tuner.get_block_size())
 
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
+                if block_size_changed or self.current_slice_index == self.total_slice_size \
+                        or self.is_checkpoint_due(uncommitted_slices, last_checkpoint_time):
+                    self.checkpoint()
+                    uncommitted_slices = 0
+                    last_checkpoint_time = time.time()
+
+            if self.copy_engine == CommonVariables.CopyEngineNative:
+                self.clear_journal()
+            if self.checksum_journal is not None:
+                if self.verify_sample_count > 0:
+                    mismatches = self.verify_sample(self.verify_sample_count)
+                    if mismatches:
+                        self.logger.log(msg="the destination does not match the copied data at offsets {0}".format(mismatches),
+                                        level=CommonVariables.ErrorLevel)
+                self.checksum_journal.clear()
+            self.write_progress_file('completed')
+            self.log_throughput(time.time() - copy_start_time)
             return CommonVariables.process_success
+        finally:
+            if self.checksum_journal is not None:
+                self.checksum_journal.close()
+            if self.stripe_journal is not None:
+                self.stripe_journal.close()
+            self.close_fds()
 
     """
     TODO: if the copy failed?
     """
-    def copy_internal(self, from_device, to_device,  block_size, skip=0, seek=0, count=1):
+    def copy_internal(self, from_device, to_device, block_size, skip=0, seek=0, count=1):
+        if self.copy_engine == CommonVariables.CopyEngineNative:
+            return self.copy_internal_native(from_device, to_device, block_size, skip, seek, count)
+        else:
+            return self.copy_internal_dd(from_device, to_device, block_size, skip, seek, count)
+
+    def copy_internal_native(self, from_device, to_device, block_size, skip=0, seek=0, count=1):
+        """
+        same steps as the dd copy, but the slice stays in one process buffer instead of going through the middle cache
+        """
+        read_offset = int(block_size * skip)
+        try:
+            buffer_view, slice_size = self.take_read_ahead(from_device, read_offset, int(block_size * count))
+            if buffer_view is None:
+                buffer_view = self.get_slice_buffer(int(block_size * count))
+                slice_size = self.read_device(from_device, buffer_view, read_offset)
+            self.logger.log(msg=("slice size is: {0}".format(slice_size)))
+            if self.next_read_ahead_range is not None:
+                self.start_read_ahead(from_device, self.next_read_ahead_range[0], self.next_read_ahead_range[1])
+            if self.overlap_window is not None:
+                self.write_slice_journaled(to_device, buffer_view[:slice_size], int(block_size * seek))
+            else:
+                # the backup belongs to the slice the journal points at, so the journal has to get there first
+                self.write_journal(self.get_copied_offset(self.current_slice_index))
+                zero_ranges = self.get_zero_ranges(buffer_view[:slice_size])
+                self.write_slice_item_backup_file(buffer_view[:slice_size], zero_ranges)
+                self.write_slice(to_device, buffer_view[:slice_size], int(block_size * seek), zero_ranges)
+            self.record_checksum(int(block_size * seek), buffer_view[:slice_size])
+            self.copied_bytes += slice_size
+        except (IOError, OSError) as e:
+            self.logger.log(msg="failed to copy {0} bytes from {1} to {2}: {3}".format(int(block_size * count), from_device, to_device, e),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+
+        #the copy done correctly, so clear the backup slice file item.
+        if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
+            os.remove(self.encryption_environment.copy_slice_item_backup_file)
+        return CommonVariables.process_success
+
+    def execute_dd(self, dd_cmd, output_view=None, input_view=None):
+        """
+        runs dd with its output read into output_view or its input fed from input_view, so that the slice
+        is staged in the process buffer instead of a file. returns the return code and the bytes read.
         """
-        first, copy the data to the middle cache
+        self.logger.log("Executing: {0}".format(dd_cmd))
+        proc = Popen(shlex.split(dd_cmd), stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=0, close_fds=True)
+        read_size = 0
+        try:
+            written_size = 0
+            while input_view is not None and written_size < len(input_view):
+                written_size += os.write(proc.stdin.fileno(), input_view[written_size:])
+            proc.stdin.close()
+            while output_view is not None and read_size < len(output_view):
+                chunk_size = proc.stdout.readinto(output_view[read_size:])
+                if not chunk_size:
+                    break
+                read_size += chunk_size
+            stderr = proc.stderr.read()
+        finally:
+            for pipe in [proc.stdin, proc.stdout, proc.stderr]:
+                pipe.close()
+            return_code = proc.wait()
+            if input_view is not None:
+                # like write_slice, dd wrote the device
+                DeviceTopologyCache.invalidate_all()
+        if return_code != CommonVariables.process_success:
+            self.logger.log(msg="{0} failed with return code {1}: {2}".format(dd_cmd, return_code, stderr),
+                            level=CommonVariables.ErrorLevel)
+        return return_code, read_size
+
+    def copy_internal_dd(self, from_device, to_device, block_size, skip=0, seek=0, count=1):
         """
+        dd reads the slice into the slice buffer, which is backed up and then handed to dd to write.
+        the writing dd reblocks its input, pipe reads can be short, and does not truncate image files.
+        """
+        if self.rate_limiter is not None:
+            # dd reads and writes the whole slice at once, so it is paced a slice at a time
+            self.rate_limiter.consume(2 * int(block_size * count))
+        buffer_view = self.get_slice_buffer(int(block_size * count))
         dd_cmd = str(self.copy_command) \
                + ' if=' + from_device \
-               + ' of=' + self.slice_file_path \
                + ' bs=' + str(int(block_size)) \
                + ' skip=' + str(int(skip)) \
                + ' count=' + str(int(count))
-
-        return_code = self.command_executer.Execute(dd_cmd)
-        if return_code != CommonVariables.process_success:
-            self.logger.log(msg="{0} is {1}".format(dd_cmd, return_code), level=CommonVariables.ErrorLevel)
-            return return_code
-        else:
-            slice_file_size = os.path.getsize(self.slice_file_path)
-            self.logger.log(msg=("slice_file_size is: {0}".format(slice_file_size)))
-            """
-            second, copy the data in the middle cache to the backup slice.
-            """
-            backup_slice_item_cmd = str(self.copy_command) \
-                                  + ' if=' + self.slice_file_path \
-                                  + ' of=' + self.encryption_environment.copy_slice_item_backup_file \
-                                  + ' bs=' + str(int(block_size)) \
-                                  + ' count=' + str(int(count))
-            return_code = self.command_executer.Execute(backup_slice_item_cmd)
-            self.logger.log("backup_slice_item_cmd is:{0}".format(backup_slice_item_cmd))
-            if return_code != CommonVariables.process_success:
-                self.logger.log(msg=("{0} is: {1}".format(backup_slice_item_cmd, return_code)), level = CommonVariables.ErrorLevel)
-            """
-            third, copy the data in the middle cache to the target device.
-            """
-            dd_cmd = str(self.copy_command) + ' if=' + self.slice_file_path + ' of=' + to_device + ' bs=' + str(int(block_size)) + ' seek=' + str(int(seek)) + ' count=' + str(int(count))
-            return_code = self.command_executer.Execute(dd_cmd)
+        try:
+            return_code, slice_size = self.execute_dd(dd_cmd, output_view=buffer_view)
             if return_code != CommonVariables.process_success:
-                self.logger.log(msg=("{0} is: {1}".format(dd_cmd, return_code)), level = CommonVariables.ErrorLevel)
-            else:
-                #the copy done correctly, so clear the backup slice file item.
-                if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                    self.logger.log(msg = "clean up the backup file")
-                    os.remove(self.encryption_environment.copy_slice_item_backup_file)
-                if os.path.exists(self.slice_file_path):
-                    self.logger.log(msg = "clean up the slice file")
-                    os.remove(self.slice_file_path)
-            return return_code
-
-    def prepare_mem_fs(self):
-        self.disk_util.make_sure_path_exists(self.tmpfs_mount_point)
-        commandToExecute = self.patching.mount_path + " -t tmpfs -o size=" + str(self.block_size + 1024) + " tmpfs " + self.tmpfs_mount_point
-        self.logger.log("prepare mem fs script is: {0}".format(commandToExecute))
-        return_code = self.command_executer.Execute(commandToExecute)
-        return return_code
+                return return_code
+            self.copied_bytes += slice_size
+            self.logger.log(msg=("slice size is: {0}".format(slice_size)))
+            self.write_slice_item_backup_file(buffer_view[:slice_size])
 
-    def clear_mem_fs(self):
-        commandToExecute = self.patching.umount_path + " " + self.tmpfs_mount_point
-        return_code = self.command_executer.Execute(commandToExecute)
+            dd_cmd = str(self.copy_command) \
+                   + ' of=' + to_device \
+                   + ' ibs=' + str(CommonVariables.dd_pipe_block_size) \
+                   + ' obs=' + str(int(block_size)) \
+                   + ' seek=' + str(int(seek)) \
+                   + ' conv=notrunc'
+            return_code, _ = self.execute_dd(dd_cmd, input_view=buffer_view[:slice_size])
+            if self.io_throttle is not None:
+                # the dd processes are gone before the throttle samples the I/O of the copy
+                self.io_throttle.add_own_io(2 * slice_size)
+            if return_code == CommonVariables.process_success and self.dirty_writeback is not None:
+                self.dirty_writeback.add(self.get_fd(to_device, os.O_WRONLY | os.O_CREAT), int(block_size * seek), slice_size)
+        except (IOError, OSError) as e:
+            self.logger.log(msg="failed to copy {0} bytes from {1} to {2}: {3}".format(int(block_size * count), from_device, to_device, e),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+
+        if return_code == CommonVariables.process_success:
+            #the copy done correctly, so clear the backup slice file item.
+            if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
+                self.logger.log(msg = "clean up the backup file")
+                os.remove(self.encryption_environment.copy_slice_item_backup_file)
         return return_code
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import os.path
+import re
+import threading
+
+
+class UdevDatabase(object):
+    """
+    indexes the udev database of the block devices by major:minor, read in one pass and again only once udev changed it.
+    device_id is an attribute of the Hyper-V device a disk sits on, which udevadm info -a finds among the parents of
+    the device in sysfs, so it is read from there and kept by device.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.udev_data_path = '/run/udev/data'
+        self.sys_path = '/sys'
+        self.sys_dev_block_path = os.path.join(self.sys_path, 'dev', 'block')
+        self.properties = None
+        self.loaded_mtime = None
+        self.device_ids = {}
+        # shared by the DiskUtil of every volume encrypted at once
+        self.lock = threading.RLock()
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.udev_data_path).st_mtime
+        except OSError:
+            return None
+
+    def load(self):
+        """
+        udev writes an entry to a temporary file and renames it, so the directory changes with every entry.
+        """
+        properties = {}
+        loaded_mtime = self.get_mtime()
+        if loaded_mtime is not None:
+            for entry in os.listdir(self.udev_data_path):
+                if not entry.startswith('b'):
+                    continue
+                entry_properties = {}
+                try:
+                    with open(os.path.join(self.udev_data_path, entry), 'r') as f:
+                        for line in f:
+                            if line.startswith('E:') and '=' in line:
+                                key, value = line[2:].rstrip('\n').split('=', 1)
+                                entry_properties[key] = value
+                except (IOError, OSError):
+                    # removed while it was read
+                    continue
+                properties[entry[1:]] = entry_properties
+        self.properties = properties
+        self.loaded_mtime = loaded_mtime
+
+    def refresh(self):
+        if self.properties is None or self.get_mtime() != self.loaded_mtime:
+            self.load()
+
+    def get_properties(self, majmin):
+        """
+        returns the udev properties of the device, or None if udev has no entry for it.
+        """
+        with self.lock:
+            self.refresh()
+            return self.properties.get(majmin)
+
+    def get_device_id(self, majmin):
+        """
+        returns the device_id of the nearest parent of the device that has one, without the braces, or "".
+        """
+        if not majmin:
+            return ""
+        with self.lock:
+            return self.read_device_id(majmin)
+
+    def read_device_id(self, majmin):
+        sys_device_path = os.path.realpath(os.path.join(self.sys_dev_block_path, majmin))
+        if sys_device_path in self.device_ids:
+            return self.device_ids[sys_device_path]
+
+        device_id = ""
+        path = sys_device_path
+        while path.startswith(self.sys_path + os.sep) and os.path.exists(path):
+            device_id_path = os.path.join(path, 'device_id')
+            if os.path.isfile(device_id_path):
+                with open(device_id_path, 'r') as f:
+                    match = re.findall(r'{(.*)}', f.read().strip())
+                if match:
+                    device_id = match[0]
+                    break
+            path = os.path.dirname(path)
+        self.device_ids[sys_device_path] = device_id
+        return device_id
@@ -63,6 +63,7 @@ import sys
 import base64
 import json
 import tempfile
+import threading
 import time
 import logging
 import logging.handlers
@@ -94,6 +95,8 @@ class HandlerUtility:
         self._context = HandlerContext(self._short_name)
         self.config_folder = '/var/lib/azure_disk_encryption_config'
         self.status_lock_file_path = '/var/lib/azure_disk_encryption_config/status_lock_file.lck'
+        # the volumes encrypted at once report from threads of their own, the status lock file is per process
+        self.status_report_lock = threading.RLock()
 
     def _get_log_prefix(self):
         return '[%s-%s]' % (self._context._name, self._context._version)
@@ -468,6 +471,10 @@ class HandlerUtility:
         sys.exit(0)
 
     def do_status_report(self, operation, status, status_code, message):
+        with self.status_report_lock:
+            self._do_status_report(operation, status, status_code, message)
+
+    def _do_status_report(self, operation, status, status_code, message):
         lock = None
         try:
             if not os.path.exists(self.config_folder):
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+
+class VolumeStatusReporter(object):
+    """
+    reports the status of one of the volumes of a VolumeStatusReport, in place of hutil.
+    """
+    def __init__(self, volume_status_report, volume_num):
+        self.volume_status_report = volume_status_report
+        self.volume_num = volume_num
+
+    def do_status_report(self, operation, status, status_code, message):
+        self.volume_status_report.report(self.volume_num, operation, status, status_code, message)
+
+
+class VolumeStatusReport(object):
+    """
+    the status of the data volumes encrypted at once. every volume reports through a VolumeStatusReporter of its own,
+    and the status file gets the last message of every volume in the order of the volumes, not only the last one written.
+    """
+    def __init__(self, hutil, volume_count):
+        self.hutil = hutil
+        self.messages = [None] * volume_count
+        self.lock = threading.Lock()
+
+    def get_reporter(self, volume_num):
+        return VolumeStatusReporter(self, volume_num)
+
+    def get_message(self):
+        return '; '.join(message for message in self.messages if message)
+
+    def report(self, volume_num, operation, status, status_code, message):
+        with self.lock:
+            self.messages[volume_num] = message
+            self.hutil.do_status_report(operation=operation,
+                                        status=status,
+                                        status_code=status_code,
+                                        message=self.get_message())
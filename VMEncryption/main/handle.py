@@ -24,12 +24,17 @@ import os.path
 import re
 import subprocess
 import sys
+import threading
 import time
 import tempfile
 import traceback
 import uuid
 import shutil
 from distutils.version import LooseVersion
+try:
+    import queue # python3+
+except ImportError:
+    import Queue as queue # python2
 
 
 from Utils import HandlerUtil
@@ -50,10 +55,13 @@ from DecryptionMarkConfig import DecryptionMarkConfig
 from EncryptionMarkConfig import EncryptionMarkConfig
 from EncryptionEnvironment import EncryptionEnvironment
 from OnGoingItemConfig import OnGoingItemConfig
+from FreeSpaceMap import FreeSpaceMap
 from ProcessLock import ProcessLock
 from CommandExecutor import CommandExecutor, ProcessCommunicator
 from OnlineEncryptionHandler import OnlineEncryptionHandler
+from OnlineDecryptionHandler import OnlineDecryptionHandler
 from VolumeNotificationService import VolumeNotificationService
+from VolumeStatusReport import VolumeStatusReport
 from io import open
 
 # Global variables
@@ -67,6 +75,8 @@ DistroPatcher = None
 encryption_environment = None
 security_Type = None
 vns_call = None
+# volumes encrypted at once take turns to format their luks header and to update the crypt and fstab configs
+encryption_volume_lock = threading.Lock()
 
 
 def install():
@@ -162,6 +172,9 @@ def disable_encryption():
 
         decryption_marker.command = extension_parameter.command
         decryption_marker.volume_type = extension_parameter.VolumeType
+        if should_perform_online_decryption(disk_util, crypt_items):
+            logger.log("Disks will be decrypted with online mode")
+            decryption_marker.decryption_mode = CommonVariables.EncryptionModeOnline
         decryption_marker.commit()
 
         settings_util = EncryptionSettingsUtil(logger)
@@ -677,6 +690,26 @@ def mark_encryption(command, volume_type, disk_format_query, encryption_mode=Non
                                message='Online Encryption initialized.')
     return encryption_marker
 
+def should_perform_online_decryption(disk_util, crypt_items):
+    if security_Type != CommonVariables.ConfidentialVM and not DistroPatcher.support_online_encryption:
+        return False
+    if security_Type == CommonVariables.ConfidentialVM and not DistroPatcher.validate_online_encryption_support():
+        return False
+    public_settings = get_public_settings() or {}
+    if str(public_settings.get(CommonVariables.OnlineDecryptionKey, False)).lower() != 'true':
+        logger.log("{0} is not set, decrypting offline".format(CommonVariables.OnlineDecryptionKey))
+        return False
+    if not crypt_items:
+        return False
+    for crypt_item in crypt_items:
+        if not disk_util.supports_online_decryption(crypt_item.luks_header_path):
+            logger.log("cryptsetup cannot decrypt {0} online, decrypting offline".format(crypt_item.dev_path))
+            return False
+        if disk_util.get_luks_version(crypt_item.dev_path, crypt_item.luks_header_path) != "2":
+            logger.log("{0} does not have a LUKS2 header, decrypting offline".format(crypt_item.dev_path))
+            return False
+    return True
+
 def should_perform_online_encryption(disk_util, encryption_command, volume_type):
     if security_Type != CommonVariables.ConfidentialVM and not DistroPatcher.support_online_encryption:
         return False
@@ -1344,21 +1377,45 @@ def mapper_update_for_resume_operation( disk_util,
             logger.log("device {0} can't opened using {1} passphrase".format(ongoing_item_config.original_dev_name_path,passphrase_file))
     return open_result
 
+def save_free_space_map(ongoing_item_config, dev_path):
+    """
+    saves the used ranges of the unmounted file system, so the data copy can skip its free space.
+    this has to run while the file system metadata on the device is still in clear text.
+    skipping is opt-in through CopySkipFreeSpace: the free space is left as it was, so the plain text of deleted
+    files stays readable on the disk after the encryption.
+    """
+    public_settings = get_public_settings() or {}
+    if str(public_settings.get(CommonVariables.CopySkipFreeSpaceKey, False)).lower() != 'true':
+        logger.log("skipping the free space is not enabled, the whole device will be copied")
+        FreeSpaceMap.remove(ongoing_item_config.encryption_environment.copy_used_ranges_file_path)
+        return
+    free_space_map = FreeSpaceMap(logger=logger, dev_path=dev_path, file_system=ongoing_item_config.get_file_system())
+    free_space_map.save(ongoing_item_config.encryption_environment.copy_used_ranges_file_path)
+
+
 def encrypt_inplace_without_separate_header_file(passphrase_file,
                                                  device_item,
                                                  disk_util,
                                                  crypt_mount_config_util,
                                                  bek_util,
                                                  status_prefix='',
-                                                 ongoing_item_config=None):
+                                                 ongoing_item_config=None,
+                                                 item_environment=None,
+                                                 status_hutil=None):
     """
     if ongoing_item_config is not None, then this is a resume case.
+    item_environment keeps the state of this device apart from the others encrypted at the same time.
+    status_hutil reports the status of the copy in place of hutil, for the devices encrypted at the same time.
     this function will return the phase
     """
     logger.log("encrypt_inplace_without_seperate_header_file")
     current_phase = CommonVariables.EncryptionPhaseBackupHeader
+    if ongoing_item_config is not None:
+        item_environment = ongoing_item_config.encryption_environment
+    elif item_environment is None:
+        item_environment = encryption_environment
     if ongoing_item_config is None:
-        ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment, logger=logger)
+        ongoing_item_config = OnGoingItemConfig(encryption_environment=item_environment, logger=logger)
         ongoing_item_config.current_block_size = CommonVariables.default_block_size
         ongoing_item_config.current_slice_index = 0
         ongoing_item_config.device_size = device_item.size
@@ -1425,23 +1482,25 @@ def encrypt_inplace_without_separate_header_file(passphrase_file,
             else:
                 ongoing_item_config.current_slice_index = 0
                 ongoing_item_config.current_source_path = original_dev_path
-                ongoing_item_config.current_destination = encryption_environment.copy_header_slice_file_path
+                ongoing_item_config.current_destination = item_environment.copy_header_slice_file_path
                 ongoing_item_config.current_total_copy_size = CommonVariables.default_block_size
                 ongoing_item_config.from_end = False
-                ongoing_item_config.header_slice_file_path = encryption_environment.copy_header_slice_file_path
+                ongoing_item_config.header_slice_file_path = item_environment.copy_header_slice_file_path
                 ongoing_item_config.original_dev_path = original_dev_path
                 ongoing_item_config.commit()
-                if os.path.exists(encryption_environment.copy_header_slice_file_path):
+                if os.path.exists(item_environment.copy_header_slice_file_path):
                     logger.log(msg="the header slice file is there, remove it.", level=CommonVariables.WarningLevel)
-                    os.remove(encryption_environment.copy_header_slice_file_path)
+                    os.remove(item_environment.copy_header_slice_file_path)
 
-                copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix)
+                copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix, public_settings=get_public_settings(),
+                                             encryption_environment=item_environment, hutil=status_hutil)
 
                 if copy_result != CommonVariables.process_success:
                     logger.log(msg="copy the header block failed, return code is: {0}".format(copy_result),
                                level=CommonVariables.ErrorLevel)
                     return current_phase
                 else:
+                    save_free_space_map(ongoing_item_config=ongoing_item_config, dev_path=original_dev_path)
                     ongoing_item_config.current_slice_index = 0
                     ongoing_item_config.phase = CommonVariables.EncryptionPhaseEncryptDevice
                     ongoing_item_config.commit()
@@ -1453,10 +1512,12 @@ def encrypt_inplace_without_separate_header_file(passphrase_file,
             encrypt_result = CommonVariables.process_success
             #in case of resume -> if disk is not luks
             if not disk_util.is_luks_device(device_path=original_dev_path,device_header_path = None):
-                encrypt_result = disk_util.encrypt_disk(dev_path=original_dev_path,
-                                                        passphrase_file=passphrase_file,
-                                                        mapper_name=mapper_name,
-                                                        header_file=None)
+                # the key derivation of luksFormat takes a lot of memory, one volume at a time
+                with encryption_volume_lock:
+                    encrypt_result = disk_util.encrypt_disk(dev_path=original_dev_path,
+                                                            passphrase_file=passphrase_file,
+                                                            mapper_name=mapper_name,
+                                                            header_file=None)
             # after the encrypt_disk without seperate header, then the uuid
             # would change.
             if encrypt_result != CommonVariables.process_success:
@@ -1484,7 +1545,8 @@ def encrypt_inplace_without_separate_header_file(passphrase_file,
             ongoing_item_config.phase = CommonVariables.EncryptionPhaseCopyData
             ongoing_item_config.commit()
 
-            copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix)
+            copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix, public_settings=get_public_settings(),
+                                         encryption_environment=item_environment, hutil=status_hutil)
             if copy_result != CommonVariables.process_success:
                 logger.log(msg="copy the main content block failed, return code is: {0}".format(copy_result),
                            level=CommonVariables.ErrorLevel)
@@ -1506,7 +1568,8 @@ def encrypt_inplace_without_separate_header_file(passphrase_file,
             ongoing_item_config.current_total_copy_size = CommonVariables.default_block_size
             ongoing_item_config.commit()
 
-            copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix)
+            copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix, public_settings=get_public_settings(),
+                                         encryption_environment=item_environment, hutil=status_hutil)
 
             if copy_result == CommonVariables.process_success:
                 crypt_item_to_update = CryptItem()
@@ -1527,27 +1590,30 @@ def encrypt_inplace_without_separate_header_file(passphrase_file,
                 else:
                     crypt_item_to_update.mount_point = mount_point
 
-                if mount_point:
-                    logger.log(msg="removing entry for unencrypted drive from fstab",
-                               level=CommonVariables.InfoLevel)
-                    crypt_mount_config_util.modify_fstab_entry_encrypt(mount_point, os.path.join(CommonVariables.dev_mapper_root, mapper_name))
-                else:
-                    logger.log(msg=original_dev_name_path + " is not defined in fstab, no need to update",
-                               level=CommonVariables.InfoLevel)
+                # the fstab and the crypt items are shared by the volumes encrypted at once
+                with encryption_volume_lock:
+                    if mount_point:
+                        logger.log(msg="removing entry for unencrypted drive from fstab",
+                                   level=CommonVariables.InfoLevel)
+                        crypt_mount_config_util.modify_fstab_entry_encrypt(mount_point, os.path.join(CommonVariables.dev_mapper_root, mapper_name))
+                    else:
+                        logger.log(msg=original_dev_name_path + " is not defined in fstab, no need to update",
+                                   level=CommonVariables.InfoLevel)
 
-                if crypt_item_to_update.mount_point != "None":
-                    disk_util.mount_filesystem(device_mapper_path, ongoing_item_config.get_mount_point())
-                    backup_folder = os.path.join(crypt_item_to_update.mount_point, ".azure_ade_backup_mount_info/")
-                    update_crypt_item_result = crypt_mount_config_util.add_crypt_item(crypt_item_to_update, backup_folder)
-                else:
-                    logger.log("the crypt_item_to_update.mount_point is None, so we do not mount it.")
-                    update_crypt_item_result = crypt_mount_config_util.add_crypt_item(crypt_item_to_update)
+                    if crypt_item_to_update.mount_point != "None":
+                        disk_util.mount_filesystem(device_mapper_path, ongoing_item_config.get_mount_point())
+                        backup_folder = os.path.join(crypt_item_to_update.mount_point, ".azure_ade_backup_mount_info/")
+                        update_crypt_item_result = crypt_mount_config_util.add_crypt_item(crypt_item_to_update, backup_folder)
+                    else:
+                        logger.log("the crypt_item_to_update.mount_point is None, so we do not mount it.")
+                        update_crypt_item_result = crypt_mount_config_util.add_crypt_item(crypt_item_to_update)
 
                 if not update_crypt_item_result:
                     logger.log(msg="update crypt item failed", level=CommonVariables.ErrorLevel)
 
-                if os.path.exists(encryption_environment.copy_header_slice_file_path):
-                    os.remove(encryption_environment.copy_header_slice_file_path)
+                if os.path.exists(item_environment.copy_header_slice_file_path):
+                    os.remove(item_environment.copy_header_slice_file_path)
+                FreeSpaceMap.remove(item_environment.copy_used_ranges_file_path)
 
                 current_phase = CommonVariables.EncryptionPhaseDone
                 ongoing_item_config.phase = current_phase
@@ -1571,7 +1637,8 @@ def encrypt_inplace_with_separate_header_file(passphrase_file,
                                               crypt_mount_config_util,
                                               bek_util,
                                               status_prefix='',
-                                              ongoing_item_config=None):
+                                              ongoing_item_config=None,
+                                              status_hutil=None):
     """
     if ongoing_item_config is not None, then this is a resume case.
     """
@@ -1614,6 +1681,7 @@ def encrypt_inplace_with_separate_header_file(passphrase_file,
                 luks_header_file_path = ongoing_item_config.get_header_file_path()
                 toggle_se_linux_for_centos7(True)
 
+                save_free_space_map(ongoing_item_config=ongoing_item_config, dev_path=original_dev_path)
                 encrypt_result = disk_util.encrypt_disk(dev_path=original_dev_path,
                                                         passphrase_file=passphrase_file,
                                                         mapper_name=mapper_name,
@@ -1664,7 +1732,8 @@ def encrypt_inplace_with_separate_header_file(passphrase_file,
                 ongoing_item_config.from_end = True
                 ongoing_item_config.commit()
 
-                copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix)
+                copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix, public_settings=get_public_settings(),
+                                             hutil=status_hutil)
 
                 if copy_result != CommonVariables.success:
                     error_message = "the copying result is {0} so skip the mounting".format(copy_result)
@@ -1709,6 +1778,7 @@ def encrypt_inplace_with_separate_header_file(passphrase_file,
                     if not update_crypt_item_result:
                         logger.log(msg="update crypt item failed", level=CommonVariables.ErrorLevel)
 
+                    FreeSpaceMap.remove(encryption_environment.copy_used_ranges_file_path)
                     current_phase = CommonVariables.EncryptionPhaseDone
                     ongoing_item_config.phase = current_phase
                     ongoing_item_config.commit()
@@ -1725,7 +1795,11 @@ def decrypt_inplace_copy_data(passphrase_file,
                               disk_util,
                               crypt_mount_config_util,
                               status_prefix='',
-                              ongoing_item_config=None):
+                              ongoing_item_config=None,
+                              status_hutil=None):
+    """
+    status_hutil reports the status of the copy in place of hutil, like for the encryption.
+    """
     logger.log(msg="decrypt_inplace_copy_data")
 
     if ongoing_item_config:
@@ -1752,7 +1826,8 @@ def decrypt_inplace_copy_data(passphrase_file,
                    level=CommonVariables.InfoLevel)
 
         if current_phase == CommonVariables.DecryptionPhaseCopyData:
-            copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix)
+            copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix, public_settings=get_public_settings(),
+                                         hutil=status_hutil)
             if copy_result == CommonVariables.process_success:
                 mount_point = ongoing_item_config.get_mount_point()
                 if mount_point and mount_point != "None":
@@ -1784,7 +1859,8 @@ def decrypt_inplace_without_separate_header_file(passphrase_file,
                                                  disk_util,
                                                  crypt_mount_config_util,
                                                  status_prefix='',
-                                                 ongoing_item_config=None):
+                                                 ongoing_item_config=None,
+                                                 status_hutil=None):
     logger.log(msg="decrypt_inplace_without_separate_header_file")
 
     luks_header_size = disk_util.get_luks_header_size(crypt_item.dev_path)
@@ -1806,7 +1882,8 @@ def decrypt_inplace_without_separate_header_file(passphrase_file,
                                      disk_util,
                                      crypt_mount_config_util,
                                      status_prefix,
-                                     ongoing_item_config)
+                                     ongoing_item_config,
+                                     status_hutil)
 
 
 def decrypt_inplace_with_separate_header_file(passphrase_file,
@@ -1816,7 +1893,8 @@ def decrypt_inplace_with_separate_header_file(passphrase_file,
                                               disk_util,
                                               crypt_mount_config_util,
                                               status_prefix='',
-                                              ongoing_item_config=None):
+                                              ongoing_item_config=None,
+                                              status_hutil=None):
     logger.log(msg="decrypt_inplace_with_separate_header_file")
 
     if raw_device_item.size != mapper_device_item.size:
@@ -1836,7 +1914,8 @@ def decrypt_inplace_with_separate_header_file(passphrase_file,
                                      disk_util,
                                      crypt_mount_config_util,
                                      status_prefix,
-                                     ongoing_item_config)
+                                     ongoing_item_config,
+                                     status_hutil)
 
 
 def enable_encryption_all_format(passphrase_file, encryption_marker, disk_util, crypt_mount_config_util, bek_util, os_items_to_stamp):
@@ -1933,6 +2012,57 @@ def find_all_devices_to_encrypt(encryption_marker, disk_util, bek_util, volume_t
     return device_items_to_encrypt
 
 
+def get_encryption_parallel_volumes():
+    """
+    how many data volumes are encrypted in place at once, each of them is copied by a transactional copy of its own.
+    """
+    public_settings = get_public_settings() or {}
+    parallel_volumes = CommonVariables.encryption_parallel_volumes
+    if public_settings.get(CommonVariables.EncryptionParallelVolumesKey) is not None:
+        try:
+            parallel_volumes = max(int(public_settings.get(CommonVariables.EncryptionParallelVolumesKey)), 1)
+        except ValueError:
+            logger.log(msg="invalid {0}, using {1}".format(CommonVariables.EncryptionParallelVolumesKey, parallel_volumes),
+                       level=CommonVariables.WarningLevel)
+    return parallel_volumes
+
+
+def encrypt_in_parallel(encrypt_item, items, parallel_volumes):
+    """
+    calls encrypt_item(item_num, item) on a pool of parallel_volumes threads, it returns whether the item is done.
+    no item is started once one has failed, the ones in flight are finished.
+    returns the first item which failed, or None.
+    """
+    item_queue = queue.Queue()
+    for item_num, item in enumerate(items):
+        item_queue.put((item_num, item))
+    failed_items = []
+
+    def volume_worker():
+        while not failed_items:
+            try:
+                item_num, item = item_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if not encrypt_item(item_num, item):
+                    failed_items.append(item)
+            except Exception as e:
+                logger.log(msg="failed to encrypt {0}: {1}, stack trace: {2}".format(item, e, traceback.format_exc()),
+                           level=CommonVariables.ErrorLevel)
+                failed_items.append(item)
+
+    logger.log("encrypting {0} volumes on {1} workers".format(len(items), parallel_volumes))
+    workers = [threading.Thread(target=volume_worker) for _ in range(min(parallel_volumes, len(items)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1)
+    return failed_items[0] if failed_items else None
+
+
 def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util, crypt_mount_config_util, bek_util, os_items_to_stamp):
     """
     if return None for the success case, or return the device item which failed.
@@ -1955,7 +2085,7 @@ def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util
         if security_Type == CommonVariables.ConfidentialVM:
             online_enc_handle = OnlineEncryptionHandler(logger,security_Type,get_public_settings())
         else:
-            online_enc_handle = OnlineEncryptionHandler(logger)
+            online_enc_handle = OnlineEncryptionHandler(logger, public_setting=get_public_settings())
         if encryption_marker.get_encryption_phase() is not None and encryption_marker.get_encryption_phase() == CommonVariables.EncryptionPhaseResume:
             logger.log("Entering online encryption resume phase.")
             num_devices = online_enc_handle.get_device_items_for_resume(crypt_mount_config_util, disk_util)
@@ -1997,33 +2127,48 @@ def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util
                            status_code=str(CommonVariables.success),
                            message=msg)
 
-    for device_num, device_item in enumerate(device_items_to_encrypt):
+    parallel_volumes = min(get_encryption_parallel_volumes(), len(device_items_to_encrypt))
+    volume_status_report = VolumeStatusReport(hutil, len(device_items_to_encrypt))
+
+    def encrypt_device_item(device_num, device_item):
         umount_status_code = CommonVariables.success
         if device_item.mount_point is not None and device_item.mount_point != "":
             umount_status_code = disk_util.umount(device_item.mount_point)
         if umount_status_code != CommonVariables.success:
             logger.log("error occured when do the umount for: {0} with code: {1}".format(device_item.mount_point, umount_status_code))
-        else:
-            logger.log(msg=("encrypting: {0}".format(device_item)))
-            status_prefix = "Encrypting data volume {0}/{1}".format(device_num + 1,
-                                                                    len(device_items_to_encrypt))
+            return True
 
-            # TODO check the file system before encrypting it.
-            logger.log(msg="For VMSS we only do inplace headers",
-                       level=CommonVariables.WarningLevel)
+        logger.log(msg=("encrypting: {0}".format(device_item)))
+        status_prefix = "Encrypting data volume {0}/{1}".format(device_num + 1,
+                                                                len(device_items_to_encrypt))
 
-            encryption_result_phase = encrypt_inplace_without_separate_header_file(passphrase_file=passphrase_file,
-                                                                                   device_item=device_item,
-                                                                                   disk_util=disk_util,
-                                                                                   crypt_mount_config_util=crypt_mount_config_util,
-                                                                                   bek_util=bek_util,
-                                                                                   status_prefix=status_prefix)
+        # TODO check the file system before encrypting it.
+        logger.log(msg="For VMSS we only do inplace headers",
+                   level=CommonVariables.WarningLevel)
 
-            if encryption_result_phase == CommonVariables.EncryptionPhaseDone:
-                continue
-            else:
-                # do exit to exit from this round
-                return device_item
+        # the volumes encrypted at once keep their ongoing item configs apart, and report one status for all of them
+        item_environment = None
+        status_hutil = None
+        if parallel_volumes > 1:
+            item_environment = encryption_environment.get_item_environment(device_item.name)
+            status_hutil = volume_status_report.get_reporter(device_num)
+        encryption_result_phase = encrypt_inplace_without_separate_header_file(passphrase_file=passphrase_file,
+                                                                               device_item=device_item,
+                                                                               disk_util=disk_util,
+                                                                               crypt_mount_config_util=crypt_mount_config_util,
+                                                                               bek_util=bek_util,
+                                                                               status_prefix=status_prefix,
+                                                                               item_environment=item_environment,
+                                                                               status_hutil=status_hutil)
+        return encryption_result_phase == CommonVariables.EncryptionPhaseDone
+
+    if parallel_volumes > 1:
+        return encrypt_in_parallel(encrypt_device_item, device_items_to_encrypt, parallel_volumes)
+
+    for device_num, device_item in enumerate(device_items_to_encrypt):
+        if not encrypt_device_item(device_num, device_item):
+            # do exit to exit from this round
+            return device_item
     return None
 
 
@@ -2109,6 +2254,26 @@ def disable_encryption_all_in_place(passphrase_file, decryption_marker, disk_uti
     return None
 
 
+def disable_encryption_online(disk_util, crypt_mount_config_util):
+    """
+    decrypts the volumes in the background while they stay mounted, and resumes the ones that were being decrypted.
+    On success, returns None. Otherwise returns the crypt item for which decryption failed.
+    """
+    logger.log(msg="executing disable_encryption_online")
+
+    online_dec_handle = OnlineDecryptionHandler(logger, encryption_environment, get_public_settings())
+    failed_item = online_dec_handle.handle(crypt_mount_config_util.get_crypt_items(), disk_util, crypt_mount_config_util)
+    if failed_item is not None:
+        return failed_item
+
+    hutil.do_status_report(operation='DisableEncryption',
+                           status=CommonVariables.extension_success_status,
+                           status_code=str(CommonVariables.success),
+                           message='Background Decrypting {0} data volume(s).'.format(online_dec_handle.devices.qsize()))
+    online_dec_handle.handle_resume_decryption(disk_util)
+    return online_dec_handle.finish_decryption(crypt_mount_config_util)
+
+
 def daemon_encrypt(): 
     logger.log("daemon_encrypt security type is {0}".format(security_Type))
     public_settings = get_public_settings()
@@ -2344,6 +2509,39 @@ def daemon_encrypt():
                                message=message)
 
 
+def resume_ongoing_item(ongoing_item_config, disk_util, crypt_mount_config_util, bek_util, bek_passphrase_file, status_prefix, status_hutil=None):
+    """
+    resumes the encryption of the device described by ongoing_item_config and returns the phase it reached.
+    """
+    ongoing_item_config.load_value_from_file()
+    header_file_path = ongoing_item_config.get_header_file_path()
+    mount_point = ongoing_item_config.get_mount_point()
+    if not none_or_empty(mount_point):
+        logger.log("mount point is not empty {0}, trying to unmount it first.".format(mount_point))
+        umount_status_code = disk_util.umount(mount_point)
+        logger.log("unmount return code is {0}".format(umount_status_code))
+    if none_or_empty(header_file_path):
+        encryption_result_phase = encrypt_inplace_without_separate_header_file(passphrase_file=bek_passphrase_file,
+                                                                               device_item=None,
+                                                                               disk_util=disk_util,
+                                                                               crypt_mount_config_util=crypt_mount_config_util,
+                                                                               bek_util=bek_util,
+                                                                               status_prefix=status_prefix,
+                                                                               ongoing_item_config=ongoing_item_config,
+                                                                               status_hutil=status_hutil)
+        # TODO mount it back when shrink failed
+    else:
+        encryption_result_phase = encrypt_inplace_with_separate_header_file(passphrase_file=bek_passphrase_file,
+                                                                            device_item=None,
+                                                                            disk_util=disk_util,
+                                                                            crypt_mount_config_util=crypt_mount_config_util,
+                                                                            bek_util=bek_util,
+                                                                            status_prefix=status_prefix,
+                                                                            ongoing_item_config=ongoing_item_config,
+                                                                            status_hutil=status_hutil)
+    return encryption_result_phase
+
+
 def daemon_encrypt_data_volumes(encryption_marker, encryption_config, disk_util, crypt_mount_config_util, bek_util, bek_passphrase_file, os_items_to_stamp):
     try:
         """
@@ -2360,43 +2558,50 @@ def daemon_encrypt_data_volumes(encryption_marker, encryption_config, disk_util,
         identified.
         """
         ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment, logger=logger)
+        ongoing_item_environments = encryption_environment.get_ongoing_item_environments()
 
         if ongoing_item_config.config_file_exists():
             logger.log("OngoingItemConfig exists.")
-            ongoing_item_config.load_value_from_file()
-            header_file_path = ongoing_item_config.get_header_file_path()
-            mount_point = ongoing_item_config.get_mount_point()
-            status_prefix = "Resuming encryption after reboot"
-            if not none_or_empty(mount_point):
-                logger.log("mount point is not empty {0}, trying to unmount it first.".format(mount_point))
-                umount_status_code = disk_util.umount(mount_point)
-                logger.log("unmount return code is {0}".format(umount_status_code))
-            if none_or_empty(header_file_path):
-                encryption_result_phase = encrypt_inplace_without_separate_header_file(passphrase_file=bek_passphrase_file,
-                                                                                       device_item=None,
-                                                                                       disk_util=disk_util,
-                                                                                       crypt_mount_config_util=crypt_mount_config_util,
-                                                                                       bek_util=bek_util,
-                                                                                       status_prefix=status_prefix,
-                                                                                       ongoing_item_config=ongoing_item_config)
-                # TODO mount it back when shrink failed
-            else:
-                encryption_result_phase = encrypt_inplace_with_separate_header_file(passphrase_file=bek_passphrase_file,
-                                                                                    device_item=None,
-                                                                                    disk_util=disk_util,
-                                                                                    crypt_mount_config_util=crypt_mount_config_util,
-                                                                                    bek_util=bek_util,
-                                                                                    status_prefix=status_prefix,
-                                                                                    ongoing_item_config=ongoing_item_config)
+            encryption_result_phase = resume_ongoing_item(ongoing_item_config=ongoing_item_config,
+                                                          disk_util=disk_util,
+                                                          crypt_mount_config_util=crypt_mount_config_util,
+                                                          bek_util=bek_util,
+                                                          bek_passphrase_file=bek_passphrase_file,
+                                                          status_prefix="Resuming encryption after reboot")
             """
             if the resuming failed, we should fail.
             """
             if encryption_result_phase != CommonVariables.EncryptionPhaseDone:
-                original_dev_path = ongoing_item_config.get_original_dev_path
+                original_dev_path = ongoing_item_config.get_original_dev_path()
                 message = 'EnableEncryption: resuming encryption for {0} failed'.format(original_dev_path)
                 raise Exception(message)
             else:
                 ongoing_item_config.clear_config()
+        elif ongoing_item_environments:
+            logger.log("{0} OngoingItemConfigs exist.".format(len(ongoing_item_environments)))
+            ongoing_item_configs = [OnGoingItemConfig(encryption_environment=item_environment, logger=logger)
+                                    for item_environment in ongoing_item_environments]
+
+            volume_status_report = VolumeStatusReport(hutil, len(ongoing_item_configs))
+
+            def resume_item(item_num, item_config):
+                status_prefix = "Resuming encryption of data volume {0}/{1} after reboot".format(item_num + 1, len(ongoing_item_configs))
+                encryption_result_phase = resume_ongoing_item(ongoing_item_config=item_config,
+                                                              disk_util=disk_util,
+                                                              crypt_mount_config_util=crypt_mount_config_util,
+                                                              bek_util=bek_util,
+                                                              bek_passphrase_file=bek_passphrase_file,
+                                                              status_prefix=status_prefix,
+                                                              status_hutil=volume_status_report.get_reporter(item_num))
+                if encryption_result_phase != CommonVariables.EncryptionPhaseDone:
+                    return False
+                item_config.clear_config()
+                return True
+
+            failed_item_config = encrypt_in_parallel(resume_item, ongoing_item_configs, get_encryption_parallel_volumes())
+            if failed_item_config is not None:
+                message = 'EnableEncryption: resuming encryption for {0} failed'.format(failed_item_config.get_original_dev_path())
+                raise Exception(message)
         else:
             logger.log("OngoingItemConfig does not exist")
             failed_item = None
@@ -2474,9 +2679,13 @@ def daemon_decrypt():
                           bek_util=None,
                           encryption_config=encryption_config,
                           passphrase_file=None)
-    for crypt_item in crypt_mount_config_util.get_crypt_items():
-        logger.log("Unmounting {0}".format(os.path.join(CommonVariables.dev_mapper_root, crypt_item.mapper_name)))
-        disk_util.umount(os.path.join(CommonVariables.dev_mapper_root, crypt_item.mapper_name))
+    online_decryption = decryption_marker.get_decryption_mode() == CommonVariables.EncryptionModeOnline
+    if online_decryption:
+        logger.log("the volumes stay mounted while they are decrypted online.")
+    else:
+        for crypt_item in crypt_mount_config_util.get_crypt_items():
+            logger.log("Unmounting {0}".format(os.path.join(CommonVariables.dev_mapper_root, crypt_item.mapper_name)))
+            disk_util.umount(os.path.join(CommonVariables.dev_mapper_root, crypt_item.mapper_name))
 
     # at this point all the /dev/mapper/* crypt devices should be open
 
@@ -2489,7 +2698,10 @@ def daemon_decrypt():
 
         failed_item = None
 
-        if decryption_marker.get_current_command() == CommonVariables.DisableEncryption:
+        if decryption_marker.get_current_command() == CommonVariables.DisableEncryption and online_decryption:
+            failed_item = disable_encryption_online(disk_util=disk_util,
+                                                    crypt_mount_config_util=crypt_mount_config_util)
+        elif decryption_marker.get_current_command() == CommonVariables.DisableEncryption:
             failed_item = disable_encryption_all_in_place(passphrase_file=None,
                                                           decryption_marker=decryption_marker,
                                                           disk_util=disk_util,
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks the data copy of the in-place encryption and decryption on sparse file backed images.
+
+Each image is built once per file system and fill level, and copied for every case, which runs in a
+process of its own so that its peak RSS and I/O counters are its own. The encrypt direction copies the
+image onto itself moved up by the LUKS header size, like the copy through the mapper does, when the
+image is attached as loop devices (--loop, needs root), and onto a second image otherwise.
+The decrypt direction always copies onto a second image.
+Every case starts with the pages of its images dropped, and the pages of them in the page cache
+are sampled while it copies.
+
+    python copy_benchmark.py --size 1024 --file-systems ext4,xfs --fill-levels 0,50,90 --output report.json
+
+Engines are named sets of public settings handed to the copy, see ENGINES, and more can be given
+with --engine name='{"CopyEngine": "native", ...}'.
+"""
+
+import argparse
+import ctypes
+import json
+import mmap
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+_TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+_MAIN_DIR = os.path.dirname(_TEST_DIR)
+for _path in [_MAIN_DIR, os.path.join(os.path.dirname(os.path.dirname(_MAIN_DIR)), 'Utils')]:
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+
+from Common import CommonVariables
+
+MB = 1024 * 1024
+
+ENGINES = {
+    'native': {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineNative},
+    'native-direct': {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineNative,
+                      CommonVariables.CopyIOModeKey: CommonVariables.CopyIOModeDirect},
+    'native-cached': {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineNative,
+                      CommonVariables.CopyCacheNeutralKey: False},
+    'dd': {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd},
+    # the opt-in free space skipping, the other engines copy the whole file system like the handler does by default
+    'native-skip-free': {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineNative,
+                         CommonVariables.CopySkipFreeSpaceKey: True},
+    # dd with the tail and the resumed slice in 512 byte blocks, like before they were read in one request
+    'dd-512': {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd,
+               CommonVariables.CopyVectoredIOKey: False},
+}
+
+ENTRIES = ['transactional', 'disk_util']
+DIRECTIONS = ['encrypt', 'decrypt']
+FILL_FILE_SIZE = 4 * MB
+
+
+def register_engine(name, public_settings):
+    ENGINES[name] = public_settings
+
+
+class BenchmarkLogger(object):
+    def __init__(self, log_path):
+        self.log_path = log_path
+
+    def log(self, msg, level='Info'):
+        with open(self.log_path, 'a') as f:
+            f.write("[{0}] {1}\n".format(level, msg))
+
+
+class BenchmarkHandlerUtil(object):
+    def __init__(self, logger):
+        self.logger = logger
+        self.status_reports = 0
+
+    def log(self, msg):
+        self.logger.log(msg)
+
+    def do_status_report(self, operation, status, status_code, message):
+        self.status_reports += 1
+        self.logger.log("status: {0}".format(message))
+
+
+class BenchmarkPatcher(object):
+    dd_path = 'dd'
+    mount_path = 'mount'
+    umount_path = 'umount'
+    mkdir_path = 'mkdir'
+    touch_path = 'touch'
+
+
+def find_executable(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep) + ['/sbin', '/usr/sbin']:
+        if os.path.exists(os.path.join(path, name)):
+            return os.path.join(path, name)
+    return None
+
+
+def write_fill_files(fill_dir, fill_bytes):
+    """
+    random data does not compress and is never all zeros, so every byte of it is copied.
+    """
+    file_names = []
+    written = 0
+    while written < fill_bytes:
+        file_name = "fill{0:05d}".format(len(file_names))
+        size = min(FILL_FILE_SIZE, fill_bytes - written)
+        with open(os.path.join(fill_dir, file_name), 'wb') as f:
+            f.write(os.urandom(size))
+        file_names.append(file_name)
+        written += size
+    return file_names
+
+
+def build_image(image_path, size, file_system_size, file_system, fill_level, work_dir):
+    """
+    a sparse image with the file system in its first file_system_size bytes, shrunk like it is before the
+    encryption to leave room for the header, and filled to fill_level percent by mkfs so that nothing
+    has to be mounted.
+    """
+    with open(image_path, 'wb') as f:
+        f.truncate(size)
+    if file_system == 'none':
+        with open(image_path, 'r+b') as f:
+            f.write(os.urandom(int(file_system_size * fill_level / 100)))
+        return
+
+    fill_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        # leave room for the file system metadata
+        file_names = write_fill_files(fill_dir, int(file_system_size * fill_level / 100 * 0.9))
+        if file_system in ['ext2', 'ext3', 'ext4']:
+            subprocess.check_call([find_executable('mke2fs') or 'mke2fs', '-q', '-F', '-t', file_system, '-d', fill_dir, image_path, str(file_system_size // 1024)])
+        elif file_system == 'xfs':
+            proto_path = os.path.join(work_dir, 'xfs.proto')
+            with open(proto_path, 'w') as f:
+                f.write("/dev/null\n0 0\nd--755 0 0\n")
+                for file_name in file_names:
+                    f.write("{0} ---644 0 0 {1}\n".format(file_name, os.path.join(fill_dir, file_name)))
+                f.write("$\n$\n")
+            subprocess.check_call([find_executable('mkfs.xfs') or 'mkfs.xfs', '-q', '-f', '-p', proto_path, '-d', 'size={0}'.format(file_system_size), image_path])
+        else:
+            raise ValueError("unsupported file system {0}".format(file_system))
+    finally:
+        shutil.rmtree(fill_dir)
+
+
+def copy_sparse(source_path, destination_path):
+    subprocess.check_call(['cp', '--sparse=always', source_path, destination_path])
+
+
+def attach_loop(image_path, offset=0):
+    return subprocess.check_output(['losetup', '--find', '--show', '--offset', str(offset), image_path]).decode('utf-8').strip()
+
+
+def detach_loop(loop_path):
+    subprocess.call(['losetup', '-d', loop_path])
+
+
+def read_proc_io():
+    counters = {}
+    if os.path.exists('/proc/self/io'):
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name.strip()] = int(value)
+    return counters
+
+
+def get_cached_bytes(path):
+    """
+    counts the bytes of the file or device in the page cache, with mincore on a mapping of it.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        if size == 0:
+            return 0
+        address = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if address == ctypes.c_void_p(-1).value:
+            raise OSError(ctypes.get_errno(), "mmap of {0} failed".format(path))
+        try:
+            pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+            residency = ctypes.create_string_buffer(pages)
+            if libc.mincore(address, size, residency) != 0:
+                raise OSError(ctypes.get_errno(), "mincore of {0} failed".format(path))
+            return (pages - residency.raw.count(b'\0')) * mmap.PAGESIZE
+        finally:
+            libc.munmap(address, size)
+    finally:
+        os.close(fd)
+
+
+def drop_cached_pages(path):
+    """
+    writes back and drops the pages of the file or device, so that every case starts with a cold cache.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+class PageCacheSampler(object):
+    """
+    samples the page cache footprint of the images and the devices of a case while it copies.
+    """
+    def __init__(self, paths, interval_seconds=0.2):
+        self.paths = paths
+        self.interval_seconds = interval_seconds
+        self.peak_bytes = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def get_cached_bytes(self):
+        cached_bytes = sum(get_cached_bytes(path) for path in self.paths)
+        self.peak_bytes = max(self.peak_bytes, cached_bytes)
+        return cached_bytes
+
+    def run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            self.get_cached_bytes()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.get_cached_bytes()
+
+
+def compare_ranges(expected_path, expected_offset, actual_path, actual_offset, ranges):
+    with open(expected_path, 'rb') as expected_file, open(actual_path, 'rb') as actual_file:
+        for offset, length in ranges:
+            position = 0
+            while position < length:
+                size = min(16 * MB, length - position)
+                expected_file.seek(expected_offset + offset + position)
+                actual_file.seek(actual_offset + offset + position)
+                if expected_file.read(size) != actual_file.read(size):
+                    return False
+                position += size
+    return True
+
+
+def create_encryption_environment(work_dir, logger):
+    from EncryptionEnvironment import EncryptionEnvironment
+    encryption_environment = EncryptionEnvironment(BenchmarkPatcher(), logger)
+    config_path = encryption_environment.encryption_config_path
+    for name, value in list(vars(encryption_environment).items()):
+        if isinstance(value, str) and value.startswith(config_path):
+            setattr(encryption_environment, name, os.path.join(work_dir, value[len(config_path):]))
+    return encryption_environment
+
+
+def run_case(case):
+    """
+    runs one copy in this process and returns its measurements.
+    """
+    from DiskUtil import DiskUtil
+    from FreeSpaceMap import FreeSpaceMap
+    from OnGoingItemConfig import OnGoingItemConfig
+    from TransactionalCopyTask import TransactionalCopyTask
+
+    work_dir = case['work_dir']
+    logger = BenchmarkLogger(os.path.join(work_dir, 'copy.log'))
+    hutil = BenchmarkHandlerUtil(logger)
+    encryption_environment = create_encryption_environment(work_dir, logger)
+    disk_util = DiskUtil(hutil, BenchmarkPatcher(), logger, encryption_environment)
+    header_size = case['header_size']
+    disk_util.get_luks_header_size = lambda *args, **kwargs: header_size
+    public_settings = dict(case['public_settings'])
+
+    ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment, logger=logger)
+    ongoing_item_config.current_source_path = case['source']
+    ongoing_item_config.current_destination = case['destination']
+    ongoing_item_config.current_total_copy_size = case['total_size']
+    ongoing_item_config.current_block_size = case['block_size']
+    ongoing_item_config.current_slice_index = 0
+    ongoing_item_config.from_end = True
+    ongoing_item_config.file_system = case['file_system']
+    ongoing_item_config.luks_header_file_path = None
+    if case['direction'] == 'encrypt':
+        ongoing_item_config.phase = CommonVariables.EncryptionPhaseCopyData
+    else:
+        ongoing_item_config.phase = CommonVariables.DecryptionPhaseCopyData
+    ongoing_item_config.commit()
+
+    used_ranges = [[0, case['total_size']]]
+    if case['direction'] == 'encrypt' and case['file_system'] != 'none' \
+            and str(public_settings.get(CommonVariables.CopySkipFreeSpaceKey, False)).lower() == 'true':
+        free_space_map = FreeSpaceMap(logger, case['source'], case['file_system'])
+        if free_space_map.save(encryption_environment.copy_used_ranges_file_path):
+            with open(encryption_environment.copy_used_ranges_file_path, 'r') as f:
+                used_ranges = json.load(f)['used_ranges']
+
+    for path in case['cache_paths']:
+        drop_cached_pages(path)
+    page_cache_sampler = PageCacheSampler(case['cache_paths'])
+    page_cache_sampler.start()
+    io_before = read_proc_io()
+    start_time = time.time()
+    if case['entry'] == 'disk_util':
+        result = disk_util.copy(ongoing_item_config, status_prefix='Benchmark', public_settings=public_settings)
+    else:
+        copy_task = TransactionalCopyTask(logger=logger,
+                                          hutil=hutil,
+                                          disk_util=disk_util,
+                                          ongoing_item_config=ongoing_item_config,
+                                          patching=BenchmarkPatcher(),
+                                          encryption_environment=encryption_environment,
+                                          status_prefix='Benchmark',
+                                          public_settings=public_settings)
+        result = copy_task.begin_copy()
+    elapsed_seconds = time.time() - start_time
+    io_after = read_proc_io()
+    page_cache_bytes = page_cache_sampler.stop()
+
+    progress = {}
+    if os.path.exists(encryption_environment.copy_progress_file_path):
+        with open(encryption_environment.copy_progress_file_path, 'r') as f:
+            progress = json.load(f)
+
+    import resource
+    measurements = {
+        'result': result,
+        'elapsed_seconds': round(elapsed_seconds, 3),
+        'mb_per_second': round(case['total_size'] / float(MB) / elapsed_seconds, 1) if elapsed_seconds > 0 else None,
+        'copied_bytes': progress.get('copied_bytes'),
+        'zeroed_bytes': progress.get('zeroed_bytes'),
+        'skipped_bytes': progress.get('skipped_bytes'),
+        # the read and write family, counted by the kernel for this process and the dd it waited for
+        'read_syscalls': io_after.get('syscr', 0) - io_before.get('syscr', 0),
+        'write_syscalls': io_after.get('syscw', 0) - io_before.get('syscw', 0),
+        'storage_read_bytes': io_after.get('read_bytes', 0) - io_before.get('read_bytes', 0),
+        'storage_write_bytes': io_after.get('write_bytes', 0) - io_before.get('write_bytes', 0),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        # the pages of the images and devices left in the page cache by the copy, and the most seen during it
+        'page_cache_bytes': page_cache_bytes,
+        'page_cache_peak_bytes': page_cache_sampler.peak_bytes,
+        'status_reports': hutil.status_reports,
+    }
+    if result == CommonVariables.process_success:
+        measurements['verified'] = compare_ranges(case['expected'], 0, case['verify_path'], case['verify_offset'], used_ranges)
+    return measurements
+
+
+def run_case_process(case):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def prepare_case(case, golden_path, use_loop, loops):
+    """
+    copies the golden image for the case and fills in the source, the destination and where to verify.
+    """
+    work_dir = case['work_dir']
+    image_path = os.path.join(work_dir, 'image')
+    copy_sparse(golden_path, image_path)
+    header_size = case['header_size']
+    case['expected'] = golden_path
+
+    if case['direction'] == 'encrypt' and use_loop:
+        case['source'] = attach_loop(image_path)
+        case['destination'] = attach_loop(image_path, header_size)
+        loops.extend([case['source'], case['destination']])
+        case['verify_path'], case['verify_offset'] = image_path, header_size
+        case['cache_paths'] = [case['source'], case['destination'], image_path]
+        return
+
+    destination_path = os.path.join(work_dir, 'destination')
+    with open(destination_path, 'wb') as f:
+        f.truncate(os.path.getsize(image_path))
+    case['source'], case['destination'] = image_path, destination_path
+    case['cache_paths'] = [image_path, destination_path]
+    if use_loop:
+        case['source'], case['destination'] = attach_loop(image_path), attach_loop(destination_path)
+        loops.extend([case['source'], case['destination']])
+        # the loop devices cache the pages of their images too
+        case['cache_paths'].extend([case['source'], case['destination']])
+    case['verify_path'], case['verify_offset'] = destination_path, 0
+
+
+def run_benchmark(args):
+    for engine in args.engine or []:
+        name, settings = engine.split('=', 1)
+        register_engine(name, json.loads(settings))
+
+    # a tail leaves the last slice partial, like on most disks
+    size = args.size * MB + args.tail_kb * 1024
+    header_size = args.header_size * MB
+    work_root = tempfile.mkdtemp(prefix='copy_benchmark', dir=args.work_dir)
+    results = []
+    try:
+        for file_system in args.file_systems.split(','):
+            for fill_level in [int(fill_level) for fill_level in args.fill_levels.split(',')]:
+                golden_path = os.path.join(work_root, "{0}-{1}.img".format(file_system, fill_level))
+                build_image(golden_path, size, size - header_size, file_system, fill_level, work_root)
+                for engine in args.engines.split(','):
+                    for direction in args.directions.split(','):
+                        for entry in args.entries.split(','):
+                            case = {'file_system': file_system, 'fill_level': fill_level, 'engine': engine,
+                                    'direction': direction, 'entry': entry, 'loop': args.loop,
+                                    'image_size': size, 'total_size': size - header_size,
+                                    'header_size': header_size, 'block_size': args.block_size * MB,
+                                    'public_settings': ENGINES[engine],
+                                    'work_dir': tempfile.mkdtemp(dir=work_root)}
+                            loops = []
+                            try:
+                                prepare_case(case, golden_path, args.loop, loops)
+                                measurements = run_case_process(case)
+                            except (subprocess.CalledProcessError, OSError, ValueError) as e:
+                                measurements = {'error': str(e)}
+                            finally:
+                                for loop_path in loops:
+                                    detach_loop(loop_path)
+                                shutil.rmtree(case['work_dir'])
+                            result = dict((key, case[key]) for key in ['file_system', 'fill_level', 'engine', 'direction', 'entry',
+                                                                        'loop', 'image_size', 'total_size', 'block_size', 'public_settings'])
+                            result.update(measurements)
+                            results.append(result)
+                            sys.stderr.write("{0:6} {1:3}% {2:14} {3:8} {4:14} {5} MB/s {6} MB cached {7}\n".format(
+                                file_system, fill_level, engine, direction, entry, result.get('mb_per_second'),
+                                (result.get('page_cache_peak_bytes') or 0) // MB,
+                                result.get('error', 'verified' if result.get('verified') else 'result {0}'.format(result.get('result')))))
+                os.remove(golden_path)
+    finally:
+        shutil.rmtree(work_root)
+
+    with open(os.path.join(_MAIN_DIR, 'version.txt'), 'r') as f:
+        version = f.read().strip()
+    report = {'version': version,
+              'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'kernel': platform.release(),
+              'python': platform.python_version(),
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="benchmarks the in-place copy of disk encryption on file backed images")
+    parser.add_argument('--size', type=int, default=512, help="image size in MB")
+    parser.add_argument('--tail-kb', type=int, default=0, help="KB added to the image size, copied as a partial last slice")
+    parser.add_argument('--header-size', type=int, default=CommonVariables.luks_header_size_v2 // MB, help="LUKS header size in MB")
+    parser.add_argument('--block-size', type=int, default=CommonVariables.default_block_size // MB, help="slice size in MB")
+    parser.add_argument('--file-systems', default='ext4,xfs', help="comma separated, none for raw random data")
+    parser.add_argument('--fill-levels', default='0,50,90', help="comma separated percentages")
+    parser.add_argument('--engines', default='native,native-direct,native-cached,dd,native-skip-free', help="comma separated names of ENGINES")
+    parser.add_argument('--engine', action='append', help="adds an engine, name='{public settings json}'")
+    parser.add_argument('--directions', default=','.join(DIRECTIONS))
+    parser.add_argument('--entries', default=','.join(ENTRIES))
+    parser.add_argument('--loop', action='store_true', help="attach the images as loop devices, needs root")
+    parser.add_argument('--work-dir', default=None, help="where the images are built, on the disk to measure")
+    parser.add_argument('--output', default='copy_benchmark.json')
+    parser.add_argument('--run-case', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.run_case is not None:
+        sys.stdout.write(json.dumps(run_case(json.loads(args.run_case))) + '\n')
+    else:
+        run_benchmark(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from BlockDeviceInventory import BlockDeviceInventory
+from UdevDatabase import UdevDatabase
+from CommandExecutor import ProcessCommunicator
+
+from console_logger import ConsoleLogger
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+
+class Test_BlockDeviceInventory(unittest.TestCase):
+    """ lists a fake sysfs tree: a disk with a partition under LUKS and LVM, a second disk udev does not know, and devices lsblk leaves out """
+
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.command_executor = mock.MagicMock()
+        self.udev_database = UdevDatabase(self.logger)
+        self.udev_database.udev_data_path = os.path.join(self.temp_dir, 'udev_data')
+        self.inventory = BlockDeviceInventory(self.logger, self.command_executor, self.udev_database)
+        self.inventory.sys_block_path = os.path.join(self.temp_dir, 'sys_block')
+        self.inventory.sys_class_block_path = os.path.join(self.temp_dir, 'sys_class_block')
+        self.inventory.mountinfo_path = os.path.join(self.temp_dir, 'mountinfo')
+        self.inventory.swaps_path = os.path.join(self.temp_dir, 'swaps')
+        for path in [self.inventory.sys_block_path, self.inventory.sys_class_block_path, self.udev_database.udev_data_path]:
+            os.makedirs(path)
+
+        self._add_device('sda', '8:0', 2048, model='Virtual Disk')
+        self._add_device('sda1', '8:1', 1024, parent='sda', partition=1, holders=['dm-0'])
+        self._add_device('dm-0', '253:0', 992, dm_name='data', dm_uuid='CRYPT-LUKS2-0123-data', slaves=['sda1'], holders=['dm-1'])
+        self._add_device('dm-1', '253:1', 512, dm_name='my--vg-lv0', dm_uuid='LVM-abcdef', slaves=['dm-0'])
+        self._add_device('sdb', '8:16', 4096, model='Virtual Disk')
+        self._add_device('loop0', '7:0', 0)
+        self._add_device('ram0', '1:0', 8192)
+        self._add_udev_data('8:1', ['E:ID_FS_TYPE=crypto_LUKS', 'E:ID_FS_UUID=0123'])
+        self._add_udev_data('253:1', ['E:ID_FS_TYPE=ext4', 'E:ID_FS_UUID=4567', 'E:ID_FS_LABEL=my_data', 'E:ID_FS_LABEL_ENC=my\\x20data'])
+        self._add_udev_data('8:0', [])
+        self._add_udev_data('253:0', [])
+        with open(self.inventory.mountinfo_path, 'w') as f:
+            f.write('22 1 253:1 / /mnt/my\\040data rw,relatime shared:1 - ext4 /dev/mapper/my--vg-lv0 rw\n')
+        with open(self.inventory.swaps_path, 'w') as f:
+            f.write('Filename Type Size Used Priority\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content + '\n')
+
+    def _add_device(self, name, majmin, sectors, parent=None, partition=None, model=None, dm_name=None, dm_uuid=None, holders=(), slaves=()):
+        if parent is None:
+            device_path = os.path.join(self.inventory.sys_class_block_path, name)
+            os.makedirs(os.path.join(self.inventory.sys_block_path, name))
+        else:
+            device_path = os.path.join(self.inventory.sys_class_block_path, parent, name)
+            os.symlink(device_path, os.path.join(self.inventory.sys_class_block_path, name))
+        self._write(os.path.join(device_path, 'dev'), majmin)
+        self._write(os.path.join(device_path, 'size'), str(sectors))
+        if partition is not None:
+            self._write(os.path.join(device_path, 'partition'), str(partition))
+        if model is not None:
+            self._write(os.path.join(device_path, 'device', 'model'), model)
+        if dm_name is not None:
+            self._write(os.path.join(device_path, 'dm', 'name'), dm_name)
+            self._write(os.path.join(device_path, 'dm', 'uuid'), dm_uuid)
+        for directory, entries in [('holders', holders), ('slaves', slaves)]:
+            os.makedirs(os.path.join(device_path, directory))
+            for entry in entries:
+                os.makedirs(os.path.join(device_path, directory, entry))
+
+    def _add_udev_data(self, majmin, lines):
+        self._write(os.path.join(self.udev_database.udev_data_path, 'b' + majmin), '\n'.join(['I:1234'] + lines))
+
+    def _mock_lsblk(self, stdout):
+        def execute(command, communicator=None, **kwargs):
+            communicator.stdout = stdout
+            return 0
+        self.command_executor.Execute.side_effect = execute
+
+    def test_get_device_items(self):
+        self._mock_lsblk('KNAME="sdb" FSTYPE="xfs" LABEL="" UUID="89ab"\n')
+
+        device_items = self.inventory.get_device_items(None)
+
+        # the disks come in directory order, each followed by what is built on it
+        names = [device_item.name for device_item in device_items]
+        self.assertEqual(['sda', 'sda1', 'data', 'my-vg/lv0'], names[names.index('sda'):names.index('sda') + 4])
+        self.assertEqual(set(['sda', 'sda1', 'data', 'my-vg/lv0', 'sdb']), set(names))
+        self.assertEqual(5, len(names))
+        items = dict((device_item.name, device_item) for device_item in device_items)
+        self.assertEqual(('disk', 'Virtual Disk', 1024 * 1024, '8:0', ''), (items['sda'].type, items['sda'].model, items['sda'].size, items['sda'].majmin, items['sda'].file_system))
+        self.assertEqual(('part', '', 'crypto_LUKS', '0123'), (items['sda1'].type, items['sda1'].model, items['sda1'].file_system, items['sda1'].uuid))
+        self.assertEqual(('crypt', ''), (items['data'].type, items['data'].mount_point))
+        self.assertEqual(('lvm', 'ext4', 'my data', '/mnt/my data'), (items['my-vg/lv0'].type, items['my-vg/lv0'].file_system, items['my-vg/lv0'].label, items['my-vg/lv0'].mount_point))
+        # only the disk without a udev entry is asked from lsblk
+        self.assertEqual('xfs', items['sdb'].file_system)
+        self.assertEqual('89ab', items['sdb'].uuid)
+        self.command_executor.Execute.assert_called_once()
+        self.assertTrue(self.command_executor.Execute.call_args[0][0].endswith(' /dev/sdb'))
+
+    def test_get_device_items_of_a_device(self):
+        device_items = self.inventory.get_device_items('/dev/sda1')
+
+        self.assertEqual(['sda1', 'data', 'my-vg/lv0'], [device_item.name for device_item in device_items])
+        self.assertFalse(self.command_executor.Execute.called)
+
+    def test_unknown_device_is_left_to_lsblk(self):
+        self.assertIsNone(self.inventory.get_device_items('/dev/sdz'))
+        shutil.rmtree(self.inventory.sys_block_path)
+        self.assertIsNone(self.inventory.get_device_items(None))
+
+    def test_split_lvm_name(self):
+        self.assertEqual(('rootvg', 'rootlv'), BlockDeviceInventory.split_lvm_name('rootvg-rootlv'))
+        self.assertEqual(('my-vg', 'lv-0'), BlockDeviceInventory.split_lvm_name('my--vg-lv--0'))
+        self.assertEqual(('vg-', 'lv'), BlockDeviceInventory.split_lvm_name('vg---lv'))
+        self.assertIsNone(BlockDeviceInventory.split_lvm_name('vg-pool-tpool'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from BlockDeviceTree import BlockDeviceTree
+
+from console_logger import ConsoleLogger
+
+
+class Test_BlockDeviceTree(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.block_device_tree = BlockDeviceTree(self.logger)
+        self.block_device_tree.sys_class_block_path = os.path.join(self.temp_dir, 'class', 'block')
+        os.makedirs(self.block_device_tree.sys_class_block_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _add_device(self, device_path, holders=(), slaves=()):
+        """ device_path is relative to the devices directory, like sda/sda1 for a partition """
+        sys_device_path = os.path.join(self.temp_dir, 'devices', device_path)
+        os.makedirs(os.path.join(sys_device_path, 'holders'))
+        os.makedirs(os.path.join(sys_device_path, 'slaves'))
+        if '/' in device_path:
+            open(os.path.join(sys_device_path, 'partition'), 'w').close()
+        for holder in holders:
+            open(os.path.join(sys_device_path, 'holders', holder), 'w').close()
+        for slave in slaves:
+            open(os.path.join(sys_device_path, 'slaves', slave), 'w').close()
+        os.symlink(sys_device_path, os.path.join(self.block_device_tree.sys_class_block_path, os.path.basename(device_path)))
+
+    def test_load(self):
+        # an LVM volume on a dm-crypt device on the second partition of sda, and a RAID of sdb and sdc
+        self._add_device('sda')
+        self._add_device('sda/sda1')
+        self._add_device('sda/sda2', holders=['dm-0'])
+        self._add_device('dm-0', holders=['dm-1'], slaves=['sda2'])
+        self._add_device('dm-1', slaves=['dm-0'])
+        self._add_device('sdb', holders=['md0'])
+        self._add_device('sdc', holders=['md0'])
+        self._add_device('md0', slaves=['sdb', 'sdc'])
+        self._add_device('cciss!c0d0')
+        self.block_device_tree.load()
+
+        self.assertEqual(set(['/dev/sda', '/dev/sda1', '/dev/sda2', '/dev/dm-0', '/dev/dm-1']),
+                         self.block_device_tree.get_descendants('/dev/sda'))
+        self.assertEqual(set(['/dev/sda2', '/dev/dm-0', '/dev/dm-1']), self.block_device_tree.get_descendants('/dev/sda2'))
+        self.assertEqual(set(['/dev/sda1']), self.block_device_tree.get_descendants('/dev/sda1'))
+        self.assertEqual(set(['/dev/sdc', '/dev/md0']), self.block_device_tree.get_descendants('/dev/sdc'))
+        self.assertEqual(set(['/dev/cciss/c0d0']), self.block_device_tree.get_descendants('/dev/cciss/c0d0'))
+        self.assertIsNone(self.block_device_tree.get_descendants('/dev/sdd'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import copy_benchmark
+
+
+class Test_CopyBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.temp_dir, "report.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_report(self):
+        args = copy_benchmark.parse_args(['--size', '8', '--header-size', '1', '--block-size', '1',
+                                          '--file-systems', 'none', '--fill-levels', '50',
+                                          '--engines', 'native,buffered,dd', '--engine', 'buffered={"CopyIOMode": "buffered"}',
+                                          '--entries', 'transactional', '--work-dir', self.temp_dir,
+                                          '--output', self.output_path])
+        report = copy_benchmark.run_benchmark(args)
+
+        self.assertTrue(os.path.exists(self.output_path))
+        self.assertEqual(6, len(report['results']))
+        self.assertEqual(set(['encrypt', 'decrypt']), set(result['direction'] for result in report['results']))
+        for result in report['results']:
+            self.assertEqual(0, result['result'])
+            self.assertTrue(result['verified'])
+            self.assertEqual(7 * 1024 * 1024, result['total_size'])
+            self.assertEqual(7 * 1024 * 1024, result['copied_bytes'])
+            self.assertTrue(result['mb_per_second'] > 0)
+            self.assertTrue(result['read_syscalls'] > 0 and result['write_syscalls'] > 0)
+            self.assertTrue(result['peak_rss_kb'] > 0)
+            self.assertTrue(0 <= result['page_cache_bytes'] <= result['page_cache_peak_bytes'] <= 2 * 8 * 1024 * 1024)
+        # only the report is left behind
+        self.assertEqual(['report.json'], os.listdir(self.temp_dir))
+
+    def test_report_with_partial_last_slice(self):
+        args = copy_benchmark.parse_args(['--size', '4', '--header-size', '1', '--block-size', '1', '--tail-kb', '8',
+                                          '--file-systems', 'none', '--fill-levels', '100',
+                                          '--engines', 'dd,dd-512', '--directions', 'decrypt',
+                                          '--entries', 'transactional', '--work-dir', self.temp_dir,
+                                          '--output', self.output_path])
+        report = copy_benchmark.run_benchmark(args)
+
+        self.assertEqual(['dd', 'dd-512'], [result['engine'] for result in report['results']])
+        for result in report['results']:
+            self.assertEqual(0, result['result'])
+            self.assertTrue(result['verified'])
+            self.assertEqual(3 * 1024 * 1024 + 8 * 1024, result['copied_bytes'])
@@ -0,0 +1,54 @@
+import unittest
+
+from CopyProgress import CopyProgress
+
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+MB = 1024 * 1024
+
+
+class Test_CopyProgress(unittest.TestCase):
+    def setUp(self):
+        self.now = [1000.0]
+        time_patcher = mock.patch('CopyProgress.time')
+        time_mock = time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        time_mock.time.side_effect = lambda: self.now[0]
+
+    def _add_sample(self, progress, seconds, processed_bytes, copied_bytes):
+        self.now[0] += seconds
+        progress.add_sample(processed_bytes, copied_bytes)
+
+    def test_unknown_before_two_samples(self):
+        progress = CopyProgress(100 * MB)
+        self.assertIsNone(progress.get_copy_rate())
+        self.assertIsNone(progress.get_eta_seconds())
+        progress.add_sample(10 * MB, 0)
+        self.assertIsNone(progress.get_copy_rate())
+        self.assertIsNone(progress.get_eta_seconds())
+
+    def test_rate_and_eta(self):
+        progress = CopyProgress(100 * MB)
+        progress.add_sample(0, 0)
+        # half of the first 20 MB was free space
+        self._add_sample(progress, 1, 20 * MB, 10 * MB)
+        self.assertEqual(10 * MB, progress.get_copy_rate())
+        self.assertEqual(4, progress.get_eta_seconds())
+        self._add_sample(progress, 1, 100 * MB, 90 * MB)
+        self.assertEqual(0, progress.get_eta_seconds())
+
+    def test_rates_follow_the_window(self):
+        progress = CopyProgress(1000 * MB)
+        progress.add_sample(0, 0)
+        for i in range(1, 7):
+            self._add_sample(progress, 10, i * 100 * MB, i * 100 * MB)
+        self.assertEqual(10 * MB, progress.get_copy_rate())
+        # slowed down to 1 MB/s, the samples older than a minute stop counting
+        for i in range(1, 7):
+            self._add_sample(progress, 10, 600 * MB + i * 10 * MB, 600 * MB + i * 10 * MB)
+        self.assertEqual(1 * MB, progress.get_copy_rate())
+        self.assertEqual(340, progress.get_eta_seconds())
+        self.assertEqual(7, len(progress.samples))
@@ -0,0 +1,46 @@
+import unittest
+
+from CopyRateLimiter import CopyRateLimiter
+
+from console_logger import ConsoleLogger
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+
+class Test_CopyRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.now = [1000.0]
+        self.sleeps = []
+        time_patcher = mock.patch('CopyRateLimiter.time')
+        time_mock = time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        time_mock.time.side_effect = lambda: self.now[0]
+        time_mock.sleep.side_effect = self._sleep
+
+    def _sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now[0] += seconds
+
+    def test_burst_is_not_paced(self):
+        limiter = CopyRateLimiter(self.logger, 100, 200)
+        self.assertEqual(0, limiter.consume(150))
+        self.assertEqual(0, limiter.consume(50))
+        self.assertEqual([], self.sleeps)
+
+    def test_debt_is_paid_off(self):
+        limiter = CopyRateLimiter(self.logger, 100, 100)
+        # bigger than the burst, waits for the 200 bytes over it
+        self.assertEqual(2.0, limiter.consume(300))
+        self.assertEqual(1.0, limiter.consume(100))
+        self.assertEqual(3.0, limiter.waited_seconds)
+        self.assertEqual(400 / 3.0, limiter.get_achieved_rate())
+
+    def test_bucket_refills_up_to_burst(self):
+        limiter = CopyRateLimiter(self.logger, 100, 100)
+        limiter.consume(100)
+        self.now[0] += 10
+        self.assertEqual(0, limiter.consume(100))
+        self.assertEqual(0.5, limiter.consume(50))
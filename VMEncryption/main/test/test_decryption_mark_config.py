@@ -83,6 +83,7 @@ class TestDecryptionMarkConfig(unittest.TestCase):
             with patch('DecryptionMarkConfig.CommonVariables') as mock_common_vars:
                 mock_common_vars.EncryptionEncryptionOperationKey = 'EncryptionOperation'
                 mock_common_vars.EncryptionVolumeTypeKey = 'VolumeType'
+                mock_common_vars.EncryptionModeKey = 'EncryptionMode'
                 
                 mock_config_instance = Mock()
                 mock_config_util.return_value = mock_config_instance
@@ -90,6 +91,7 @@ class TestDecryptionMarkConfig(unittest.TestCase):
                 dmc = DecryptionMarkConfig(self.mock_logger, self.mock_encryption_environment)
                 dmc.command = 'Disable'
                 dmc.volume_type = 'OS'
+                dmc.decryption_mode = 'Online'
                 
                 dmc.commit()
                 
@@ -97,8 +99,8 @@ class TestDecryptionMarkConfig(unittest.TestCase):
                 mock_config_instance.save_configs.assert_called_once()
                 call_args = mock_config_instance.save_configs.call_args[0][0]
                 
-                # Check that we have 2 key-value pairs
-                self.assertEqual(len(call_args), 2)
+                # Check that we have 3 key-value pairs
+                self.assertEqual(len(call_args), 3)
                 
                 # Check command key-value pair
                 command_pair = call_args[0]
@@ -109,6 +111,11 @@ class TestDecryptionMarkConfig(unittest.TestCase):
                 volume_type_pair = call_args[1]
                 self.assertEqual(volume_type_pair.prop_name, 'VolumeType')
                 self.assertEqual(volume_type_pair.prop_value, 'OS')
+
+                # Check decryption_mode key-value pair
+                decryption_mode_pair = call_args[2]
+                self.assertEqual(decryption_mode_pair.prop_name, 'EncryptionMode')
+                self.assertEqual(decryption_mode_pair.prop_value, 'Online')
                 
     def test_commit_with_none_values(self):
         """Test committing configuration with None values."""
@@ -116,6 +123,7 @@ class TestDecryptionMarkConfig(unittest.TestCase):
             with patch('DecryptionMarkConfig.CommonVariables') as mock_common_vars:
                 mock_common_vars.EncryptionEncryptionOperationKey = 'EncryptionOperation'
                 mock_common_vars.EncryptionVolumeTypeKey = 'VolumeType'
+                mock_common_vars.EncryptionModeKey = 'EncryptionMode'
                 
                 mock_config_instance = Mock()
                 mock_config_util.return_value = mock_config_instance
@@ -129,8 +137,8 @@ class TestDecryptionMarkConfig(unittest.TestCase):
                 mock_config_instance.save_configs.assert_called_once()
                 call_args = mock_config_instance.save_configs.call_args[0][0]
                 
-                # Check that we have 2 key-value pairs with None values
-                self.assertEqual(len(call_args), 2)
+                # Check that we have 3 key-value pairs with None values
+                self.assertEqual(len(call_args), 3)
                 
                 command_pair = call_args[0]
                 self.assertEqual(command_pair.prop_name, 'EncryptionOperation')
@@ -139,6 +147,8 @@ class TestDecryptionMarkConfig(unittest.TestCase):
                 volume_type_pair = call_args[1]
                 self.assertEqual(volume_type_pair.prop_name, 'VolumeType')
                 self.assertIsNone(volume_type_pair.prop_value)
+
+                self.assertIsNone(call_args[2].prop_value)
                 
     def test_clear_config_success(self):
         """Test successfully clearing configuration."""
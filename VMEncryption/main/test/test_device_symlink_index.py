@@ -0,0 +1,60 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from DeviceSymlinkIndex import DeviceSymlinkIndex
+
+from console_logger import ConsoleLogger
+
+
+class Test_DeviceSymlinkIndex(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.dev_path = os.path.join(self.temp_dir, 'dev')
+        self.azure_root = os.path.join(self.dev_path, 'disk', 'azure')
+        self.by_uuid_root = os.path.join(self.dev_path, 'disk', 'by-uuid')
+        os.makedirs(os.path.join(self.azure_root, 'scsi1'))
+        os.makedirs(self.by_uuid_root)
+        for device in ['sda', 'sda1', 'sdc', 'sdc1']:
+            open(os.path.join(self.dev_path, device), 'w').close()
+        self._link('sda', os.path.join(self.azure_root, 'root'))
+        self._link('sdc', os.path.join(self.azure_root, 'scsi1', 'lun0'))
+        self._link('sdc1', os.path.join(self.azure_root, 'scsi1', 'lun0-part1'))
+        self._link('sda1', os.path.join(self.by_uuid_root, '1111'))
+        self._link('sdc1', os.path.join(self.by_uuid_root, '2222'))
+        self._link('sdc1', os.path.join(self.by_uuid_root, '3333'))
+        self.symlink_index = DeviceSymlinkIndex(self.logger, [self.azure_root, self.by_uuid_root,
+                                                              os.path.join(self.dev_path, 'mapper')])
+        self.symlink_index.load()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _link(self, device, link_path):
+        os.symlink(os.path.join(self.dev_path, device), link_path)
+
+    def _dev(self, device):
+        return os.path.realpath(os.path.join(self.dev_path, device))
+
+    def test_get_links(self):
+        self.assertEqual([os.path.join(self.azure_root, 'scsi1', 'lun0-part1')], self.symlink_index.get_links(self.azure_root, self._dev('sdc1')))
+        self.assertEqual([os.path.join(self.azure_root, 'root')], self.symlink_index.get_links(self.azure_root, self._dev('sda')))
+        self.assertEqual(set([os.path.join(self.by_uuid_root, '2222'), os.path.join(self.by_uuid_root, '3333')]),
+                         set(self.symlink_index.get_links(self.by_uuid_root, self._dev('sdc1'))))
+        self.assertEqual([], self.symlink_index.get_links(self.by_uuid_root, self._dev('sdc')))
+        self.assertEqual([], self.symlink_index.get_links(os.path.join(self.dev_path, 'mapper'), self._dev('sdc')))
+
+    def test_get_realpath(self):
+        self.assertEqual(self._dev('sda1'), self.symlink_index.get_realpath(os.path.join(self.by_uuid_root, '1111')))
+        self.assertIsNone(self.symlink_index.get_realpath(os.path.join(self.by_uuid_root, '4444')))
+
+    def test_get_table(self):
+        self.assertEqual({self._dev('sda'): os.path.join(self.azure_root, 'root'),
+                          self._dev('sdc'): os.path.join(self.azure_root, 'scsi1', 'lun0'),
+                          self._dev('sdc1'): os.path.join(self.azure_root, 'scsi1', 'lun0-part1')},
+                         self.symlink_index.get_table(self.azure_root))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+import os
+import threading
+import time
+import shutil
+import tempfile
+
+from DeviceTopologyCache import DeviceTopologyCache
+from UdevDatabase import UdevDatabase
+
+from console_logger import ConsoleLogger
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+
+class Test_DeviceTopologyCache(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        udev_database = UdevDatabase(self.logger)
+        udev_database.udev_data_path = os.path.join(self.temp_dir, 'udev_data')
+        os.makedirs(udev_database.udev_data_path)
+        self.topology_cache = DeviceTopologyCache(self.logger, udev_database)
+        self.topology_cache.uevent_seqnum_path = os.path.join(self.temp_dir, 'uevent_seqnum')
+        self._set_uevent_seqnum(100)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _set_uevent_seqnum(self, seqnum):
+        with open(self.topology_cache.uevent_seqnum_path, 'w') as f:
+            f.write('{0}\n'.format(seqnum))
+
+    def test_get(self):
+        compute = mock.Mock(side_effect=[['sda'], ['sda', 'sdb'], ['sda', 'sdb', 'sdc'], ['sdb']])
+
+        self.assertEqual(['sda'], self.topology_cache.get('devices', compute))
+        self.assertEqual(['sda'], self.topology_cache.get('devices', compute))
+        self.assertEqual(1, compute.call_count)
+
+        # the kernel sent a uevent
+        self._set_uevent_seqnum(101)
+        self.assertEqual(['sda', 'sdb'], self.topology_cache.get('devices', compute))
+        self.assertEqual(['sda', 'sdb'], self.topology_cache.get('devices', compute))
+
+        # this process changed the devices
+        DeviceTopologyCache.note_command(['mkfs.ext4', '/dev/sdc'])
+        self.assertEqual(['sda', 'sdb', 'sdc'], self.topology_cache.get('devices', compute))
+
+        # udev updated its database
+        os.utime(self.topology_cache.udev_database.udev_data_path, (1, 1))
+        self.assertEqual(['sdb'], self.topology_cache.get('devices', compute))
+        self.assertEqual(4, compute.call_count)
+
+    def test_get_error(self):
+        compute = mock.Mock(side_effect=[Exception('lsblk failed'), ['sda']])
+        self.assertRaises(Exception, self.topology_cache.get, 'devices', compute)
+        self.assertEqual(['sda'], self.topology_cache.get('devices', compute))
+
+    def test_is_mutating_command(self):
+        self.assertTrue(DeviceTopologyCache.is_mutating_command(['cryptsetup', 'luksOpen', '/dev/sdc', 'data']))
+        self.assertTrue(DeviceTopologyCache.is_mutating_command(['mount', '/dev/mapper/data', '/data']))
+        self.assertTrue(DeviceTopologyCache.is_mutating_command(['/sbin/mkfs.xfs', '/dev/mapper/data']))
+        self.assertTrue(DeviceTopologyCache.is_mutating_command(['bash', '-c', 'set -e; umount /data && cryptsetup luksClose data']))
+        self.assertFalse(DeviceTopologyCache.is_mutating_command(['cryptsetup', 'isLuks', '/dev/sdc']))
+        self.assertFalse(DeviceTopologyCache.is_mutating_command(['dmsetup', 'deps', '-o', 'blkdevname', 'osencrypt']))
+        self.assertFalse(DeviceTopologyCache.is_mutating_command(['lsblk', '-b', '-n', '-P']))
+        self.assertFalse(DeviceTopologyCache.is_mutating_command(['bash', '-c', 'pvdisplay | grep /dev/mapper/osencrypt']))
+        self.assertFalse(DeviceTopologyCache.is_mutating_command(['tune2fs', '-l', '/dev/sdc1']))
+        self.assertTrue(DeviceTopologyCache.is_mutating_command(['lvcreate', '-l', '100%FREE', '-n', 'data', 'datavg']))
+        self.assertTrue(DeviceTopologyCache.is_mutating_command(['sudo', '-n', 'mount', '/dev/sdc1', '/data']))
+        self.assertTrue(DeviceTopologyCache.is_mutating_command(['mdadm', '--create', '/dev/md0', '--level=0', '--raid-devices=2', '/dev/sdc', '/dev/sdd']))
+        self.assertTrue(DeviceTopologyCache.is_mutating_command(['bash', '-c', 'echo ",,L" | sfdisk /dev/sdc']))
+        self.assertTrue(DeviceTopologyCache.is_mutating_command(['fdisk', '/dev/sdc']))
+        self.assertFalse(DeviceTopologyCache.is_mutating_command(['mdadm', '--detail', '/dev/md0']))
+        self.assertFalse(DeviceTopologyCache.is_mutating_command(['sfdisk', '-d', '/dev/sdc']))
+        self.assertFalse(DeviceTopologyCache.is_mutating_command(['fdisk', '-l', '/dev/sdc']))
+
+    def test_is_mutating_script(self):
+        def is_mutating_script(script):
+            return DeviceTopologyCache.is_mutating_command(['bash', '-c', script])
+
+        # a read only command does not hide the mutating ones around it
+        self.assertTrue(is_mutating_script('lsblk; parted -s /dev/sdc mkpart primary 0% 100%'))
+        self.assertTrue(is_mutating_script('blkid /dev/sdc1 && mkfs.ext4 /dev/sdc1'))
+        self.assertTrue(is_mutating_script('cryptsetup isLuks /dev/sdc || cryptsetup luksFormat /dev/sdc'))
+        self.assertTrue(is_mutating_script('findmnt -n -o TARGET /dev/sdc1 | xargs -r umount'))
+        self.assertTrue(is_mutating_script('set -e; (cd /tmp && mount -a)'))
+        self.assertFalse(is_mutating_script('cryptsetup isLuks /dev/sdc && cryptsetup luksDump /dev/sdc'))
+        self.assertFalse(is_mutating_script('echo "mount; mkfs" > /tmp/note; cat /tmp/note'))
+        self.assertFalse(is_mutating_script("findmnt -n -o SOURCE / 2>&1"))
+        # scripts that cannot be split are taken as mutating
+        self.assertTrue(is_mutating_script('lsblk $(blkid -U 1111)'))
+        self.assertTrue(is_mutating_script('lsblk `blkid -U 1111`'))
+        self.assertTrue(is_mutating_script('lsblk "/dev/sdc'))
+
+    def test_get_concurrently(self):
+        computed = []
+
+        def compute():
+            computed.append(threading.current_thread().name)
+            time.sleep(0.01)
+            # a command of another volume changes the devices
+            DeviceTopologyCache.note_command(['mount', '/dev/mapper/data', '/data'])
+            return ['sda']
+
+        results = []
+        workers = [threading.Thread(target=lambda: results.append(self.topology_cache.get('devices', compute))) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([['sda']] * 4, results)
+        # the devices changed while every value was computed, so none was kept
+        self.assertEqual(4, len(computed))
+        self.assertEqual({}, self.topology_cache.entries)
+
+if __name__ == '__main__':
+    unittest.main()
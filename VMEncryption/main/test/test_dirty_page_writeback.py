@@ -0,0 +1,88 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from DirtyPageWriteback import DirtyPageWriteback
+from Common import CommonVariables
+
+from console_logger import ConsoleLogger
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+WAIT_AND_WRITE = CommonVariables.SYNC_FILE_RANGE_WAIT_BEFORE | CommonVariables.SYNC_FILE_RANGE_WRITE \
+    | CommonVariables.SYNC_FILE_RANGE_WAIT_AFTER
+
+
+class Test_DirtyPageWriteback(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.calls = []
+
+    def _create_writeback(self, limit):
+        writeback = DirtyPageWriteback(self.logger, limit)
+        writeback.sync_file_range = lambda fd, offset, length, flags: self.calls.append((fd, offset, length, flags)) or 0
+        return writeback
+
+    def test_merge_ranges(self):
+        self.assertEqual([[0, 300], [400, 100]], DirtyPageWriteback.merge_ranges([(200, 100), (0, 100), (100, 100), (400, 100)]))
+        self.assertEqual([[0, 150]], DirtyPageWriteback.merge_ranges([(0, 100), (50, 100)]))
+
+    def test_writeback_starts_at_half_the_limit_and_waits_for_the_half_before(self):
+        writeback = self._create_writeback(1000)
+        writeback.add(3, 900, 100)
+        writeback.add(3, 800, 100)
+        writeback.add(3, 700, 100)
+        writeback.add(3, 600, 100)
+        self.assertEqual([], self.calls)
+
+        writeback.add(3, 500, 100)
+        self.assertEqual([(3, 500, 500, CommonVariables.SYNC_FILE_RANGE_WRITE)], self.calls)
+
+        del self.calls[:]
+        for offset in [400, 300, 200, 100, 0]:
+            writeback.add(3, offset, 100)
+        self.assertEqual([(3, 0, 500, CommonVariables.SYNC_FILE_RANGE_WRITE), (3, 500, 500, WAIT_AND_WRITE)], self.calls)
+        self.assertEqual(1000, writeback.written_back_bytes)
+
+    def test_synced_device_starts_over(self):
+        writeback = self._create_writeback(1000)
+        writeback.add(3, 0, 400)
+        writeback.synced(3)
+        writeback.add(3, 400, 400)
+        self.assertEqual([], self.calls)
+        # every device is counted on its own
+        writeback.add(4, 0, 400)
+        self.assertEqual([], self.calls)
+
+    def test_sync_file_range_failure(self):
+        writeback = DirtyPageWriteback(self.logger, 1000)
+        writeback.sync_file_range = lambda fd, offset, length, flags: -1
+        with self.assertRaises(OSError):
+            writeback.add(3, 0, 500)
+
+    @mock.patch('DirtyPageWriteback.os.fdatasync')
+    def test_fdatasync_without_sync_file_range(self, fdatasync_mock):
+        writeback = DirtyPageWriteback(self.logger, 1000)
+        writeback.sync_file_range = None
+        writeback.add(3, 0, 500)
+        writeback.add(3, 500, 400)
+        self.assertFalse(fdatasync_mock.called)
+        writeback.add(3, 900, 100)
+        fdatasync_mock.assert_called_once_with(3)
+        writeback.add(3, 1000, 900)
+        self.assertEqual(1, fdatasync_mock.call_count)
+
+    @unittest.skipIf(DirtyPageWriteback.load_sync_file_range() is None, "needs sync_file_range")
+    def test_sync_file_range_on_file(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        fd = os.open(os.path.join(temp_dir, "destination"), os.O_WRONLY | os.O_CREAT, 0o600)
+        self.addCleanup(os.close, fd)
+        writeback = DirtyPageWriteback(self.logger, 8192)
+        for offset in range(0, 5 * 4096, 4096):
+            os.pwrite(fd, b'\xa5' * 4096, offset)
+            writeback.add(fd, offset, 4096)
+        self.assertEqual(5 * 4096, writeback.written_back_bytes)
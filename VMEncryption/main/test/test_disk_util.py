@@ -7,6 +7,7 @@ from EncryptionEnvironment import EncryptionEnvironment
 from Common import DeviceItem
 from Common import CommonVariables
 from CommandExecutor import CommandExecutor
+from DeviceTopologyCache import DeviceTopologyCache
 
 from console_logger import ConsoleLogger
 from test_utils import mock_dir_structure, MockDistroPatcher
@@ -308,6 +309,17 @@ Tokens:
         header_size = self.disk_util.get_luks_header_size()
         self.assertEqual(header_size, CommonVariables.luks_header_size_v2)
 
+    @mock.patch("DiskUtil.DiskUtil._get_cryptsetup_version")
+    def test_supports_online_decryption(self, ver_mock):
+        ver_mock.return_value = "cryptsetup 2.1.0"
+        self.assertFalse(self.disk_util.supports_online_decryption("/boot/luks/dataheader"))
+        ver_mock.return_value = "cryptsetup 2.4.3"
+        self.assertTrue(self.disk_util.supports_online_decryption("/boot/luks/dataheader"))
+        # moving the header out of the device needs 2.6.0
+        self.assertFalse(self.disk_util.supports_online_decryption())
+        ver_mock.return_value = "cryptsetup 2.6.1"
+        self.assertTrue(self.disk_util.supports_online_decryption())
+
     @mock.patch("DiskUtil.DiskUtil._luks_get_header_dump")
     def test_get_luks_header_size_luks1(self, lghd_mock):
         lghd_mock.return_value = """
@@ -416,3 +428,71 @@ Digests:
         dump_mock.return_value = ""
         header_size = self.disk_util.get_luks_header_size("/mocked/device/path")
         self.assertEqual(header_size, None)
+
+    @mock.patch('UdevDatabase.UdevDatabase.get_device_id', return_value="")
+    @mock.patch('DiskUtil.DiskUtil.get_lvm_items', return_value=[])
+    def test_get_device_items_falls_back_to_lsblk(self, lvm_items_mock, device_id_mock):
+        sysfs_item = self._create_device_item(name="sdc", type="disk")
+        with mock.patch.object(self.disk_util.block_device_inventory, 'get_device_items', return_value=[sysfs_item]), \
+                mock.patch.object(self.disk_util.command_executor, 'Execute') as execute_mock:
+            self.assertEqual(['sdc'], [device_item.name for device_item in self.disk_util.get_device_items(None)])
+        self.assertFalse(execute_mock.called)
+
+        def execute(command, communicator=None, **kwargs):
+            communicator.stdout = 'NAME="sdd" TYPE="disk" FSTYPE="ext4" MOUNTPOINT="" LABEL="" UUID="0123" MODEL="Virtual Disk" SIZE="1024" MAJ:MIN="8:48"\n'
+            return 0
+        with mock.patch.object(self.disk_util.block_device_inventory, 'get_device_items', return_value=None), \
+                mock.patch.object(self.disk_util.command_executor, 'Execute', side_effect=execute):
+            device_items = self.disk_util.get_device_items('/dev/sdd')
+        self.assertEqual(['sdd'], [device_item.name for device_item in device_items])
+        self.assertEqual('0123', device_items[0].uuid)
+
+    def test_get_device_items_cached(self):
+        sysfs_item = self._create_device_item(name="sdc", type="disk")
+        with mock.patch.object(self.disk_util.block_device_inventory, 'get_device_items', return_value=[sysfs_item]) as inventory_mock:
+            device_items = self.disk_util.get_device_items(None)
+            device_items.append(self._create_device_item(name="sdd", type="disk"))
+            # the callers change the items they get
+            device_items[0].mount_point = '/data'
+            device_items = self.disk_util.get_device_items(None)
+            self.assertEqual(['sdc'], [device_item.name for device_item in device_items])
+            self.assertIsNot(sysfs_item, device_items[0])
+            self.assertIsNone(device_items[0].mount_point)
+            self.assertEqual(1, inventory_mock.call_count)
+
+            DeviceTopologyCache.note_command(['umount', '/data'])
+            self.assertEqual(['sdc'], [device_item.name for device_item in self.disk_util.get_device_items(None)])
+            self.assertEqual(2, inventory_mock.call_count)
+
+            DeviceTopologyCache.note_command(['sfdisk', '/dev/sdc'])
+            self.disk_util.get_device_items(None)
+            self.assertEqual(3, inventory_mock.call_count)
+
+    def test_get_persistent_path_by_sdx_path(self):
+        symlink_index = mock.Mock()
+        links = {
+            (CommonVariables.azure_symlinks_dir, '/dev/sdc'): ['/dev/disk/azure/scsi1/lun0'],
+            (CommonVariables.dev_mapper_root, '/dev/dm-0'): ['/dev/mapper/rootvg-rootlv'],
+            (CommonVariables.disk_by_uuid_root, '/dev/dm-0'): ['/dev/disk/by-uuid/1111'],
+            (CommonVariables.disk_by_uuid_root, '/dev/sdd1'): ['/dev/disk/by-uuid/2222'],
+        }
+        symlink_index.get_links.side_effect = lambda link_root, realpath: links.get((link_root, realpath), [])
+        with mock.patch.object(self.disk_util, 'get_device_symlink_index', return_value=symlink_index), \
+                mock.patch('os.path.realpath', side_effect=lambda path: path):
+            self.assertEqual('/dev/disk/azure/scsi1/lun0', self.disk_util.get_persistent_path_by_sdx_path('/dev/sdc'))
+            self.assertEqual('/dev/mapper/rootvg-rootlv', self.disk_util.get_persistent_path_by_sdx_path('/dev/dm-0'))
+            self.assertEqual('/dev/disk/by-uuid/2222', self.disk_util.get_persistent_path_by_sdx_path('/dev/sdd1'))
+            self.assertEqual('/dev/sde', self.disk_util.get_persistent_path_by_sdx_path('/dev/sde'))
+
+    def test_is_parent_of_any(self):
+        block_device_tree = mock.Mock()
+        block_device_tree.get_descendants.side_effect = lambda dev_path: {'/dev/sdc': set(['/dev/sdc', '/dev/sdc1', '/dev/dm-0'])}.get(dev_path)
+        with mock.patch.object(self.disk_util, 'get_block_device_tree', return_value=block_device_tree), \
+                mock.patch.object(self.disk_util, 'get_device_items', return_value=[]) as get_device_items_mock:
+            self.assertTrue(self.disk_util.is_parent_of_any('/dev/sdc', set(['/dev/dm-0', '/dev/dm-1'])))
+            self.assertFalse(self.disk_util.is_parent_of_any('/dev/sdc', set(['/dev/sdd1'])))
+            self.assertFalse(get_device_items_mock.called)
+
+            # sysfs does not know the device
+            self.assertFalse(self.disk_util.is_parent_of_any('/dev/sdd', set(['/dev/sdd1'])))
+            get_device_items_mock.assert_called_once_with('/dev/sdd')
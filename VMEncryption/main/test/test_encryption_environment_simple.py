@@ -71,5 +71,48 @@ class TestEncryptionEnvironmentSimple(unittest.TestCase):
         self.assertIsInstance(env.default_bek_filename, str)
 
 
+    def test_get_item_environment(self):
+        """Test that the state of an ongoing item is kept in a folder of its own."""
+        import shutil
+        import tempfile
+        from EncryptionEnvironment import EncryptionEnvironment
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        env = EncryptionEnvironment(self.mock_patching, self.mock_logger)
+        env.ongoing_items_path = os.path.join(work_dir, 'ongoing_items')
+
+        item_env = env.get_item_environment('sdc1')
+        item_path = os.path.join(env.ongoing_items_path, 'sdc1')
+        self.assertTrue(os.path.isdir(item_path))
+        for path in [item_env.azure_crypt_ongoing_item_config_path, item_env.copy_header_slice_file_path,
+                     item_env.copy_slice_item_backup_file, item_env.copy_slice_item_journal_file,
+                     item_env.copy_slice_checksum_file, item_env.copy_stripe_journal_file,
+                     item_env.copy_stripe_guard_file, item_env.copy_used_ranges_file_path,
+                     item_env.copy_progress_file_path]:
+            self.assertEqual(os.path.dirname(path), item_path)
+        # the settings shared by all the items are unchanged
+        self.assertEqual(item_env.encryption_config_file_path, env.encryption_config_file_path)
+        self.assertEqual(env.azure_crypt_ongoing_item_config_path,
+                         '/var/lib/azure_disk_encryption_config/azure_crypt_ongoing_item.ini')
+
+    def test_get_ongoing_item_environments(self):
+        """Test that only the items with an ongoing item config are resumed."""
+        import shutil
+        import tempfile
+        from EncryptionEnvironment import EncryptionEnvironment
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        env = EncryptionEnvironment(self.mock_patching, self.mock_logger)
+        env.ongoing_items_path = os.path.join(work_dir, 'ongoing_items')
+        self.assertEqual(env.get_ongoing_item_environments(), [])
+
+        for item_id in ['sdd1', 'sdc1', 'sde1']:
+            item_env = env.get_item_environment(item_id)
+            if item_id != 'sde1':
+                open(item_env.azure_crypt_ongoing_item_config_path, 'w').close()
+        item_envs = env.get_ongoing_item_environments()
+        self.assertEqual([os.path.basename(os.path.dirname(item_env.azure_crypt_ongoing_item_config_path)) for item_env in item_envs],
+                         ['sdc1', 'sdd1'])
+
 if __name__ == '__main__':
     unittest.main()
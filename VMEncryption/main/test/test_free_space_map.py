@@ -0,0 +1,185 @@
+import unittest
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+from FreeSpaceMap import FreeSpaceMap, UsedRanges
+
+from console_logger import ConsoleLogger
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+
+def find_executable(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep) + ['/sbin', '/usr/sbin']:
+        if os.path.exists(os.path.join(path, name)):
+            return os.path.join(path, name)
+    return None
+
+
+class Test_FreeSpaceMap(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.image_path = os.path.join(self.temp_dir, "image")
+        self.map_path = os.path.join(self.temp_dir, "copy_used_ranges.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_xfs_image(self, version, block_size=4096, ag_blocks=64, ag_count=2, free_extents=None):
+        """
+        writes the superblock, the AGFs and a two level by-block-number free space btree per allocation group.
+        """
+        header_size = 56 if version == 5 else 16
+        magic = b'AB3B' if version == 5 else b'ABTB'
+        sector_size = 512
+        image = bytearray(ag_blocks * ag_count * block_size)
+
+        struct.pack_into('>4sI', image, 0, b'XFSB', block_size)
+        struct.pack_into('>Q', image, 0x8, ag_blocks * ag_count)
+        struct.pack_into('>2I', image, 0x54, ag_blocks, ag_count)
+        struct.pack_into('>2H', image, 0x64, version, sector_size)
+
+        for ag in range(ag_count):
+            ag_offset = ag * ag_blocks * block_size
+            struct.pack_into('>4s', image, ag_offset + sector_size, b'XAGF')
+            # root node in block 4, two leaves in blocks 5 and 6
+            struct.pack_into('>I', image, ag_offset + sector_size + 0x10, 4)
+            struct.pack_into('>I', image, ag_offset + sector_size + 0x1C, 2)
+
+            leaves = [free_extents[ag][:1], free_extents[ag][1:]]
+            root = ag_offset + 4 * block_size
+            struct.pack_into('>4s2H', image, root, magic, 1, len(leaves))
+            max_records = (block_size - header_size) // 12
+            for i, leaf_records in enumerate(leaves):
+                struct.pack_into('>2I', image, root + header_size + i * 8, leaf_records[0][0], leaf_records[0][1])
+                struct.pack_into('>I', image, root + header_size + max_records * 8 + i * 4, 5 + i)
+                leaf = ag_offset + (5 + i) * block_size
+                struct.pack_into('>4s2H', image, leaf, magic, 0, len(leaf_records))
+                for j, record in enumerate(leaf_records):
+                    struct.pack_into('>2I', image, leaf + header_size + j * 8, record[0], record[1])
+
+        with open(self.image_path, 'wb') as f:
+            f.write(image)
+
+    def test_merge_ranges(self):
+        self.assertEqual([[0, 30], [40, 10]], FreeSpaceMap.merge_ranges([(10, 20), (0, 10), (40, 10), (15, 5), (50, 0)]))
+
+    def test_used_ranges_overlap(self):
+        used_ranges = UsedRanges([[4096, 4096], [65536, 512]])
+        self.assertFalse(used_ranges.is_used(0, 4096))
+        self.assertTrue(used_ranges.is_used(0, 4097))
+        self.assertTrue(used_ranges.is_used(8000, 100))
+        self.assertFalse(used_ranges.is_used(8192, 65536 - 8192))
+        self.assertTrue(used_ranges.is_used(65536 + 511, 4096))
+        self.assertFalse(used_ranges.is_used(65536 + 512, 4096))
+        self.assertFalse(used_ranges.is_used(4096, 0))
+
+    @mock.patch('FreeSpaceMap.FreeSpaceMap.is_xfs_log_clean', return_value=True)
+    def test_xfs_free_space_btree(self, log_clean_mock):
+        for version in [4, 5]:
+            self._write_xfs_image(version, free_extents=[[(10, 6), (20, 44)], [(0, 0), (8, 56)]])
+            used_ranges = FreeSpaceMap(self.logger, self.image_path, 'xfs').get_used_ranges()
+            self.assertEqual([[0, 10 * 4096], [16 * 4096, 4 * 4096], [64 * 4096, 8 * 4096]], used_ranges)
+
+    @mock.patch('FreeSpaceMap.FreeSpaceMap.is_xfs_log_clean', return_value=True)
+    def test_xfs_bad_btree_block(self, log_clean_mock):
+        self._write_xfs_image(5, free_extents=[[(10, 6), (20, 44)], [(0, 0), (8, 56)]])
+        with open(self.image_path, 'r+b') as f:
+            f.seek(5 * 4096)
+            f.write(b'XXXX')
+        self.assertRaises(ValueError, FreeSpaceMap(self.logger, self.image_path, 'xfs').get_used_ranges)
+        # saving falls back to copying everything
+        self.assertFalse(FreeSpaceMap(self.logger, self.image_path, 'xfs').save(self.map_path))
+        self.assertFalse(os.path.exists(self.map_path))
+
+    def test_xfs_dirty_log(self):
+        self._write_xfs_image(5, free_extents=[[(10, 6), (20, 44)], [(0, 0), (8, 56)]])
+        free_space_map = FreeSpaceMap(self.logger, self.image_path, 'xfs')
+
+        def logprint(state, return_code=0):
+            def execute(command, communicator=None, **kwargs):
+                communicator.stdout = '    data device: 0x800\n    log device: 0x800 daddr: 2097160 length: 20480\n\n' \
+                                      '    log tail: 451 head: 466 state: {0}\n'.format(state)
+                return return_code
+            return execute
+
+        with mock.patch.object(free_space_map.command_executor, 'Execute', side_effect=logprint('<DIRTY>')) as execute_mock:
+            self.assertIsNone(free_space_map.get_used_ranges())
+            self.assertFalse(free_space_map.save(self.map_path))
+            self.assertFalse(os.path.exists(self.map_path))
+        self.assertEqual('xfs_logprint -t ' + self.image_path, execute_mock.call_args[0][0])
+        # xfs_logprint missing or failing counts as dirty
+        with mock.patch.object(free_space_map.command_executor, 'Execute', side_effect=logprint('<CLEAN>', 1)):
+            self.assertIsNone(free_space_map.get_used_ranges())
+        with mock.patch.object(free_space_map.command_executor, 'Execute', side_effect=logprint('<CLEAN>')):
+            self.assertEqual([[0, 10 * 4096], [16 * 4096, 4 * 4096], [64 * 4096, 8 * 4096]], free_space_map.get_used_ranges())
+
+    def test_unsupported_file_system(self):
+        self._write_xfs_image(5, free_extents=[[(10, 6), (20, 44)], [(0, 0), (8, 56)]])
+        with open(self.map_path, 'w') as f:
+            f.write('stale')
+        self.assertIsNone(FreeSpaceMap(self.logger, self.image_path, 'btrfs').get_used_ranges())
+        self.assertFalse(FreeSpaceMap(self.logger, self.image_path, 'btrfs').save(self.map_path))
+        self.assertFalse(os.path.exists(self.map_path))
+
+    @mock.patch('FreeSpaceMap.FreeSpaceMap.is_xfs_log_clean', return_value=True)
+    def test_save_and_load(self, log_clean_mock):
+        self._write_xfs_image(4, free_extents=[[(10, 6), (20, 44)], [(0, 0), (8, 56)]])
+        self.assertTrue(FreeSpaceMap(self.logger, self.image_path, 'xfs').save(self.map_path))
+
+        used_ranges = FreeSpaceMap.load(self.map_path, self.image_path)
+        self.assertTrue(used_ranges.is_used(0, 4096))
+        self.assertFalse(used_ranges.is_used(10 * 4096, 6 * 4096))
+        # a map saved for another device is not used
+        self.assertIsNone(FreeSpaceMap.load(self.map_path, '/dev/sdz'))
+        FreeSpaceMap.remove(self.map_path)
+        self.assertIsNone(FreeSpaceMap.load(self.map_path, self.image_path))
+
+    @unittest.skipIf(find_executable('mke2fs') is None or find_executable('debugfs') is None, "e2fsprogs is not installed")
+    def test_ext4_bitmaps(self):
+        data_path = os.path.join(self.temp_dir, "data")
+        with open(data_path, 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024))
+
+        for options in [[], ['-O', '^flex_bg'], ['-t', 'ext2'], ['-b', '1024'], ['-O', 'meta_bg,^resize_inode']]:
+            with open(self.image_path, 'wb') as f:
+                f.truncate(512 * 1024 * 1024)
+            subprocess.check_call([find_executable('mke2fs'), '-q', '-F'] + options + [self.image_path])
+            subprocess.check_call([find_executable('debugfs'), '-w', '-R', 'write {0} data'.format(data_path), self.image_path],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = subprocess.check_output([find_executable('dumpe2fs'), '-h', self.image_path], stderr=subprocess.PIPE).decode()
+            fields = dict(line.split(':', 1) for line in output.splitlines() if ':' in line)
+            block_size = int(fields['Block size'])
+            expected_used = (int(fields['Block count']) - int(fields['Free blocks'])) * block_size
+
+            used_ranges = FreeSpaceMap(self.logger, self.image_path, 'ext4').get_used_ranges()
+            used_size = sum(length for _, length in used_ranges)
+            # bitmaps are scanned a byte at a time, so a few partial bytes round up
+            self.assertTrue(expected_used <= used_size < expected_used + 64 * 8 * block_size, "{0}: {1} {2}".format(options, expected_used, used_size))
+            self.assertTrue(used_size < 64 * 1024 * 1024)
+
+    @unittest.skipIf(find_executable('mke2fs') is None, "e2fsprogs is not installed")
+    def test_ext4_not_cleanly_unmounted(self):
+        superblock_offset = FreeSpaceMap.ext_superblock_offset
+        for position, field_format, flag, clear in [(0x60, '<I', FreeSpaceMap.ext_feature_incompat_recover, False),
+                                                    (0x3A, '<H', FreeSpaceMap.ext_state_valid, True),
+                                                    (0x3A, '<H', FreeSpaceMap.ext_state_error, False)]:
+            with open(self.image_path, 'wb') as f:
+                f.truncate(64 * 1024 * 1024)
+            subprocess.check_call([find_executable('mke2fs'), '-q', '-F', '-t', 'ext4', self.image_path])
+            self.assertIsNotNone(FreeSpaceMap(self.logger, self.image_path, 'ext4').get_used_ranges())
+
+            with open(self.image_path, 'r+b') as f:
+                f.seek(superblock_offset + position)
+                value = struct.unpack(field_format, f.read(struct.calcsize(field_format)))[0]
+                f.seek(superblock_offset + position)
+                f.write(struct.pack(field_format, value & ~flag if clear else value | flag))
+            self.assertIsNone(FreeSpaceMap(self.logger, self.image_path, 'ext4').get_used_ranges())
+            self.assertFalse(FreeSpaceMap(self.logger, self.image_path, 'ext4').save(self.map_path))
+            self.assertFalse(os.path.exists(self.map_path))
@@ -362,6 +362,42 @@ class TestHandleEncryptionFunctions(unittest.TestCase):
             )
             self.assertFalse(result)
 
+    def test_should_perform_online_decryption(self):
+        """Test should_perform_online_decryption needs the opt-in, a cryptsetup that can do it and LUKS2 on every volume"""
+        with patch.object(handle, 'DistroPatcher', self.mock_distro_patcher), \
+             patch.object(handle, 'security_Type', CommonVariables.Standard), \
+             patch.object(handle, 'get_public_settings', return_value={CommonVariables.OnlineDecryptionKey: 'true'}), \
+             patch.object(handle, 'logger', self.mock_logger):
+
+            crypt_item = Mock()
+            crypt_item.dev_path = '/dev/sdc1'
+            crypt_item.luks_header_path = None
+            mock_disk_util = Mock()
+            mock_disk_util.supports_online_decryption.return_value = True
+            mock_disk_util.get_luks_version.return_value = "2"
+            self.assertTrue(handle.should_perform_online_decryption(mock_disk_util, [crypt_item]))
+
+            mock_disk_util.get_luks_version.return_value = "1"
+            self.assertFalse(handle.should_perform_online_decryption(mock_disk_util, [crypt_item]))
+
+            mock_disk_util.get_luks_version.return_value = "2"
+            mock_disk_util.supports_online_decryption.return_value = False
+            self.assertFalse(handle.should_perform_online_decryption(mock_disk_util, [crypt_item]))
+
+            mock_disk_util.supports_online_decryption.return_value = True
+            crypt_item.luks_header_path = '/boot/luks/dataheader'
+            self.assertTrue(handle.should_perform_online_decryption(mock_disk_util, [crypt_item]))
+            mock_disk_util.supports_online_decryption.assert_called_with('/boot/luks/dataheader')
+
+            # off unless asked for
+            with patch.object(handle, 'get_public_settings', return_value={}):
+                self.assertFalse(handle.should_perform_online_decryption(mock_disk_util, [crypt_item]))
+            with patch.object(handle, 'get_public_settings', return_value={CommonVariables.OnlineDecryptionKey: False}):
+                self.assertFalse(handle.should_perform_online_decryption(mock_disk_util, [crypt_item]))
+
+            self.mock_distro_patcher.support_online_encryption = False
+            self.assertFalse(handle.should_perform_online_decryption(mock_disk_util, [crypt_item]))
+
     def test_is_confidential_temp_disk_encryption_true(self):
         """Test is_confidential_temp_disk_encryption returns True"""
         with patch.object(handle, 'security_Type', CommonVariables.ConfidentialVM), \
@@ -390,6 +426,176 @@ class TestHandleEncryptionFunctions(unittest.TestCase):
             result = handle.is_confidential_temp_disk_encryption()
             self.assertFalse(result)
 
+    def test_get_encryption_parallel_volumes(self):
+        """Test the parallelism limit read from the public settings"""
+        with patch.object(handle, 'logger', self.mock_logger):
+            with patch.object(handle, 'get_public_settings', return_value={}):
+                self.assertEqual(handle.get_encryption_parallel_volumes(), 1)
+            with patch.object(handle, 'get_public_settings', return_value={CommonVariables.EncryptionParallelVolumesKey: '8'}):
+                self.assertEqual(handle.get_encryption_parallel_volumes(), 8)
+            with patch.object(handle, 'get_public_settings', return_value={CommonVariables.EncryptionParallelVolumesKey: 0}):
+                self.assertEqual(handle.get_encryption_parallel_volumes(), 1)
+            with patch.object(handle, 'get_public_settings', return_value={CommonVariables.EncryptionParallelVolumesKey: 'many'}):
+                self.assertEqual(handle.get_encryption_parallel_volumes(), CommonVariables.encryption_parallel_volumes)
+
+    def test_encrypt_in_parallel_limits_volumes_in_flight(self):
+        """Test that encrypt_in_parallel encrypts every item with at most parallel_volumes at once"""
+        import threading
+        import time
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+        done = []
+
+        def encrypt_item(item_num, item):
+            with lock:
+                in_flight.append(item)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(item)
+                done.append((item_num, item))
+            return True
+
+        items = ['sdc', 'sdd', 'sde', 'sdf', 'sdg']
+        with patch.object(handle, 'logger', self.mock_logger):
+            self.assertIsNone(handle.encrypt_in_parallel(encrypt_item, items, 2))
+        self.assertEqual(sorted(done), list(enumerate(items)))
+        self.assertEqual(max(max_in_flight), 2)
+
+    def test_encrypt_in_parallel_stops_after_failure(self):
+        """Test that no item is started once one has failed"""
+        started = []
+
+        def encrypt_item(item_num, item):
+            started.append(item)
+            if item == 'sdd':
+                return False
+            return True
+
+        with patch.object(handle, 'logger', self.mock_logger):
+            self.assertEqual(handle.encrypt_in_parallel(encrypt_item, ['sdc', 'sdd', 'sde'], 1), 'sdd')
+
+            def raise_error(item_num, item):
+                raise OSError('device is gone')
+
+            self.assertEqual(handle.encrypt_in_parallel(raise_error, ['sdc', 'sdd'], 1), 'sdc')
+        self.assertEqual(started, ['sdc', 'sdd'])
+
+    def test_enable_encryption_all_in_place_keeps_volumes_apart(self):
+        """Test that volumes encrypted at once get an ongoing item config of their own"""
+        import tempfile
+        import shutil
+        from EncryptionEnvironment import EncryptionEnvironment
+        from Common import DeviceItem
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        environment = EncryptionEnvironment(None, self.mock_logger)
+        environment.ongoing_items_path = os.path.join(work_dir, 'ongoing_items')
+        device_items = []
+        for name in ['sdc1', 'sdd1', 'sde1']:
+            device_item = DeviceItem()
+            device_item.name = name
+            device_item.mount_point = ''
+            device_items.append(device_item)
+        encryption_marker = Mock()
+        encryption_marker.get_encryption_mode.return_value = None
+        environments = {}
+        status_hutils = {}
+
+        def encrypt_inplace(**kwargs):
+            environments[kwargs['device_item'].name] = kwargs['item_environment']
+            status_hutils[kwargs['device_item'].name] = kwargs['status_hutil']
+            return CommonVariables.EncryptionPhaseDone
+
+        with patch.object(handle, 'hutil', self.mock_hutil), \
+             patch.object(handle, 'logger', self.mock_logger), \
+             patch.object(handle, 'encryption_environment', environment), \
+             patch.object(handle, 'get_public_settings', return_value={CommonVariables.EncryptionParallelVolumesKey: 2}), \
+             patch.object(handle, 'find_all_devices_to_encrypt', return_value=device_items), \
+             patch.object(handle, 'are_disks_stamped_with_current_config', return_value=True), \
+             patch.object(handle, 'encrypt_inplace_without_separate_header_file', side_effect=encrypt_inplace):
+            self.assertIsNone(handle.enable_encryption_all_in_place(passphrase_file='/tmp/bek',
+                                                                    encryption_marker=encryption_marker,
+                                                                    disk_util=Mock(),
+                                                                    crypt_mount_config_util=Mock(),
+                                                                    bek_util=Mock(),
+                                                                    os_items_to_stamp=[]))
+            self.assertEqual(sorted(environments.keys()), ['sdc1', 'sdd1', 'sde1'])
+            config_paths = set(item_environment.azure_crypt_ongoing_item_config_path for item_environment in environments.values())
+            self.assertEqual(len(config_paths), 3)
+            self.assertNotIn(environment.azure_crypt_ongoing_item_config_path, config_paths)
+            # one status for all of them
+            self.assertEqual(sorted(status_hutil.volume_num for status_hutil in status_hutils.values()), [0, 1, 2])
+            self.assertEqual(len(set(status_hutil.volume_status_report for status_hutil in status_hutils.values())), 1)
+
+            # a single volume at a time keeps the legacy ongoing item config
+            environments.clear()
+            with patch.object(handle, 'get_public_settings', return_value={CommonVariables.EncryptionParallelVolumesKey: 1}):
+                handle.enable_encryption_all_in_place(passphrase_file='/tmp/bek',
+                                                      encryption_marker=encryption_marker,
+                                                      disk_util=Mock(),
+                                                      crypt_mount_config_util=Mock(),
+                                                      bek_util=Mock(),
+                                                      os_items_to_stamp=[])
+            self.assertEqual(list(environments.values()), [None, None, None])
+            self.assertEqual(list(status_hutils.values()), [None, None, None])
+
+    def test_decrypt_inplace_copy_data(self):
+        """Test that the decryption copies the data and restores the mount point"""
+        from Common import CryptItem, DeviceItem
+        crypt_item = CryptItem()
+        crypt_item.dev_path = '/dev/sdc1'
+        crypt_item.mapper_name = 'data'
+        crypt_item.mount_point = '/mnt/data'
+        raw_device_item = DeviceItem()
+        raw_device_item.size = 1024 * 1024 * 1024 + CommonVariables.luks_header_size_v2
+        mapper_device_item = DeviceItem()
+        mapper_device_item.size = 1024 * 1024 * 1024
+        disk_util = Mock()
+        disk_util.get_luks_header_size.return_value = CommonVariables.luks_header_size_v2
+        disk_util.copy.return_value = CommonVariables.process_success
+        crypt_mount_config_util = Mock()
+        ongoing_item_config = Mock()
+        ongoing_item_config.get_phase.return_value = CommonVariables.DecryptionPhaseCopyData
+        ongoing_item_config.get_mount_point.return_value = '/mnt/data'
+        status_hutil = Mock()
+
+        with patch.object(handle, 'logger', self.mock_logger), \
+             patch.object(handle, 'get_public_settings', return_value={}):
+            result = handle.decrypt_inplace_without_separate_header_file(passphrase_file='/tmp/bek',
+                                                                         crypt_item=crypt_item,
+                                                                         raw_device_item=raw_device_item,
+                                                                         mapper_device_item=mapper_device_item,
+                                                                         disk_util=disk_util,
+                                                                         crypt_mount_config_util=crypt_mount_config_util,
+                                                                         status_prefix='Decrypting data volume 1/1',
+                                                                         ongoing_item_config=ongoing_item_config,
+                                                                         status_hutil=status_hutil)
+            self.assertEqual(result, CommonVariables.DecryptionPhaseDone)
+            disk_util.copy.assert_called_once_with(ongoing_item_config=ongoing_item_config,
+                                                   status_prefix='Decrypting data volume 1/1',
+                                                   public_settings={},
+                                                   hutil=status_hutil)
+            crypt_mount_config_util.restore_mount_info.assert_called_once_with('/mnt/data')
+            ongoing_item_config.clear_config.assert_called_once_with()
+
+            # a failed copy keeps the ongoing item config to resume from
+            disk_util.copy.reset_mock()
+            disk_util.copy.return_value = CommonVariables.process_success + 1
+            ongoing_item_config.reset_mock()
+            result = handle.decrypt_inplace_with_separate_header_file(passphrase_file='/tmp/bek',
+                                                                      crypt_item=crypt_item,
+                                                                      raw_device_item=mapper_device_item,
+                                                                      mapper_device_item=mapper_device_item,
+                                                                      disk_util=disk_util,
+                                                                      crypt_mount_config_util=crypt_mount_config_util,
+                                                                      ongoing_item_config=ongoing_item_config)
+            self.assertEqual(result, CommonVariables.DecryptionPhaseCopyData)
+            self.assertIsNone(disk_util.copy.call_args[1]['hutil'])
+            self.assertFalse(ongoing_item_config.clear_config.called)
+
+
 class TestHandleUtilityFunctions(unittest.TestCase):
     """Test cases for low-level utility functions that don't require complex mocking"""
     
@@ -0,0 +1,163 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from IOLoadThrottle import IOLoadThrottle
+from Common import CommonVariables
+
+from console_logger import ConsoleLogger
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+
+class Test_IOLoadThrottle(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.sys_block_path = tempfile.mkdtemp()
+        # sdc with the partitions sdc1 and sdc2, dm-0 on sdc1, and an idle sdd
+        for path in ['sdc/sdc1', 'sdc/sdc2', 'sdd', 'dm-0/slaves/sdc1']:
+            os.makedirs(os.path.join(self.sys_block_path, path))
+        self.stats = {'sdc': [0] * 17, 'sdd': [0] * 17}
+        self._write_stats()
+        self.proc_path = tempfile.mkdtemp()
+        self.now = [1000.0]
+        time_patcher = mock.patch('IOLoadThrottle.time')
+        time_mock = time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        time_mock.time.side_effect = lambda: self.now[0]
+        self.sleep_mock = time_mock.sleep
+
+    def tearDown(self):
+        shutil.rmtree(self.sys_block_path)
+        shutil.rmtree(self.proc_path)
+
+    def _write_stats(self):
+        for disk_name, fields in self.stats.items():
+            with open(os.path.join(self.sys_block_path, disk_name, 'stat'), 'w') as f:
+                f.write(' '.join(str(field) for field in fields) + '\n')
+
+    def _add_io(self, disk_name, ios, latency_ms, queue_depth, size=0):
+        fields = self.stats[disk_name]
+        fields[0] += ios
+        fields[2] += size // IOLoadThrottle.sector_size
+        fields[3] += ios * latency_ms
+        fields[10] += int(queue_depth * IOLoadThrottle.sample_interval * 1000)
+        self._write_stats()
+
+    def _write_process_io(self, pid, read_bytes, write_bytes):
+        if not os.path.isdir(os.path.join(self.proc_path, str(pid))):
+            os.makedirs(os.path.join(self.proc_path, str(pid)))
+        with open(os.path.join(self.proc_path, str(pid), 'io'), 'w') as f:
+            f.write('rchar: 0\nwchar: 0\nread_bytes: {0}\nwrite_bytes: {1}\ncancelled_write_bytes: 0\n'.format(read_bytes, write_bytes))
+
+    def _create_throttle(self, device_names=None):
+        return IOLoadThrottle(self.logger, device_names or ['/dev/sdc1'], 20, 8, sys_block_path=self.sys_block_path, proc_path=self.proc_path)
+
+    def _sample(self, throttle):
+        self.now[0] += IOLoadThrottle.sample_interval
+        return throttle.update()
+
+    def test_disk_names(self):
+        throttle = self._create_throttle(['/dev/sdc1', '/dev/dm-0', '/dev/sdd', '/dev/sdz'])
+        self.assertEqual(['sdc', 'sdd'], throttle.disk_names)
+        self.assertEqual(['sdc'], throttle.get_disk_names('dm-0'))
+        self.assertEqual([], throttle.get_disk_names('sdz'))
+
+    def test_backs_off_and_speeds_up(self):
+        throttle = self._create_throttle()
+        self.assertEqual(1.0, throttle.update())
+
+        # the latency of the sibling partition counts, it is the same disk
+        self._add_io('sdc', 100, 40, 1)
+        self.assertEqual(0.5, self._sample(throttle))
+        self._add_io('sdc', 100, 5, 16)
+        self.assertEqual(0.25, self._sample(throttle))
+        # between half the target and the target
+        self._add_io('sdc', 100, 15, 1)
+        self.assertEqual(0.25, self._sample(throttle))
+        self._add_io('sdc', 100, 5, 1)
+        self.assertAlmostEqual(0.35, self._sample(throttle))
+        # idle
+        self.assertAlmostEqual(0.45, self._sample(throttle))
+
+    def test_samples_once_per_interval(self):
+        throttle = self._create_throttle()
+        throttle.update()
+        self._add_io('sdc', 100, 40, 1)
+        self.now[0] += IOLoadThrottle.sample_interval / 2.0
+        self.assertEqual(1.0, throttle.update())
+        self.now[0] += IOLoadThrottle.sample_interval / 2.0
+        self.assertEqual(0.5, throttle.update())
+
+    def test_duty_cycle_floor(self):
+        throttle = self._create_throttle()
+        throttle.update()
+        for _ in range(10):
+            self._add_io('sdc', 100, 40, 1)
+            self._sample(throttle)
+        self.assertEqual(IOLoadThrottle.min_duty_cycle, throttle.duty_cycle)
+
+    def test_pace(self):
+        throttle = self._create_throttle()
+        self.assertEqual(0, throttle.pace(2.0))
+        self._add_io('sdc', 100, 40, 1)
+        self.now[0] += IOLoadThrottle.sample_interval
+        self.assertEqual(2.0, throttle.pace(2.0))
+        self.sleep_mock.assert_called_once_with(2.0)
+        self.assertEqual(2.0, throttle.throttled_seconds)
+
+        # the caller sleeps the pause it takes
+        self.sleep_mock.reset_mock()
+        self._add_io('sdc', 100, 40, 1)
+        self.now[0] += IOLoadThrottle.sample_interval
+        self.assertEqual(6.0, throttle.take_pause(2.0))
+        self.assertFalse(self.sleep_mock.called)
+        self.assertEqual(8.0, throttle.throttled_seconds)
+
+    def test_own_io_is_not_load(self):
+        os.makedirs(os.path.join(self.sys_block_path, 'sdc', 'queue'))
+        with open(os.path.join(self.sys_block_path, 'sdc', 'queue', 'max_sectors_kb'), 'w') as f:
+            f.write('1024\n')
+        throttle = self._create_throttle()
+        self.assertEqual(1024 * 1024, throttle.max_request_bytes)
+        throttle.watch_process(1234)
+        self._write_process_io(1234, 0, 0)
+        throttle.update()
+        throttle.duty_cycle = 0.5
+
+        # the copy alone, 100 requests of 1 MB, is slow and deep without anyone waiting on it
+        self._write_process_io(1234, 50 * 1024 * 1024, 50 * 1024 * 1024)
+        self._add_io('sdc', 100, 40, 16, 100 * 1024 * 1024)
+        self.assertAlmostEqual(0.6, self._sample(throttle))
+
+        # 20 requests of the others behind 80 of the copy's
+        self._write_process_io(1234, 90 * 1024 * 1024, 90 * 1024 * 1024)
+        self._add_io('sdc', 100, 40, 20, 80 * 1024 * 1024 + 20 * 4096)
+        latency_ms, queue_depth = throttle.get_load(throttle.read_stats(), IOLoadThrottle.sample_interval, 80 * 1024 * 1024)
+        self.assertEqual(40, latency_ms)
+        self.assertAlmostEqual(4, queue_depth)
+        self.assertAlmostEqual(0.3, self._sample(throttle))
+
+        # the dd of the copy is gone by the next sample, a cryptsetup started after the last one did all of its I/O since
+        throttle.add_own_io(10 * 1024 * 1024)
+        throttle.watch_process(1235)
+        self._write_process_io(1235, 5 * 1024 * 1024, 5 * 1024 * 1024)
+        self.now[0] += IOLoadThrottle.sample_interval
+        self.assertEqual(20 * 1024 * 1024, throttle.get_own_bytes_since_last_sample())
+        self.assertEqual(0, throttle.get_own_bytes_since_last_sample())
+
+    def test_create(self):
+        self.assertIsNone(IOLoadThrottle.create(self.logger, None, ['/dev/sdc1']))
+        self.assertIsNone(IOLoadThrottle.create(self.logger, {CommonVariables.CopyAdaptiveThrottleKey: 'false'}, ['/dev/sdc1']))
+        # regular files have no disk statistics
+        self.assertIsNone(IOLoadThrottle.create(self.logger, {CommonVariables.CopyAdaptiveThrottleKey: 'true'}, [self.sys_block_path]))
+
+        with mock.patch.object(IOLoadThrottle, 'get_disk_names', return_value=['sdc']):
+            throttle = IOLoadThrottle.create(self.logger, {CommonVariables.CopyAdaptiveThrottleKey: 'True',
+                                                           CommonVariables.CopyThrottleTargetLatencyMsKey: '10',
+                                                           CommonVariables.CopyThrottleTargetQueueDepthKey: 'deep'}, ['/dev/sdc1'])
+        self.assertEqual(['sdc'], throttle.disk_names)
+        self.assertEqual((10.0, CommonVariables.copy_throttle_target_queue_depth), (throttle.target_latency_ms, throttle.target_queue_depth))
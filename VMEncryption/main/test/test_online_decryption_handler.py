@@ -0,0 +1,251 @@
+import unittest
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from OnlineDecryptionHandler import OnlineDecryptionHandler
+from OnlineEncryptionHandler import OnlineEncryptionItem
+from Common import CommonVariables, CryptItem
+from DiskUtil import DiskUtil
+from EncryptionEnvironment import EncryptionEnvironment
+
+from console_logger import ConsoleLogger
+from test_utils import MockDistroPatcher
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+
+def find_executable(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep) + ['/sbin', '/usr/sbin']:
+        if os.path.exists(os.path.join(path, name)):
+            return os.path.join(path, name)
+    return None
+
+
+def get_cryptsetup_version():
+    if find_executable('cryptsetup') is None:
+        return None
+    try:
+        output = subprocess.check_output([find_executable('cryptsetup'), '--version']).decode()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    match = re.search(r'(\d+)\.(\d+)\.(\d+)', output)
+    return tuple(int(part) for part in match.groups()) if match else None
+
+
+def can_decrypt_loop_device():
+    # moving the header out of the device needs cryptsetup 2.6.0, and the loop device and the mapper need root
+    cryptsetup_version = get_cryptsetup_version()
+    return (hasattr(os, 'geteuid') and os.geteuid() == 0 and find_executable('losetup') is not None and
+            os.path.exists('/dev/mapper/control') and cryptsetup_version is not None and cryptsetup_version >= (2, 6, 0))
+
+
+class Test_OnlineDecryptionHandler(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.encryption_environment = mock.MagicMock()
+        self.encryption_environment.luks_header_base_path = os.path.join(self.temp_dir, 'azureluksheader')
+        self.encryption_environment.cleartext_key_base_path = os.path.join(self.temp_dir, 'cleartext_key')
+        self.handler = OnlineDecryptionHandler(self.logger, self.encryption_environment)
+        self.disk_util = mock.MagicMock()
+        self.disk_util.luks_check_reencryption.return_value = False
+        self.disk_util.is_luks_device.return_value = True
+        self.disk_util.get_luks_version.return_value = "2"
+        self.disk_util.supports_online_decryption.return_value = True
+        self.crypt_mount_config_util = mock.MagicMock()
+        self.moved_header_path = self.encryption_environment.luks_header_base_path + 'data'
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _create_crypt_item(self, luks_header_path=None, mount_point='/mnt/data'):
+        crypt_item = CryptItem()
+        crypt_item.dev_path = '/dev/disk/azure/scsi1/lun0-part1'
+        crypt_item.mapper_name = 'data'
+        crypt_item.luks_header_path = luks_header_path
+        crypt_item.mount_point = mount_point
+        crypt_item.uses_cleartext_key = True
+        return crypt_item
+
+    def test_handle_moves_header_out_and_starts_decryption(self):
+        crypt_item = self._create_crypt_item()
+
+        with mock.patch.object(self.handler.command_executor, 'ExecuteInBash', return_value=CommonVariables.success) as execute_mock:
+            self.assertIsNone(self.handler.handle([crypt_item], self.disk_util, self.crypt_mount_config_util))
+
+        execute_mock.assert_called_once_with('cryptsetup reencrypt --decrypt --init-only --header {0} {1} -d {2} -q'.format(
+            self.moved_header_path, crypt_item.dev_path, self.encryption_environment.cleartext_key_base_path + 'data'))
+        self.assertEqual(self.moved_header_path, crypt_item.luks_header_path)
+        self.crypt_mount_config_util.update_crypt_item.assert_called_once_with(crypt_item)
+        item = self.handler.devices.get_nowait()
+        self.assertEqual(crypt_item, item.crypt_item)
+        self.assertEqual(self.encryption_environment.cleartext_key_base_path + 'data', item.bek_file_path)
+
+    def test_handle_keeps_separate_header(self):
+        crypt_item = self._create_crypt_item(luks_header_path='/boot/luks/dataheader')
+
+        with mock.patch.object(self.handler.command_executor, 'ExecuteInBash', return_value=CommonVariables.success) as execute_mock:
+            self.assertIsNone(self.handler.handle([crypt_item], self.disk_util, self.crypt_mount_config_util))
+
+        self.assertIn('--header /boot/luks/dataheader ', execute_mock.call_args[0][0])
+        self.assertFalse(self.crypt_mount_config_util.update_crypt_item.called)
+        self.assertEqual(1, self.handler.devices.qsize())
+
+    def test_handle_resumes_with_moved_header(self):
+        # the header was moved out before the crypt item was updated
+        with open(self.moved_header_path, 'w') as f:
+            f.write('header')
+        crypt_item = self._create_crypt_item()
+        self.disk_util.luks_check_reencryption.return_value = True
+
+        with mock.patch.object(self.handler.command_executor, 'ExecuteInBash') as execute_mock:
+            self.assertIsNone(self.handler.handle([crypt_item], self.disk_util, self.crypt_mount_config_util))
+
+        self.assertFalse(execute_mock.called)
+        self.disk_util.luks_check_reencryption.assert_called_once_with(crypt_item.dev_path, self.moved_header_path)
+        self.assertEqual(self.moved_header_path, crypt_item.luks_header_path)
+        self.crypt_mount_config_util.update_crypt_item.assert_called_once_with(crypt_item)
+        self.assertEqual(1, self.handler.devices.qsize())
+
+    def test_handle_finds_decrypted_volume(self):
+        crypt_item = self._create_crypt_item(luks_header_path=self.moved_header_path)
+        self.disk_util.is_luks_device.return_value = False
+
+        self.assertIsNone(self.handler.handle([crypt_item], self.disk_util, self.crypt_mount_config_util))
+        self.assertTrue(self.handler.devices.empty())
+        self.assertEqual([crypt_item], self.handler.decrypted_items)
+
+    def test_handle_failures(self):
+        crypt_item = self._create_crypt_item()
+        self.disk_util.get_luks_version.return_value = "1"
+        self.assertEqual(crypt_item, self.handler.handle([crypt_item], self.disk_util, self.crypt_mount_config_util))
+
+        self.disk_util.get_luks_version.return_value = "2"
+        with mock.patch.object(self.handler.command_executor, 'ExecuteInBash', return_value=1):
+            self.assertEqual(crypt_item, self.handler.handle([crypt_item], self.disk_util, self.crypt_mount_config_util))
+        self.assertIsNone(crypt_item.luks_header_path)
+        self.assertTrue(self.handler.devices.empty())
+
+    def test_handle_unsupported_cryptsetup(self):
+        crypt_item = self._create_crypt_item()
+        self.disk_util.supports_online_decryption.return_value = False
+
+        with mock.patch.object(self.handler.command_executor, 'ExecuteInBash') as execute_mock:
+            self.assertEqual(crypt_item, self.handler.handle([crypt_item], self.disk_util, self.crypt_mount_config_util))
+
+        self.disk_util.supports_online_decryption.assert_called_once_with(None)
+        self.assertFalse(execute_mock.called)
+        self.assertIsNone(crypt_item.luks_header_path)
+        self.assertTrue(self.handler.devices.empty())
+
+    @mock.patch('OnlineDecryptionHandler.OnlineEncryptionResumer')
+    def test_handle_resume_decryption(self, resumer_mock):
+        crypt_items = [self._create_crypt_item(), self._create_crypt_item()]
+        for crypt_item in crypt_items:
+            self.handler.devices.put(OnlineEncryptionItem(crypt_item, '/mnt/key'))
+        results = [True, False]
+        lock = threading.Lock()
+
+        def begin_resume(*args, **kwargs):
+            with lock:
+                return results.pop(0)
+        resumer_mock.return_value.begin_resume.side_effect = begin_resume
+
+        self.handler.handle_resume_decryption(self.disk_util)
+
+        self.assertEqual(2, resumer_mock.call_count)
+        self.assertTrue(all(c[1]['decrypt'] for c in resumer_mock.call_args_list))
+        self.assertEqual(1, len(self.handler.decrypted_items))
+        self.assertEqual(1, len(self.handler.failed_items))
+
+    def test_finish_decryption(self):
+        with open(self.moved_header_path, 'w') as f:
+            f.write('header')
+        decrypted_item = self._create_crypt_item(luks_header_path=self.moved_header_path)
+        failed_item = self._create_crypt_item(mount_point='None')
+        self.handler.decrypted_items = [decrypted_item]
+        self.handler.failed_items = [failed_item]
+
+        self.assertEqual(failed_item, self.handler.finish_decryption(self.crypt_mount_config_util))
+        self.crypt_mount_config_util.restore_mount_info.assert_called_once_with('/mnt/data')
+        self.crypt_mount_config_util.remove_crypt_item.assert_called_once_with(decrypted_item, '/mnt/data/.azure_ade_backup_mount_info/')
+        self.assertFalse(os.path.exists(self.moved_header_path))
+
+
+@unittest.skipIf(not can_decrypt_loop_device(), "needs root, losetup, device mapper and cryptsetup 2.6.0 or later")
+class Test_OnlineDecryptionHandler_LoopDevice(unittest.TestCase):
+    """
+    decrypts a LUKS2 volume on a loop device with the real cryptsetup, moving its header out and shifting the data back
+    to the start of the device while the mapper stays open.
+    """
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.image_path = os.path.join(self.temp_dir, "image")
+        with open(self.image_path, 'wb') as f:
+            f.truncate(64 * 1024 * 1024)
+        self.loop_device = subprocess.check_output([find_executable('losetup'), '-f', '--show', self.image_path]).decode().strip()
+        self.mapper_name = 'ade_test_{0}'.format(os.getpid())
+        self.mapper_path = os.path.join(CommonVariables.dev_mapper_root, self.mapper_name)
+
+        self.encryption_environment = EncryptionEnvironment(None, self.logger)
+        self.encryption_environment.luks_header_base_path = os.path.join(self.temp_dir, 'azureluksheader')
+        self.encryption_environment.cleartext_key_base_path = os.path.join(self.temp_dir, 'cleartext_key')
+        self.encryption_environment.resume_daemon_status_file_path = os.path.join(self.temp_dir, 'resume_daemon_status-')
+        self.key_file = self.encryption_environment.cleartext_key_base_path + self.mapper_name
+        with open(self.key_file, 'wb') as f:
+            f.write(os.urandom(32))
+
+        cryptsetup = find_executable('cryptsetup')
+        subprocess.check_call([cryptsetup, 'luksFormat', '--type', 'luks2', '--pbkdf', 'pbkdf2', '--pbkdf-force-iterations', '1000',
+                               '-q', self.loop_device, '-d', self.key_file])
+        subprocess.check_call([cryptsetup, 'open', self.loop_device, self.mapper_name, '-d', self.key_file])
+        self.data = os.urandom(4 * 1024 * 1024)
+        with open(self.mapper_path, 'r+b') as f:
+            f.write(self.data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        distro_patcher = MockDistroPatcher('Ubuntu', '22.04', '5.15')
+        distro_patcher.cryptsetup_path = cryptsetup
+        self.disk_util = DiskUtil(None, distro_patcher, self.logger, self.encryption_environment)
+        self.crypt_mount_config_util = mock.MagicMock()
+
+    def tearDown(self):
+        if os.path.exists(self.mapper_path):
+            subprocess.call([find_executable('cryptsetup'), 'close', self.mapper_name])
+        subprocess.call([find_executable('losetup'), '-d', self.loop_device])
+        shutil.rmtree(self.temp_dir)
+
+    def test_decrypt_online(self):
+        crypt_item = CryptItem()
+        crypt_item.dev_path = self.loop_device
+        crypt_item.mapper_name = self.mapper_name
+        crypt_item.luks_header_path = None
+        crypt_item.mount_point = 'None'
+        crypt_item.uses_cleartext_key = True
+        handler = OnlineDecryptionHandler(self.logger, self.encryption_environment)
+
+        self.assertIsNone(handler.handle([crypt_item], self.disk_util, self.crypt_mount_config_util))
+        self.assertEqual(handler.get_moved_header_path(crypt_item), crypt_item.luks_header_path)
+        handler.handle_resume_decryption(self.disk_util)
+
+        self.assertEqual([crypt_item], handler.decrypted_items)
+        self.assertFalse(self.disk_util.is_luks_device(self.loop_device, None))
+        with open(self.loop_device, 'rb') as f:
+            self.assertEqual(self.data, f.read(len(self.data)))
+        with open(self.mapper_path, 'rb') as f:
+            self.assertEqual(self.data, f.read(len(self.data)))
+
+        self.assertIsNone(handler.finish_decryption(self.crypt_mount_config_util))
+        self.assertFalse(os.path.exists(handler.get_moved_header_path(crypt_item)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import unittest
+import os
+import shutil
+import signal
+import tempfile
+
+from OnlineEncryptionResumer import OnlineEncryptionResumer
+from Common import CryptItem
+from DeviceTopologyCache import DeviceTopologyCache
+
+from console_logger import ConsoleLogger
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+
+class Test_OnlineEncryptionResumer(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.sys_block_path = tempfile.mkdtemp()
+        crypt_item = CryptItem()
+        crypt_item.dev_path = '/dev/sdc1'
+        crypt_item.mapper_name = 'data'
+        self.resumer = OnlineEncryptionResumer(crypt_item, mock.MagicMock(), '/mnt/bek', self.logger, None)
+        self.resumer.sys_block_path = self.sys_block_path
+        self.proc_path = tempfile.mkdtemp()
+        self.resumer.proc_path = self.proc_path
+
+    def tearDown(self):
+        shutil.rmtree(self.sys_block_path)
+        shutil.rmtree(self.proc_path)
+        OnlineEncryptionResumer.stopped_pids.clear()
+
+    def _add_process(self, pid, state, args):
+        os.makedirs(os.path.join(self.proc_path, str(pid)))
+        with open(os.path.join(self.proc_path, str(pid), 'stat'), 'w') as f:
+            f.write('{0} ({1}) {2} 1 {0}\n'.format(pid, os.path.basename(args[0]), state))
+        with open(os.path.join(self.proc_path, str(pid), 'cmdline'), 'w') as f:
+            f.write('\0'.join(args) + '\0')
+
+    def _add_dm_device(self, dm_name, name, suspended):
+        os.makedirs(os.path.join(self.sys_block_path, dm_name, 'dm'))
+        with open(os.path.join(self.sys_block_path, dm_name, 'dm', 'name'), 'w') as f:
+            f.write(name + '\n')
+        with open(os.path.join(self.sys_block_path, dm_name, 'dm', 'suspended'), 'w') as f:
+            f.write(('1' if suspended else '0') + '\n')
+
+    def test_get_suspended_devices(self):
+        self._add_dm_device('dm-0', 'data', False)
+        self._add_dm_device('dm-1', 'data-hotzone-forward', True)
+        self._add_dm_device('dm-2', 'other', True)
+        self.assertEqual(['data-hotzone-forward'], self.resumer.get_suspended_devices())
+
+    @mock.patch('OnlineEncryptionResumer.os.kill')
+    @mock.patch('OnlineEncryptionResumer.sleep')
+    @mock.patch('OnlineEncryptionResumer.time')
+    def test_wait_throttled(self, time_mock, sleep_mock, kill_mock):
+        now = [0.0]
+        time_mock.side_effect = lambda: now[0]
+
+        def advance(seconds):
+            now[0] += seconds
+        sleep_mock.side_effect = advance
+        child = mock.MagicMock()
+        child.pid = 1234
+        child.poll.return_value = None
+        io_throttle = mock.MagicMock()
+        io_throttle.update.return_value = 0.25
+        io_throttle.throttled_seconds = 0.0
+
+        with mock.patch.object(self.resumer, 'wait_stopped', return_value=True):
+            self.resumer.wait_throttled(child, io_throttle, 2, None)
+        self.assertEqual([mock.call(1234, signal.SIGSTOP), mock.call(1234, signal.SIGCONT)] * 2, kill_mock.call_args_list)
+        self.assertEqual(1.5, io_throttle.throttled_seconds)
+
+        # stopped with the hotzone suspended, it is continued without a pause and tried again after the next run
+        self._add_dm_device('dm-1', 'data-hotzone-forward', True)
+        kill_mock.reset_mock()
+        with mock.patch.object(self.resumer, 'wait_stopped', return_value=True):
+            self.resumer.wait_throttled(child, io_throttle, 0.5, None)
+        self.assertEqual([mock.call(1234, signal.SIGSTOP), mock.call(1234, signal.SIGCONT)] * 2, kill_mock.call_args_list)
+        self.assertEqual(1.5, io_throttle.throttled_seconds)
+
+    @mock.patch('OnlineEncryptionResumer.OnlineEncryptionResumer.restore_resume_handlers')
+    @mock.patch('OnlineEncryptionResumer.OnlineEncryptionResumer.install_resume_handlers', return_value=True)
+    @mock.patch('OnlineEncryptionResumer.os.kill')
+    @mock.patch('OnlineEncryptionResumer.sleep')
+    def test_wait_throttled_continues_on_error(self, sleep_mock, kill_mock, install_mock, restore_mock):
+        child = mock.MagicMock()
+        child.pid = 1234
+        child.poll.return_value = None
+        io_throttle = mock.MagicMock()
+        io_throttle.update.return_value = 0.25
+
+        with mock.patch.object(self.resumer, 'wait_stopped', side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, self.resumer.wait_throttled, child, io_throttle, 2, None)
+        self.assertTrue(install_mock.called)
+        self.assertEqual(1, restore_mock.call_count)
+        self.assertEqual([mock.call(1234, signal.SIGSTOP), mock.call(1234, signal.SIGCONT)], kill_mock.call_args_list)
+        self.assertEqual(set(), OnlineEncryptionResumer.stopped_pids)
+
+        # stopped when the extension is terminated during the pause
+        def terminate(pid):
+            OnlineEncryptionResumer.get_resume_signal_handler(signal.SIG_IGN)(signal.SIGTERM, None)
+            raise SystemExit(1)
+        kill_mock.reset_mock()
+        with mock.patch.object(self.resumer, 'wait_stopped', side_effect=terminate):
+            self.assertRaises(SystemExit, self.resumer.wait_throttled, child, io_throttle, 2, None)
+        self.assertEqual([mock.call(1234, signal.SIGSTOP), mock.call(1234, signal.SIGCONT), mock.call(1234, signal.SIGCONT)],
+                         kill_mock.call_args_list)
+
+    @mock.patch('OnlineEncryptionResumer.os.kill')
+    def test_continue_stopped_processes(self, kill_mock):
+        OnlineEncryptionResumer.stopped_pids.update([1234, 1235])
+        kill_mock.side_effect = [OSError(), None]
+
+        OnlineEncryptionResumer.continue_stopped_processes()
+        self.assertEqual([1234, 1235], sorted(c[0][0] for c in kill_mock.call_args_list))
+        self.assertTrue(all(c[0][1] == signal.SIGCONT for c in kill_mock.call_args_list))
+        self.assertEqual(set(), OnlineEncryptionResumer.stopped_pids)
+
+    @mock.patch('OnlineEncryptionResumer.signal.signal')
+    @mock.patch('OnlineEncryptionResumer.os.kill')
+    def test_resume_signal_handler(self, kill_mock, signal_mock):
+        previous_handler = mock.MagicMock()
+        OnlineEncryptionResumer.stopped_pids.add(1234)
+        OnlineEncryptionResumer.get_resume_signal_handler(previous_handler)(signal.SIGTERM, None)
+        kill_mock.assert_called_once_with(1234, signal.SIGCONT)
+        previous_handler.assert_called_once_with(signal.SIGTERM, None)
+
+        # the default action is taken once the stopped processes are continued
+        kill_mock.reset_mock()
+        OnlineEncryptionResumer.stopped_pids.add(1234)
+        OnlineEncryptionResumer.get_resume_signal_handler(signal.SIG_DFL)(signal.SIGTERM, None)
+        signal_mock.assert_called_once_with(signal.SIGTERM, signal.SIG_DFL)
+        self.assertEqual([mock.call(1234, signal.SIGCONT), mock.call(os.getpid(), signal.SIGTERM)], kill_mock.call_args_list)
+
+    @mock.patch('OnlineEncryptionResumer.atexit.register')
+    @mock.patch('OnlineEncryptionResumer.signal.getsignal')
+    @mock.patch('OnlineEncryptionResumer.signal.signal')
+    def test_install_resume_handlers(self, signal_mock, getsignal_mock, register_mock):
+        previous_handlers = {signal.SIGTERM: mock.MagicMock(), signal.SIGINT: signal.SIG_IGN, signal.SIGHUP: None}
+        getsignal_mock.side_effect = lambda signum: previous_handlers[signum]
+        with mock.patch.object(OnlineEncryptionResumer, 'exit_handler_registered', False), \
+                mock.patch.object(OnlineEncryptionResumer, 'resume_handlers_users', 0), \
+                mock.patch.object(OnlineEncryptionResumer, 'previous_signal_handlers', {}):
+            # signal handlers cannot be set outside of the main thread, they are set by the next call from it
+            signal_mock.side_effect = ValueError()
+            self.assertFalse(OnlineEncryptionResumer.install_resume_handlers())
+            register_mock.assert_called_once_with(OnlineEncryptionResumer.continue_stopped_processes)
+            self.assertEqual(0, OnlineEncryptionResumer.resume_handlers_users)
+
+            signal_mock.side_effect = None
+            signal_mock.reset_mock()
+            self.assertTrue(OnlineEncryptionResumer.install_resume_handlers())
+            self.assertTrue(OnlineEncryptionResumer.install_resume_handlers())
+            self.assertEqual(1, register_mock.call_count)
+            self.assertEqual([signal.SIGTERM, signal.SIGINT, signal.SIGHUP], [c[0][0] for c in signal_mock.call_args_list])
+            self.assertEqual(previous_handlers, OnlineEncryptionResumer.previous_signal_handlers)
+
+            # the handlers that were set are put back when the last resume ends
+            signal_mock.reset_mock()
+            OnlineEncryptionResumer.restore_resume_handlers()
+            self.assertFalse(signal_mock.called)
+            OnlineEncryptionResumer.restore_resume_handlers()
+            self.assertEqual([mock.call(signal.SIGTERM, previous_handlers[signal.SIGTERM]),
+                              mock.call(signal.SIGINT, signal.SIG_IGN),
+                              mock.call(signal.SIGHUP, signal.SIG_DFL)],
+                             sorted(signal_mock.call_args_list, key=lambda c: [signal.SIGTERM, signal.SIGINT, signal.SIGHUP].index(c[0][0])))
+            self.assertEqual(0, OnlineEncryptionResumer.resume_handlers_users)
+            self.assertEqual({}, OnlineEncryptionResumer.previous_signal_handlers)
+
+    @mock.patch('OnlineEncryptionResumer.os.kill')
+    def test_continue_orphaned_processes(self, kill_mock):
+        self._add_process(100, 'T', ['/usr/sbin/cryptsetup', 'reencrypt', '--resume-only', '--active-name', 'data', '-d', '/mnt/bek'])
+        self._add_process(101, 'S', ['cryptsetup', 'reencrypt', '--resume-only', '--active-name', 'data', '-d', '/mnt/bek'])
+        self._add_process(102, 'T', ['cryptsetup', 'reencrypt', '--resume-only', '--active-name', 'other', '-d', '/mnt/bek'])
+        self._add_process(103, 'T', ['dd', 'if=/dev/mapper/data'])
+
+        self.assertEqual([100], self.resumer.continue_orphaned_processes(None))
+        kill_mock.assert_called_once_with(100, signal.SIGCONT)
+
+    @mock.patch('OnlineEncryptionResumer.subprocess.Popen')
+    @mock.patch('OnlineEncryptionResumer.os.path.exists', return_value=True)
+    def test_begin_resume_decryption(self, exists_mock, popen_mock):
+        self.resumer.crypt_item.luks_header_path = '/var/lib/azure_disk_encryption_config/azureluksheaderdata'
+        self.resumer.decrypt = True
+        self.resumer.disk_util.encryption_environment.resume_daemon_status_file_path = os.path.join(self.sys_block_path, 'status_')
+        self.resumer.disk_util.luks_check_reencryption.return_value = True
+        popen_mock.return_value.poll.return_value = 0
+        popen_mock.return_value.returncode = 0
+
+        generation = DeviceTopologyCache.generation
+        self.assertTrue(self.resumer.begin_resume(False, None))
+        # cryptsetup is run without a CommandExecutor, the cached topology is dropped all the same
+        self.assertEqual(generation + 2, DeviceTopologyCache.generation)
+        self.assertEqual(['cryptsetup', 'reencrypt', '--resume-only', '--active-name', 'data',
+                          '--header', '/var/lib/azure_disk_encryption_config/azureluksheaderdata', '-d', '/mnt/bek'],
+                         popen_mock.call_args[0][0])
+
+        popen_mock.return_value.returncode = 1
+        self.assertFalse(self.resumer.begin_resume(False, None))
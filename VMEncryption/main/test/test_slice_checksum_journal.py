@@ -0,0 +1,65 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from SliceChecksumJournal import SliceChecksumJournal
+
+from console_logger import ConsoleLogger
+
+
+class Test_SliceChecksumJournal(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, "copy_slice_checksums")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _create_journal(self, source='/dev/sdc', destination='/dev/mapper/data'):
+        return SliceChecksumJournal(self.logger, self.file_path, source, destination)
+
+    def test_records_survive_reload(self):
+        journal = self._create_journal()
+        journal.add(0, 1024, 123)
+        journal.add(1024, 512, SliceChecksumJournal.checksum(b'\0' * 512))
+        journal.close()
+
+        journal = self._create_journal()
+        self.assertEqual(123, journal.get(0, 1024))
+        self.assertEqual(SliceChecksumJournal.checksum(b'\0' * 512), journal.get(1024, 512))
+        self.assertIsNone(journal.get(0, 512))
+        self.assertEqual([(0, 1024), (1024, 512)], journal.get_slices())
+        journal.close()
+
+    def test_torn_record_is_ignored(self):
+        journal = self._create_journal()
+        journal.add(0, 1024, 123)
+        journal.close()
+        with open(self.file_path, 'a') as f:
+            f.write("1024 10")
+
+        journal = self._create_journal()
+        self.assertEqual([(0, 1024)], journal.get_slices())
+        # new records start on a line of their own
+        journal.add(2048, 1024, 456)
+        journal.close()
+        self.assertEqual(456, self._create_journal().get(2048, 1024))
+
+    def test_journal_of_another_copy_starts_over(self):
+        journal = self._create_journal()
+        journal.add(0, 1024, 123)
+        journal.close()
+
+        journal = self._create_journal(destination='/dev/mapper/other')
+        self.assertEqual([], journal.get_slices())
+        journal.close()
+        self.assertEqual([], self._create_journal().get_slices())
+
+    def test_clear(self):
+        journal = self._create_journal()
+        journal.add(0, 1024, 123)
+        journal.clear()
+        self.assertFalse(os.path.exists(self.file_path))
+        self.assertEqual([], journal.get_slices())
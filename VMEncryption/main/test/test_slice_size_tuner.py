@@ -0,0 +1,69 @@
+import unittest
+import os
+import tempfile
+
+from SliceSizeTuner import SliceSizeTuner
+
+from console_logger import ConsoleLogger
+
+MB = 1024 * 1024
+
+
+class Test_SliceSizeTuner(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        meminfo = tempfile.NamedTemporaryFile(mode='w', delete=False)
+        meminfo.write("MemTotal:        8000000 kB\nMemFree:          500000 kB\nMemAvailable:    4194304 kB\n")
+        meminfo.close()
+        self.meminfo_path = meminfo.name
+
+    def tearDown(self):
+        os.remove(self.meminfo_path)
+
+    def _record(self, tuner, throughput_mb):
+        block_size = tuner.get_block_size()
+        for _ in range(SliceSizeTuner.samples_per_size):
+            result = tuner.record_slice(block_size, block_size, block_size / (throughput_mb * float(MB)))
+        return result
+
+    def test_memory_budget(self):
+        # a quarter of 4 GB available, shared by two buffers
+        tuner = SliceSizeTuner(self.logger, 50 * MB, 2, self.meminfo_path)
+        self.assertEqual(512 * MB, tuner.max_block_size)
+        tuner = SliceSizeTuner(self.logger, 50 * MB, 16, self.meminfo_path)
+        self.assertEqual(64 * MB, tuner.max_block_size)
+
+    def test_missing_meminfo(self):
+        tuner = SliceSizeTuner(self.logger, 50 * MB, 2, '/nonexistent/meminfo')
+        self.assertEqual(SliceSizeTuner.max_block_size, tuner.max_block_size)
+
+    def test_initial_size_fits_budget(self):
+        tuner = SliceSizeTuner(self.logger, 50 * MB, 64, self.meminfo_path)
+        self.assertEqual(12800 * 1024, tuner.get_block_size())
+
+    def test_grows_while_faster(self):
+        tuner = SliceSizeTuner(self.logger, 50 * MB, 2, self.meminfo_path)
+        self.assertEqual(100 * MB, self._record(tuner, 100))
+        self.assertEqual(200 * MB, self._record(tuner, 150))
+        # the next doubling does not pay off, so the tuner goes back to the best size
+        self.assertEqual(400 * MB, self._record(tuner, 200))
+        self.assertEqual(200 * MB, self._record(tuner, 190))
+        self.assertTrue(tuner.done)
+
+    def test_shrinks_when_growing_does_not_help(self):
+        tuner = SliceSizeTuner(self.logger, 50 * MB, 2, self.meminfo_path)
+        self.assertEqual(100 * MB, self._record(tuner, 100))
+        self.assertEqual(25 * MB, self._record(tuner, 90))
+        self.assertEqual(12800 * 1024, self._record(tuner, 120))
+        self.assertEqual(25 * MB, self._record(tuner, 110))
+        self.assertTrue(tuner.done)
+
+    def test_ignores_other_sizes(self):
+        tuner = SliceSizeTuner(self.logger, 50 * MB, 2, self.meminfo_path)
+        for _ in range(10):
+            self.assertEqual(50 * MB, tuner.record_slice(25 * MB, 25 * MB, 0.1))
+        self.assertEqual([], tuner.samples)
+
+
+if __name__ == '__main__':
+    unittest.main()
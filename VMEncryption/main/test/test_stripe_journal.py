@@ -0,0 +1,82 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from StripeJournal import StripeJournal
+
+from console_logger import ConsoleLogger
+
+
+class Test_StripeJournal(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, "copy_stripes.journal")
+        self.guard_file_path = os.path.join(self.temp_dir, "copy_stripe_guards")
+        self.source = bytearray(os.urandom(3 * 4096))
+        self.stripes = [(0, 4096), (4096, 8192), (8192, 3 * 4096)]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _create_journal(self, destination='/dev/mapper/data'):
+        return StripeJournal(self.logger, self.file_path, self.guard_file_path, '/dev/sdc', destination)
+
+    def _read_source(self, buffer_view, offset):
+        data = self.source[offset:offset + len(buffer_view)]
+        buffer_view[:len(data)] = data
+        return len(data)
+
+    def _read_file(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_create_saves_guards(self):
+        journal = self._create_journal()
+        # the guards are read in pieces of the buffer size
+        journal.create(len(self.source), 1024, self.stripes, self._read_source, memoryview(bytearray(512)))
+        journal.close()
+        self.assertEqual(2 * 1024, os.path.getsize(self.guard_file_path))
+
+        journal = self._create_journal()
+        self.assertTrue(journal.load(len(self.source)))
+        self.assertEqual([4096, 8192, 3 * 4096], journal.copied_offsets)
+        self.assertEqual(4096 + 1024, journal.get_guard_end(1))
+        self.assertEqual(0, journal.get_guard_end(0))
+        # the source under the guard is overwritten, the guard is not
+        self.source[8192:8192 + 1024] = b'\0' * 1024
+        guard = bytearray(512)
+        journal.read_guard(2, 256, memoryview(guard))
+        self.assertEqual(self._read_file(self.guard_file_path)[1024 + 256:1024 + 768], bytes(guard))
+        journal.close()
+
+    def test_records_survive_reload(self):
+        journal = self._create_journal()
+        journal.create(len(self.source), 1024, self.stripes, self._read_source, memoryview(bytearray(4096)))
+        journal.update(0, 1024)
+        journal.update(2, 8192 + 512)
+        journal.close()
+
+        journal = self._create_journal()
+        self.assertTrue(journal.load(len(self.source)))
+        self.assertEqual([1024, 8192, 8192 + 512], journal.copied_offsets)
+        journal.close()
+
+    def test_journal_of_another_copy_is_ignored(self):
+        journal = self._create_journal()
+        journal.create(len(self.source), 1024, self.stripes, self._read_source, memoryview(bytearray(4096)))
+        journal.close()
+
+        self.assertFalse(self._create_journal(destination='/dev/mapper/other').load(len(self.source)))
+        self.assertFalse(self._create_journal().load(len(self.source) - 512))
+        os.remove(self.guard_file_path)
+        self.assertFalse(self._create_journal().load(len(self.source)))
+
+    def test_clear(self):
+        journal = self._create_journal()
+        journal.create(len(self.source), 1024, self.stripes, self._read_source, memoryview(bytearray(4096)))
+        journal.clear()
+        self.assertFalse(os.path.exists(self.file_path))
+        self.assertFalse(os.path.exists(self.guard_file_path))
+        self.assertFalse(self._create_journal().load(len(self.source)))
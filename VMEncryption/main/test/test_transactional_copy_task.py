@@ -0,0 +1,1081 @@
+import unittest
+import os
+import json
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import zlib
+
+from TransactionalCopyTask import TransactionalCopyTask
+from SliceChecksumJournal import SliceChecksumJournal
+from DeviceTopologyCache import DeviceTopologyCache
+from Common import CommonVariables
+
+from console_logger import ConsoleLogger
+from test_utils import MockDistroPatcher
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+
+class Test_TransactionalCopyTask(unittest.TestCase):
+    """ copies between regular files, which the native engine handles the same way as block devices """
+
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.temp_dir, "source")
+        self.destination_path = os.path.join(self.temp_dir, "destination")
+        self.encryption_environment = mock.MagicMock()
+        self.encryption_environment.copy_slice_item_backup_file = os.path.join(self.temp_dir, "copy_slice_item.bak")
+        self.encryption_environment.copy_used_ranges_file_path = os.path.join(self.temp_dir, "copy_used_ranges.json")
+        self.encryption_environment.copy_slice_item_journal_file = os.path.join(self.temp_dir, "copy_slice_item.journal")
+        self.encryption_environment.copy_slice_checksum_file = os.path.join(self.temp_dir, "copy_slice_checksums")
+        self.encryption_environment.copy_progress_file_path = os.path.join(self.temp_dir, "copy_progress.json")
+        self.encryption_environment.copy_stripe_journal_file = os.path.join(self.temp_dir, "copy_stripes.journal")
+        self.encryption_environment.copy_stripe_guard_file = os.path.join(self.temp_dir, "copy_stripe_guards")
+        self.patching = MockDistroPatcher('Ubuntu', '20.04', '5.4')
+        self.patching.dd_path = 'dd'
+        self.hutil = mock.MagicMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_source(self, size):
+        content = bytearray(os.urandom(size))
+        with open(self.source_path, 'wb') as f:
+            f.write(content)
+        return bytes(content)
+
+    def _write_destination(self, size):
+        with open(self.destination_path, 'wb') as f:
+            f.write(b'\0' * size)
+
+    def _read_file(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _create_ongoing_item_config(self, total_size, block_size, from_end, slice_index=0):
+        ongoing_item_config = mock.MagicMock()
+        ongoing_item_config.get_current_total_copy_size.return_value = total_size
+        ongoing_item_config.get_current_block_size.return_value = block_size
+        ongoing_item_config.get_current_source_path.return_value = self.source_path
+        ongoing_item_config.get_current_destination.return_value = self.destination_path
+        ongoing_item_config.get_current_slice_index.return_value = slice_index
+        ongoing_item_config.get_from_end.return_value = from_end
+        return ongoing_item_config
+
+    def _create_copy_task(self, ongoing_item_config, public_settings=None, status_prefix="Encrypting data volume 1/1"):
+        return TransactionalCopyTask(logger=self.logger,
+                                     hutil=self.hutil,
+                                     disk_util=mock.MagicMock(),
+                                     ongoing_item_config=ongoing_item_config,
+                                     patching=self.patching,
+                                     encryption_environment=self.encryption_environment,
+                                     status_prefix=status_prefix,
+                                     public_settings=public_settings)
+
+    def test_copy_engine_selection(self):
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'False')
+        self.assertEqual(CommonVariables.CopyEngineNative, self._create_copy_task(ongoing_item_config).copy_engine)
+        self.assertEqual(CommonVariables.CopyEngineDd, self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: 'DD'}).copy_engine)
+        self.assertEqual(CommonVariables.CopyEngineNative, self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: 'bogus'}).copy_engine)
+
+    @mock.patch('TransactionalCopyTask.os')
+    def test_copy_engine_falls_back_to_dd_without_pread(self, os_mock):
+        del os_mock.pread
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'False')
+        self.assertEqual(CommonVariables.CopyEngineDd, self._create_copy_task(ongoing_item_config).copy_engine)
+
+    def test_io_mode_selection(self):
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'False')
+        self.assertEqual(CommonVariables.CopyIOModeBuffered, self._create_copy_task(ongoing_item_config).io_mode)
+        self.assertEqual(CommonVariables.CopyIOModeDirect,
+                         self._create_copy_task(ongoing_item_config, {CommonVariables.CopyIOModeKey: 'Direct'}).io_mode)
+        # dd has no aligned buffer, so it stays buffered
+        self.assertEqual(CommonVariables.CopyIOModeBuffered,
+                         self._create_copy_task(ongoing_item_config, {CommonVariables.CopyIOModeKey: 'direct',
+                                                                      CommonVariables.CopyEngineKey: 'dd'}).io_mode)
+
+    def test_get_direct_io_size(self):
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyIOModeKey: 'direct'})
+        copy_task.direct_io_alignment = 4096
+        buffer_view = copy_task.get_slice_buffer(3 * 4096 + 512)
+
+        self.assertEqual(3 * 4096, copy_task.get_direct_io_size(buffer_view, 8192))
+        self.assertEqual(0, copy_task.get_direct_io_size(buffer_view, 512))
+        self.assertEqual(0, copy_task.get_direct_io_size(buffer_view[:512], 8192))
+
+    def test_direct_copy_with_unaligned_last_slice(self):
+        content = self._write_source(5 * 8192 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 8192, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyIOModeKey: 'direct'})
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content, self._read_file(self.destination_path))
+        self.assertEqual(len(content), copy_task.copied_bytes)
+
+    def test_direct_copy_falls_back_when_open_fails(self):
+        content = self._write_source(4 * 8192)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 8192, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyIOModeKey: 'direct'})
+        get_fd = copy_task.get_fd
+
+        def get_fd_without_direct(path, flags):
+            if flags & os.O_DIRECT:
+                raise OSError(22, "Invalid argument")
+            return get_fd(path, flags)
+
+        with mock.patch.object(copy_task, 'get_fd', side_effect=get_fd_without_direct):
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content, self._read_file(self.destination_path))
+        self.assertEqual(set([self.source_path, self.destination_path]), copy_task.direct_io_unsupported_paths)
+
+    def test_read_ahead_selection(self):
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'True')
+        ongoing_item_config.get_phase.return_value = CommonVariables.EncryptionPhaseCopyData
+        self.assertTrue(self._create_copy_task(ongoing_item_config).read_ahead_enabled)
+        self.assertFalse(self._create_copy_task(ongoing_item_config, {CommonVariables.CopyReadAheadKey: 'false'}).read_ahead_enabled)
+        self.assertFalse(self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: 'dd'}).read_ahead_enabled)
+
+        ongoing_item_config.get_phase.return_value = CommonVariables.DecryptionPhaseCopyData
+        self.assertFalse(self._create_copy_task(ongoing_item_config).read_ahead_enabled)
+
+    def test_read_ahead_ranges_from_end(self):
+        ongoing_item_config = self._create_ongoing_item_config(3 * 1024 + 512, 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config)
+
+        self.assertEqual((3072, 512), copy_task.get_read_ahead_range(0))
+        self.assertEqual((2048, 1024), copy_task.get_read_ahead_range(1))
+        self.assertEqual((0, 1024), copy_task.get_read_ahead_range(3))
+        self.assertIsNone(copy_task.get_read_ahead_range(4))
+
+        copy_task.read_ahead_enabled = False
+        self.assertIsNone(copy_task.get_read_ahead_range(1))
+
+    def test_read_ahead_serves_every_slice_after_the_first(self):
+        content = self._write_source(6 * 1024 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyVerifySampleCountKey: 0})
+        read_device = copy_task.read_device
+
+        with mock.patch.object(copy_task, 'read_device', side_effect=read_device) as read_device_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+
+        self.assertEqual(content, self._read_file(self.destination_path))
+        read_offsets = [c[0][2] for c in read_device_mock.call_args_list]
+        self.assertEqual([6144, 5120, 4096, 3072, 2048, 1024, 0], read_offsets)
+        self.assertIsNone(copy_task.read_ahead)
+
+    def test_read_ahead_failure_is_read_again(self):
+        content = self._write_source(2 * 1024)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyVerifySampleCountKey: 0})
+        read_device = copy_task.read_device
+        calls = []
+
+        def failing_read_ahead(path, buffer_view, offset):
+            calls.append(offset)
+            if len(calls) == 2:
+                raise OSError(5, "Input/output error")
+            return read_device(path, buffer_view, offset)
+
+        with mock.patch.object(copy_task, 'read_device', side_effect=failing_read_ahead):
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+
+        self.assertEqual([0, 1024, 1024], calls)
+        self.assertEqual(content, self._read_file(self.destination_path))
+
+    def test_cache_neutral_selection(self):
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'True')
+        self.assertEqual(hasattr(os, 'posix_fadvise'), self._create_copy_task(ongoing_item_config).cache_neutral)
+        self.assertFalse(self._create_copy_task(ongoing_item_config, {CommonVariables.CopyCacheNeutralKey: 'False'}).cache_neutral)
+        self.assertFalse(self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: 'dd'}).cache_neutral)
+
+    @unittest.skipUnless(hasattr(os, 'posix_fadvise'), "needs os.posix_fadvise")
+    def test_cache_neutral_copy_drops_pages_once_written_back(self):
+        content = self._write_source(6 * 1024 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyCheckpointIntervalSlicesKey: 3})
+        events = []
+        drop_cache = copy_task.drop_cache
+        fdatasync = os.fdatasync
+        posix_fadvise = os.posix_fadvise
+
+        def record_drop_cache(path, offset, length):
+            events.append(('drop', path, offset, length))
+            drop_cache(path, offset, length)
+
+        def record_fdatasync(fd):
+            events.append(('sync',))
+            fdatasync(fd)
+
+        def record_posix_fadvise(fd, offset, length, advice):
+            if advice == os.POSIX_FADV_RANDOM:
+                events.append(('random', fd))
+            posix_fadvise(fd, offset, length, advice)
+
+        with mock.patch.object(copy_task, 'drop_cache', side_effect=record_drop_cache), \
+                mock.patch('os.fdatasync', side_effect=record_fdatasync), \
+                mock.patch('os.posix_fadvise', side_effect=record_posix_fadvise):
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content, self._read_file(self.destination_path))
+
+        # the copy from the end reads downwards, so the kernel does not read ahead for it
+        self.assertEqual(1, len([event for event in events if event[0] == 'random']))
+        for path in [self.source_path, self.destination_path]:
+            dropped = sorted((event[2], event[3]) for event in events if event[0] == 'drop' and event[1] == path)
+            covered = 0
+            for offset, length in dropped:
+                self.assertTrue(offset <= covered)
+                covered = max(covered, offset + length)
+            self.assertEqual(len(content), covered)
+        # the destination pages are dropped after they are synced, never before
+        first_sync = events.index(('sync',))
+        self.assertFalse([event for event in events[:first_sync] if event[0] == 'drop' and event[1] == self.destination_path])
+        self.assertEqual([], copy_task.uncached_ranges)
+
+    def test_slice_size_tuner_selection(self):
+        ongoing_item_config = self._create_ongoing_item_config(CommonVariables.autotune_min_slice_count * 1024, 1024, 'True')
+        self.assertIsNotNone(self._create_copy_task(ongoing_item_config).slice_size_tuner)
+        self.assertIsNone(self._create_copy_task(ongoing_item_config, {CommonVariables.CopySliceSizeAutotuneKey: False}).slice_size_tuner)
+        self.assertIsNone(self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: 'dd'}).slice_size_tuner)
+
+        ongoing_item_config = self._create_ongoing_item_config(8 * 1024, 1024, 'True')
+        self.assertIsNone(self._create_copy_task(ongoing_item_config).slice_size_tuner)
+
+    def test_change_block_size_from_end(self):
+        # 10 full slices and a partial one, the partial slice and 3 full ones are done
+        ongoing_item_config = self._create_ongoing_item_config(10 * 1024 + 512, 1024, 'True', slice_index=4)
+        copy_task = self._create_copy_task(ongoing_item_config)
+
+        # 7 KB are left, which is not a multiple of 2 KB
+        self.assertFalse(copy_task.change_block_size(2048))
+        self.assertTrue(copy_task.change_block_size(512))
+        self.assertEqual(8, copy_task.current_slice_index)
+        self.assertEqual(22, copy_task.total_slice_size)
+        self.assertEqual(512, ongoing_item_config.current_block_size)
+        self.assertEqual(8, ongoing_item_config.current_slice_index)
+
+        self.assertTrue(copy_task.change_block_size(1024))
+        self.assertEqual(4, copy_task.current_slice_index)
+        self.assertEqual(11, copy_task.total_slice_size)
+
+    def test_change_block_size_from_start(self):
+        ongoing_item_config = self._create_ongoing_item_config(10 * 1024 + 512, 1024, 'False', slice_index=3)
+        copy_task = self._create_copy_task(ongoing_item_config)
+
+        self.assertFalse(copy_task.change_block_size(2048))
+        self.assertTrue(copy_task.change_block_size(512))
+        self.assertEqual(6, copy_task.current_slice_index)
+        self.assertEqual(22, copy_task.total_slice_size)
+
+    def test_native_copy_with_changing_slice_size(self):
+        for from_end in ['True', 'False']:
+            content = self._write_source(20 * 1024 + 512)
+            self._write_destination(len(content))
+            ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, from_end)
+            copy_task = self._create_copy_task(ongoing_item_config)
+            block_sizes = iter([2048, 2048, 2048, 4096, 4096, 4096, 512])
+            copy_task.slice_size_tuner = mock.MagicMock()
+            copy_task.slice_size_tuner.get_block_size.side_effect = lambda: next(block_sizes, 512)
+
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+            self.assertEqual(content, self._read_file(self.destination_path))
+            self.assertEqual(512, ongoing_item_config.current_block_size)
+
+    def test_copy_skips_free_slices(self):
+        with open(self.encryption_environment.copy_used_ranges_file_path, 'w') as f:
+            json.dump({'source_path': self.source_path, 'used_ranges': [[0, 100], [3 * 1024 + 10, 1024], [8 * 1024, 512]]}, f)
+
+        for phase, from_end in [(CommonVariables.EncryptionPhaseCopyData, 'True'), (CommonVariables.EncryptionPhaseCopyData, 'False'),
+                                (CommonVariables.DecryptionPhaseCopyData, 'True')]:
+            content = self._write_source(8 * 1024 + 512)
+            self._write_destination(len(content))
+            ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, from_end)
+            ongoing_item_config.get_phase.return_value = phase
+            copy_task = self._create_copy_task(ongoing_item_config)
+
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+            destination = self._read_file(self.destination_path)
+            if phase == CommonVariables.DecryptionPhaseCopyData:
+                self.assertEqual(content, destination)
+                self.assertEqual(0, copy_task.skipped_bytes)
+                continue
+            for start, end in [(0, 1024), (3 * 1024, 5 * 1024), (8 * 1024, len(content))]:
+                self.assertEqual(content[start:end], destination[start:end])
+            for start, end in [(1024, 3 * 1024), (5 * 1024, 8 * 1024)]:
+                self.assertEqual(b'\0' * (end - start), destination[start:end])
+            self.assertEqual(5 * 1024, copy_task.skipped_bytes)
+            self.assertEqual(len(content) - 5 * 1024, copy_task.copied_bytes)
+
+    @mock.patch.object(CommonVariables, 'zero_chunk_size', 1024)
+    def test_get_zero_ranges(self):
+        ongoing_item_config = self._create_ongoing_item_config(8192, 4096, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config)
+        buffer_view = copy_task.get_slice_buffer(4096 + 512)
+        buffer_view[1024:1025] = b'\x01'
+        self.assertEqual([(0, 1024), (2048, 4608)], copy_task.get_zero_ranges(buffer_view))
+        buffer_view[4607:4608] = b'\x01'
+        self.assertEqual([(0, 1024), (2048, 4096)], copy_task.get_zero_ranges(buffer_view))
+
+        # strings that do not take a buffer compare a copy of the chunk
+        zero_chunk = mock.MagicMock()
+        zero_chunk.startswith.side_effect = TypeError()
+        zero_chunk.__getitem__.return_value = b'\x00' * 512
+        self.assertTrue(TransactionalCopyTask.is_zero_chunk(zero_chunk, buffer_view[2048:2560]))
+        self.assertFalse(TransactionalCopyTask.is_zero_chunk(zero_chunk, buffer_view[4096:4608]))
+
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyZeroDetectKey: 'false'})
+        self.assertEqual([], copy_task.get_zero_ranges(buffer_view))
+
+    @mock.patch.object(CommonVariables, 'zero_chunk_size', 1024)
+    def test_copy_zeroes_zero_chunks(self):
+        for from_end in ['True', 'False']:
+            content = bytearray(self._write_source(6 * 1024 + 512))
+            content[1024:4 * 1024] = b'\0' * (3 * 1024)
+            with open(self.source_path, 'wb') as f:
+                f.write(content)
+            with open(self.destination_path, 'wb') as f:
+                f.write(b'\xff' * len(content))
+            ongoing_item_config = self._create_ongoing_item_config(len(content), 2048, from_end)
+            copy_task = self._create_copy_task(ongoing_item_config)
+
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+            self.assertEqual(bytes(content), self._read_file(self.destination_path))
+            self.assertEqual(3 * 1024, copy_task.zeroed_bytes)
+
+    @mock.patch.object(CommonVariables, 'zero_chunk_size', 1024)
+    def test_backup_file_keeps_zero_chunks_as_holes(self):
+        ongoing_item_config = self._create_ongoing_item_config(8192, 4096, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config)
+        buffer_view = copy_task.get_slice_buffer(4096)
+        buffer_view[0:1024] = b'\x01' * 1024
+
+        copy_task.write_slice_item_backup_file(buffer_view, copy_task.get_zero_ranges(buffer_view))
+        self.assertEqual(buffer_view.tobytes(), self._read_file(self.encryption_environment.copy_slice_item_backup_file))
+
+    @unittest.skipIf(not os.path.exists('/proc/self/fd'), "needs /proc to tell the synced files apart")
+    def test_backup_file_is_synced_before_the_slice_is_written(self):
+        self._write_source(8192)
+        self._write_destination(8192)
+        ongoing_item_config = self._create_ongoing_item_config(8192, 4096, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config)
+        events = []
+        backup_file = self.encryption_environment.copy_slice_item_backup_file
+        real_fsync = os.fsync
+        real_write_slice = copy_task.write_slice
+
+        def fsync(fd):
+            path = os.readlink('/proc/self/fd/{0}'.format(fd))
+            if path == os.path.realpath(backup_file):
+                events.append('backup')
+            elif path == os.path.realpath(os.path.dirname(backup_file)):
+                events.append('directory')
+            real_fsync(fd)
+
+        def write_slice(*args):
+            events.append('slice')
+            return real_write_slice(*args)
+
+        with mock.patch('TransactionalCopyTask.os.fsync', side_effect=fsync), \
+                mock.patch.object(copy_task, 'write_slice', side_effect=write_slice):
+            self.assertEqual(CommonVariables.process_success, copy_task.copy_internal_native(self.source_path, self.destination_path, 4096, 1, 1, 1))
+        # the journal is created in the same directory first
+        self.assertEqual(['backup', 'directory', 'slice'], events[-3:])
+        self.assertFalse(os.path.exists(backup_file))
+
+    def test_written_slice_drops_cached_topology(self):
+        self._write_destination(8192)
+        copy_task = self._create_copy_task(self._create_ongoing_item_config(8192, 4096, 'False'))
+        generation = DeviceTopologyCache.generation
+        copy_task.write_slice(self.destination_path, copy_task.get_slice_buffer(4096), 0, [])
+        self.assertEqual(generation + 1, DeviceTopologyCache.generation)
+
+        with mock.patch('TransactionalCopyTask.Popen') as popen_mock:
+            popen_mock.return_value.stdout.readinto.return_value = 0
+            popen_mock.return_value.stderr.read.return_value = b''
+            popen_mock.return_value.wait.return_value = 0
+            copy_task.execute_dd('dd if=/dev/zero bs=512 count=1', output_view=copy_task.get_slice_buffer(512))
+            self.assertEqual(generation + 1, DeviceTopologyCache.generation)
+            popen_mock.return_value.stdin.fileno.return_value = os.open(os.devnull, os.O_WRONLY)
+            try:
+                copy_task.execute_dd('dd of={0} bs=512 conv=notrunc'.format(self.destination_path), input_view=copy_task.get_slice_buffer(512))
+            finally:
+                os.close(popen_mock.return_value.stdin.fileno.return_value)
+        self.assertEqual(generation + 2, DeviceTopologyCache.generation)
+
+    @mock.patch('TransactionalCopyTask.fcntl')
+    @mock.patch('TransactionalCopyTask.stat.S_ISBLK', return_value=True)
+    def test_zero_device_uses_blkzeroout(self, is_block_device_mock, fcntl_mock):
+        self._write_destination(8192)
+        ongoing_item_config = self._create_ongoing_item_config(8192, 4096, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config)
+        copy_task.get_zero_ranges(copy_task.get_slice_buffer(4096))
+
+        self.assertEqual(4096, copy_task.zero_device(self.destination_path, 1024, 4096))
+        fcntl_mock.ioctl.assert_called_once_with(mock.ANY, CommonVariables.BLKZEROOUT, struct.pack('QQ', 1024, 4096))
+
+        # without the ioctl the zeros are written
+        fcntl_mock.ioctl.side_effect = IOError(25, "Inappropriate ioctl for device")
+        with open(self.destination_path, 'wb') as f:
+            f.write(b'\xff' * 8192)
+        self.assertEqual(4096, copy_task.zero_device(self.destination_path, 1024, 4096))
+        self.assertEqual(b'\xff' * 1024 + b'\0' * 4096 + b'\xff' * 3072, self._read_file(self.destination_path))
+        self.assertIn(self.destination_path, copy_task.zero_out_unsupported_paths)
+
+    def test_status_message_reports_saved_bytes(self):
+        ongoing_item_config = self._create_ongoing_item_config(4 * 1024 * 1024, 1024 * 1024, 'False', slice_index=2)
+        copy_task = self._create_copy_task(ongoing_item_config, status_prefix="Encrypting")
+        self.assertEqual("Encrypting: 40% (0 MB copied)", copy_task.get_status_message())
+        copy_task.copied_bytes = 8 * 1024 * 1024
+        copy_task.zeroed_bytes = 3 * 1024 * 1024
+        copy_task.skipped_bytes = 1024 * 1024
+        self.assertEqual("Encrypting: 40% (8 MB copied, 3 MB zeroed without copying, 1 MB of free space skipped)", copy_task.get_status_message())
+
+    def test_status_message_reports_rate_and_time_left(self):
+        ongoing_item_config = self._create_ongoing_item_config(10 * 1024 * 1024, 1024 * 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, status_prefix="Encrypting")
+        with mock.patch('CopyProgress.time.time', side_effect=[100.0, 102.0]):
+            copy_task.add_progress_sample()
+            copy_task.current_slice_index = 3
+            copy_task.copied_bytes = 2 * 1024 * 1024
+            copy_task.add_progress_sample()
+        self.assertEqual("Encrypting: 27% (2 MB copied, 1.0 MB/s, about 0:00:08 left)", copy_task.get_status_message())
+
+    def test_copy_writes_progress_file(self):
+        content = self._write_source(4 * 1024 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyCheckpointIntervalSlicesKey: 2})
+        write_progress_file = copy_task.write_progress_file
+        states = []
+
+        def recording_write_progress_file(state):
+            write_progress_file(state)
+            with open(self.encryption_environment.copy_progress_file_path, 'r') as f:
+                states.append(json.load(f))
+
+        with mock.patch.object(copy_task, 'write_progress_file', side_effect=recording_write_progress_file):
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(['copying', 'copying', 'copying', 'completed'], [state['state'] for state in states])
+        # the tail slice first, then the slices below it
+        self.assertEqual([1024 + 512, 3 * 1024 + 512, 4 * 1024 + 512], [state['processed_bytes'] for state in states[:3]])
+        self.assertEqual(100, states[-1]['percent'])
+        self.assertEqual(len(content), states[-1]['copied_bytes'])
+        self.assertEqual(0, states[-1]['eta_seconds'])
+        self.assertEqual(self.source_path, states[-1]['source'])
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_progress_file_path + '.tmp'))
+
+    def test_rate_limiter_selection(self):
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'False')
+        self.assertIsNone(self._create_copy_task(ongoing_item_config).rate_limiter)
+        self.assertIsNone(self._create_copy_task(ongoing_item_config, {CommonVariables.CopyMaxMBPerSecondKey: '0'}).rate_limiter)
+        self.assertIsNone(self._create_copy_task(ongoing_item_config, {CommonVariables.CopyMaxMBPerSecondKey: 'fast'}).rate_limiter)
+        rate_limiter = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyMaxMBPerSecondKey: '20'}).rate_limiter
+        self.assertEqual((20 * 1024 * 1024, 20 * 1024 * 1024), (rate_limiter.rate, rate_limiter.burst))
+        rate_limiter = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyMaxMBPerSecondKey: 20,
+                                                                    CommonVariables.CopyBurstMBKey: 0.5}).rate_limiter
+        self.assertEqual(512 * 1024, rate_limiter.burst)
+
+    def test_rate_limited_copy_paces_reads_and_writes(self):
+        content = self._write_source(4 * 1024 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyMaxMBPerSecondKey: 1024,
+                                                                 CommonVariables.CopyVerifySampleCountKey: 0})
+
+        with mock.patch.object(copy_task.rate_limiter, 'consume', return_value=0) as consume_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content, self._read_file(self.destination_path))
+        self.assertEqual(2 * len(content), sum(call[0][0] for call in consume_mock.call_args_list))
+        self.assertTrue("MB/s of 1024 MB/s allowed)" in copy_task.get_status_message())
+
+    def test_io_throttle_paces_every_slice(self):
+        content = self._write_source(4 * 1024)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config)
+        self.assertIsNone(copy_task.io_throttle)
+        copy_task.io_throttle = mock.MagicMock()
+        copy_task.io_throttle.throttled_seconds = 0.0
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content, self._read_file(self.destination_path))
+        self.assertEqual(copy_task.total_slice_size, copy_task.io_throttle.pace.call_count)
+
+    def test_native_copy_from_start(self):
+        content = self._write_source(10 * 1024 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config)
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content, self._read_file(self.destination_path))
+        self.assertEqual(11, ongoing_item_config.current_slice_index)
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+        self.assertEqual({}, copy_task.opened_fds)
+
+    def test_native_copy_from_end_with_shift(self):
+        # emulate the in-place header shift, the destination is the source moved up by the header size
+        header_size = 1536
+        content = self._write_source(8 * 1024 + 512)
+        ongoing_item_config = self._create_ongoing_item_config(len(content) - header_size, 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config)
+        copy_task.destination = self.source_path
+        write_fully = copy_task.write_fully
+
+        def shifted_write_fully(fd, buffer_view, offset):
+            if fd == copy_task.opened_fds.get((self.source_path, os.O_WRONLY | os.O_CREAT)):
+                offset += header_size
+            return write_fully(fd, buffer_view, offset)
+
+        with mock.patch.object(copy_task, 'write_fully', side_effect=shifted_write_fully):
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+
+        shifted = self._read_file(self.source_path)
+        self.assertEqual(content[:len(content) - header_size], shifted[header_size:])
+
+    def _create_shifted_copy_task(self, total_size, header_size, slice_index=0, fail_after_writes=None, public_settings=None):
+        """ the in-place encryption copy, with the destination emulated as the source moved up by the header size """
+        ongoing_item_config = self._create_ongoing_item_config(total_size, 1024, 'True', slice_index=slice_index)
+        ongoing_item_config.get_phase.return_value = CommonVariables.EncryptionPhaseCopyData
+        ongoing_item_config.get_header_file_path.return_value = 'None'
+        ongoing_item_config.get_current_destination.return_value = self.source_path
+        copy_task = self._create_copy_task(ongoing_item_config, public_settings)
+        copy_task.disk_util.get_luks_header_size.return_value = header_size
+        copy_task.overlap_window = copy_task.get_overlap_window()
+        write_fully = copy_task.write_fully
+        writes = []
+
+        def shifted_write_fully(fd, buffer_view, offset):
+            if fd == copy_task.opened_fds.get((self.source_path, os.O_WRONLY | os.O_CREAT)):
+                if fail_after_writes is not None and len(writes) == fail_after_writes:
+                    raise IOError(5, "Input/output error")
+                writes.append(offset)
+                offset += header_size
+            return write_fully(fd, buffer_view, offset)
+
+        copy_task.write_fully = shifted_write_fully
+        return copy_task
+
+    def test_overlap_window_selection(self):
+        ongoing_item_config = self._create_ongoing_item_config(8192, 1024, 'True')
+        ongoing_item_config.get_phase.return_value = CommonVariables.EncryptionPhaseCopyData
+        ongoing_item_config.get_header_file_path.return_value = None
+        copy_task = self._create_copy_task(ongoing_item_config)
+        copy_task.disk_util.get_luks_header_size.return_value = 16777216
+        self.assertEqual(16777216, copy_task.get_overlap_window())
+        copy_task.disk_util.get_luks_header_size.assert_called_with(self.source_path)
+
+        copy_task.disk_util.get_luks_header_size.return_value = None
+        self.assertIsNone(copy_task.get_overlap_window())
+
+        # with a separate header the data is not shifted, each slice overwrites its own source
+        ongoing_item_config.get_header_file_path.return_value = '/var/lib/azure_disk_encryption_config/azureluksheader'
+        copy_task.disk_util.get_luks_header_size.return_value = 16777216
+        self.assertIsNone(copy_task.get_overlap_window())
+
+        ongoing_item_config.get_header_file_path.return_value = None
+        ongoing_item_config.get_phase.return_value = CommonVariables.EncryptionPhaseRecoverHeader
+        self.assertIsNone(copy_task.get_overlap_window())
+
+    def test_journaled_copy_from_end_with_shift(self):
+        header_size = 512
+        content = self._write_source(8 * 1024 + 512)
+        copy_task = self._create_shifted_copy_task(len(content) - header_size, header_size)
+
+        with mock.patch.object(copy_task, 'write_slice_item_backup_file') as backup_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+            backup_mock.assert_not_called()
+
+        self.assertEqual(content[:len(content) - header_size], self._read_file(self.source_path)[header_size:])
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_journal_file))
+
+    def test_journaled_copy_resumes_from_journal(self):
+        header_size = 512
+        content = self._write_source(8 * 1024 + 512)
+        for fail_after_writes in [1, 4, 7, 11]:
+            with open(self.source_path, 'wb') as f:
+                f.write(content)
+            copy_task = self._create_shifted_copy_task(len(content) - header_size, header_size, fail_after_writes=fail_after_writes)
+            self.assertEqual(CommonVariables.copy_data_error, copy_task.begin_copy())
+            self.assertTrue(os.path.exists(self.encryption_environment.copy_slice_item_journal_file))
+
+            # the committed slice index may not have reached the disk, the journal is ahead of it
+            copy_task = self._create_shifted_copy_task(len(content) - header_size, header_size)
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+            self.assertEqual(content[:len(content) - header_size], self._read_file(self.source_path)[header_size:])
+
+    def test_stripes_selection(self):
+        self._write_source(16 * 1024 + 512)
+        copy_task = self._create_shifted_copy_task(16 * 1024, 512, public_settings={CommonVariables.CopyStripeWorkersKey: 2})
+        self.assertEqual(2, copy_task.stripe_workers)
+        # the device is too small to split
+        self.assertIsNone(copy_task.get_stripes())
+        with mock.patch.object(CommonVariables, 'copy_stripe_min_size', 2048):
+            self.assertEqual([(0, 4096), (4096, 8192), (8192, 12288), (12288, 16384)], copy_task.get_stripes())
+            copy_task.total_size = 16 * 1024 + 512
+            self.assertEqual((12288, 16 * 1024 + 512), copy_task.get_stripes()[-1])
+            # the guard has to fit in the stripe
+            copy_task.overlap_window = 4096
+            self.assertIsNone(copy_task.get_stripes())
+
+        self.assertEqual(CommonVariables.copy_stripe_workers, self._create_shifted_copy_task(16 * 1024, 512).stripe_workers)
+        self.assertEqual(1, self._create_shifted_copy_task(16 * 1024, 512, public_settings={CommonVariables.CopyStripeWorkersKey: 0}).stripe_workers)
+
+    @mock.patch.object(CommonVariables, 'copy_stripe_min_size', 2048)
+    def test_striped_copy_from_end_with_shift(self):
+        header_size = 512
+        content = self._write_source(16 * 1024 + 512)
+        copy_task = self._create_shifted_copy_task(len(content) - header_size, header_size,
+                                                   public_settings={CommonVariables.CopyStripeWorkersKey: 2})
+
+        with mock.patch.object(copy_task, 'copy_internal') as copy_internal_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+            copy_internal_mock.assert_not_called()
+
+        self.assertEqual(content[:len(content) - header_size], self._read_file(self.source_path)[header_size:])
+        self.assertEqual(len(content) - header_size, copy_task.copied_bytes)
+        self.assertEqual(100, copy_task.get_percent())
+        self.assertEqual(copy_task.total_slice_size, copy_task.ongoing_item_config.current_slice_index)
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_stripe_journal_file))
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_stripe_guard_file))
+
+    @mock.patch.object(CommonVariables, 'copy_stripe_min_size', 2048)
+    def test_striped_copy_pauses_outside_of_the_throttle_lock(self):
+        header_size = 512
+        content = self._write_source(16 * 1024 + 512)
+        copy_task = self._create_shifted_copy_task(len(content) - header_size, header_size,
+                                                   public_settings={CommonVariables.CopyStripeWorkersKey: 2})
+        copy_task.io_throttle = mock.MagicMock()
+        copy_task.io_throttle.throttled_seconds = 0.0
+        copy_task.io_throttle.take_pause.return_value = 0.5
+        lock_holders = set()
+        locked_while_paused = []
+
+        class ThrottleLock(object):
+            def __enter__(self):
+                lock_holders.add(threading.current_thread())
+
+            def __exit__(self, *args):
+                lock_holders.discard(threading.current_thread())
+        copy_task.throttle_lock = ThrottleLock()
+
+        def sleep(seconds):
+            locked_while_paused.append(threading.current_thread() in lock_holders)
+
+        with mock.patch('TransactionalCopyTask.time.sleep', side_effect=sleep):
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content[:len(content) - header_size], self._read_file(self.source_path)[header_size:])
+        self.assertTrue(copy_task.io_throttle.take_pause.called)
+        self.assertFalse(copy_task.io_throttle.pace.called)
+        self.assertTrue(locked_while_paused)
+        self.assertNotIn(True, locked_while_paused)
+
+    @mock.patch.object(CommonVariables, 'copy_stripe_min_size', 2048)
+    def test_striped_copy_resumes_each_stripe(self):
+        header_size = 512
+        content = self._write_source(16 * 1024 + 512)
+        for fail_after_writes in [0, 3, 9, 17]:
+            with open(self.source_path, 'wb') as f:
+                f.write(content)
+            copy_task = self._create_shifted_copy_task(len(content) - header_size, header_size, fail_after_writes=fail_after_writes,
+                                                       public_settings={CommonVariables.CopyStripeWorkersKey: 2})
+            self.assertEqual(CommonVariables.copy_data_error, copy_task.begin_copy())
+            self.assertTrue(os.path.exists(self.encryption_environment.copy_stripe_journal_file))
+
+            # the stripes are resumed even when the settings no longer ask for them
+            copy_task = self._create_shifted_copy_task(len(content) - header_size, header_size,
+                                                       public_settings={CommonVariables.CopyStripeWorkersKey: 1})
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+            self.assertEqual(content[:len(content) - header_size], self._read_file(self.source_path)[header_size:])
+            self.assertFalse(os.path.exists(self.encryption_environment.copy_stripe_journal_file))
+
+    @mock.patch.object(CommonVariables, 'copy_stripe_min_size', 2048)
+    def test_copy_started_on_single_stream_is_not_striped(self):
+        header_size = 512
+        content = self._write_source(16 * 1024 + 512)
+        copy_task = self._create_shifted_copy_task(len(content) - header_size, header_size, fail_after_writes=3)
+        copy_task.stripe_workers = 1
+        self.assertEqual(CommonVariables.copy_data_error, copy_task.begin_copy())
+
+        copy_task = self._create_shifted_copy_task(len(content) - header_size, header_size,
+                                                   public_settings={CommonVariables.CopyStripeWorkersKey: 2})
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertIsNone(copy_task.stripe_journal)
+        self.assertEqual(content[:len(content) - header_size], self._read_file(self.source_path)[header_size:])
+
+    def test_stale_journal_is_ignored(self):
+        content = self._write_source(4 * 1024)
+        self._write_destination(len(content))
+        copy_task = self._create_shifted_copy_task(len(content), 512, slice_index=3)
+        copy_task.source_dev_full_path = '/dev/sdz'
+        copy_task.write_journal(512)
+        self.assertEqual(512, copy_task.read_journal())
+
+        copy_task = self._create_shifted_copy_task(len(content), 512, slice_index=3)
+        self.assertIsNone(copy_task.read_journal())
+        self.assertEqual(CommonVariables.process_success, copy_task.resume_journal())
+        self.assertEqual(3, copy_task.current_slice_index)
+
+    def test_checkpoint_intervals_selection(self):
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'False')
+        self.assertEqual((CommonVariables.copy_checkpoint_interval_slices, CommonVariables.copy_checkpoint_interval_seconds),
+                         self._create_copy_task(ongoing_item_config).get_checkpoint_intervals(None))
+        self.assertEqual((1, 0), self._create_copy_task(ongoing_item_config).get_checkpoint_intervals(
+            {CommonVariables.CopyCheckpointIntervalSlicesKey: '0', CommonVariables.CopyCheckpointIntervalSecondsKey: '0'}))
+        self.assertEqual((8, CommonVariables.copy_checkpoint_interval_seconds), self._create_copy_task(ongoing_item_config).get_checkpoint_intervals(
+            {CommonVariables.CopyCheckpointIntervalSlicesKey: 8, CommonVariables.CopyCheckpointIntervalSecondsKey: 'bogus'}))
+        # dd has no journal to resume from
+        self.assertEqual((1, 0), self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: 'dd'}).get_checkpoint_intervals(
+            {CommonVariables.CopyCheckpointIntervalSlicesKey: 8}))
+
+    def test_copy_commits_in_batches(self):
+        content = self._write_source(10 * 1024 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyCheckpointIntervalSlicesKey: 4,
+                                                                 CommonVariables.CopyCheckpointIntervalSecondsKey: 0})
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content, self._read_file(self.destination_path))
+        # after slices 4 and 8, and after the last one
+        self.assertEqual(3, ongoing_item_config.commit.call_count)
+        self.assertEqual(3, self.hutil.do_status_report.call_count)
+        self.assertEqual(11, ongoing_item_config.current_slice_index)
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_journal_file))
+
+    def test_dirty_writeback_selection(self):
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config)
+        self.assertEqual(CommonVariables.copy_dirty_limit_mb * 1024 * 1024, copy_task.dirty_writeback.limit)
+        self.assertEqual(2 * 1024 * 1024, self._create_copy_task(ongoing_item_config, {CommonVariables.CopyDirtyLimitMBKey: '2'}).dirty_writeback.limit)
+        self.assertIsNone(self._create_copy_task(ongoing_item_config, {CommonVariables.CopyDirtyLimitMBKey: 0}).dirty_writeback)
+        self.assertEqual(CommonVariables.copy_dirty_limit_mb * 1024 * 1024,
+                         self._create_copy_task(ongoing_item_config, {CommonVariables.CopyDirtyLimitMBKey: 'lots'}).dirty_writeback.limit)
+
+    def test_copy_writes_back_dirty_pages_under_the_limit(self):
+        content = self._write_source(10 * 1024 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyCheckpointIntervalSlicesKey: 100})
+        copy_task.dirty_writeback.limit = 1024
+        calls = []
+        copy_task.dirty_writeback.sync_file_range = lambda fd, offset, length, flags: calls.append((offset, length, flags)) or 0
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content, self._read_file(self.destination_path))
+        started = [c for c in calls if c[2] == CommonVariables.SYNC_FILE_RANGE_WRITE]
+        # the 1024 byte slices are written back in chunks of half the limit
+        self.assertEqual(len(content), sum(length for offset, length, flags in started))
+        for offset, length, flags in started:
+            self.assertTrue(length <= 512)
+
+    def test_dd_checkpoint_makes_destination_durable(self):
+        content = self._write_source(4 * 1024)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd})
+        events = []
+        fdatasync = os.fdatasync
+
+        def record_fdatasync(fd):
+            events.append(('sync', os.readlink('/proc/self/fd/{0}'.format(fd))))
+            fdatasync(fd)
+
+        ongoing_item_config.commit.side_effect = lambda: events.append(('commit', ongoing_item_config.current_slice_index))
+        with mock.patch('os.fdatasync', side_effect=record_fdatasync):
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+
+        self.assertEqual(content, self._read_file(self.destination_path))
+        # dd has no journal, so it commits every slice, each one after the destination is synced
+        expected_events = []
+        for slice_index in range(1, 6):
+            expected_events.extend([('sync', self.destination_path), ('commit', slice_index)])
+        self.assertEqual(expected_events, events)
+
+    def test_copy_commits_when_interval_elapses(self):
+        content = self._write_source(4 * 1024)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyCheckpointIntervalSecondsKey: 10})
+
+        with mock.patch('TransactionalCopyTask.time.time', side_effect=[0] + [30 * i for i in range(100)]):
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(5, ongoing_item_config.commit.call_count)
+
+    def _create_in_place_copy_task(self, total_size, from_end, fail_after_writes=None):
+        """
+        the copy with a separate header, each slice overwrites its own source through a transforming destination,
+        so a slice copied twice comes out transformed twice.
+        """
+        os.symlink(self.source_path, self.destination_path)
+        ongoing_item_config = self._create_ongoing_item_config(total_size, 1024, from_end)
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyCheckpointIntervalSlicesKey: 100,
+                                                                 CommonVariables.CopyVerifySampleCountKey: 0})
+        read_fully = copy_task.read_fully
+        write_fully = copy_task.write_fully
+        writes = []
+
+        def is_destination(fd):
+            return any(key[0] == self.destination_path and opened_fd == fd for key, opened_fd in copy_task.opened_fds.items())
+
+        def transforming_read_fully(fd, buffer_view, offset):
+            read_size = read_fully(fd, buffer_view, offset)
+            if is_destination(fd):
+                buffer_view[:read_size] = bytes(bytearray(b ^ 0x5a for b in bytearray(buffer_view[:read_size])))
+            return read_size
+
+        def transforming_write_fully(fd, buffer_view, offset):
+            if is_destination(fd):
+                if fail_after_writes is not None and len(writes) == fail_after_writes:
+                    raise IOError(5, "Input/output error")
+                writes.append(offset)
+                buffer_view = memoryview(bytes(bytearray(b ^ 0x5a for b in bytearray(buffer_view))))
+            return write_fully(fd, buffer_view, offset)
+
+        copy_task.read_fully = transforming_read_fully
+        copy_task.write_fully = transforming_write_fully
+        return copy_task
+
+    def test_in_place_copy_resumes_from_journal_without_commit(self):
+        content = self._write_source(8 * 1024 + 512)
+        transformed = bytes(bytearray(b ^ 0x5a for b in bytearray(content)))
+        for from_end in ['True', 'False']:
+            for fail_after_writes in [1, 3, 6]:
+                with open(self.source_path, 'wb') as f:
+                    f.write(content)
+                copy_task = self._create_in_place_copy_task(len(content), from_end, fail_after_writes=fail_after_writes)
+                self.assertEqual(CommonVariables.copy_data_error, copy_task.begin_copy())
+                copy_task.ongoing_item_config.commit.assert_not_called()
+                self.assertTrue(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+                os.remove(self.destination_path)
+
+                # the slice index was never committed, the journal and the backup tell where the copy is
+                copy_task = self._create_in_place_copy_task(len(content), from_end)
+                self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+                self.assertEqual(transformed, self._read_file(self.source_path), "{0} {1}".format(from_end, fail_after_writes))
+                self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_journal_file))
+                os.remove(self.destination_path)
+
+    def test_copy_records_slice_checksums(self):
+        content = self._write_source(4 * 1024 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config)
+        copy_task.checksum_journal.clear = mock.MagicMock()
+
+        with mock.patch.object(copy_task, 'verify_sample', return_value=[]) as verify_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+            verify_mock.assert_called_once_with(CommonVariables.copy_verify_sample_count)
+
+        journal = SliceChecksumJournal(self.logger, self.encryption_environment.copy_slice_checksum_file, self.source_path, self.destination_path)
+        self.assertEqual([(0, 1024), (1024, 1024), (2048, 1024), (3072, 1024), (4096, 512)], journal.get_slices())
+        self.assertEqual(zlib.crc32(content[1024:2048]) & 0xffffffff, journal.get(1024, 1024))
+        journal.close()
+
+        copy_task = self._create_copy_task(ongoing_item_config)
+        self.assertEqual([], copy_task.verify_sample(10))
+        with open(self.destination_path, 'r+b') as f:
+            f.seek(2048)
+            f.write(b'\xff')
+        self.assertEqual([2048], copy_task.verify_sample(10))
+
+    def test_resume_skips_slices_already_on_destination(self):
+        content = self._write_source(4 * 1024)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False', slice_index=1)
+        copy_task = self._create_copy_task(ongoing_item_config)
+        # slices 1 and 2 were copied, but the daemon stopped before their slice index was committed
+        with open(self.destination_path, 'r+b') as f:
+            f.seek(1024)
+            f.write(content[1024:3072])
+        copy_task.record_checksum(1024, memoryview(content)[1024:2048])
+        copy_task.record_checksum(2048, memoryview(content)[2048:3072])
+        copy_task.record_checksum(3072, memoryview(content)[3072:4096])
+        copy_task.checksum_journal.close()
+
+        copy_task = self._create_copy_task(ongoing_item_config)
+        copy_task.skip_verified_slices()
+        self.assertEqual(3, copy_task.current_slice_index)
+        self.assertEqual(3, ongoing_item_config.current_slice_index)
+
+    def test_resume_from_backup_skips_matching_destination(self):
+        content = self._write_source(4 * 1024)
+        self._write_destination(len(content))
+        with open(self.destination_path, 'r+b') as f:
+            f.seek(2048)
+            f.write(content[2048:3072])
+        with open(self.encryption_environment.copy_slice_item_backup_file, 'wb') as f:
+            f.write(content[2048:3072])
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False', slice_index=2)
+        copy_task = self._create_copy_task(ongoing_item_config)
+
+        with mock.patch.object(copy_task, 'write_slice') as write_slice_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.resume_copy())
+            write_slice_mock.assert_not_called()
+        self.assertEqual(3, copy_task.current_slice_index)
+
+    def test_native_copy_without_status_prefix(self):
+        content = self._write_source(4096)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config, status_prefix='')
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content, self._read_file(self.destination_path))
+        self.hutil.do_status_report.assert_not_called()
+
+    def test_native_resume_from_partial_backup(self):
+        content = self._write_source(4 * 1024)
+        self._write_destination(len(content))
+        # slice 1 was interrupted while its backup was being written
+        with open(self.encryption_environment.copy_slice_item_backup_file, 'wb') as f:
+            f.write(content[1024:1024 + 512])
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False', slice_index=1)
+        copy_task = self._create_copy_task(ongoing_item_config)
+
+        self.assertEqual(CommonVariables.process_success, copy_task.resume_copy())
+        self.assertEqual(2, copy_task.current_slice_index)
+        self.assertEqual(content[1024:2048], self._read_file(self.destination_path)[1024:2048])
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+
+    def test_native_resume_prefers_backup_over_source(self):
+        content = self._write_source(4 * 1024)
+        self._write_destination(len(content))
+        backup = b'\x5a' * 1024
+        with open(self.encryption_environment.copy_slice_item_backup_file, 'wb') as f:
+            f.write(backup)
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False', slice_index=2)
+        copy_task = self._create_copy_task(ongoing_item_config)
+
+        self.assertEqual(CommonVariables.process_success, copy_task.resume_copy())
+        self.assertEqual(backup, self._read_file(self.destination_path)[2048:3072])
+
+    def test_resume_with_oversized_backup(self):
+        self._write_source(4 * 1024)
+        with open(self.encryption_environment.copy_slice_item_backup_file, 'wb') as f:
+            f.write(b'\0' * 2048)
+        ongoing_item_config = self._create_ongoing_item_config(4 * 1024, 1024, 'False', slice_index=1)
+        copy_task = self._create_copy_task(ongoing_item_config)
+
+        self.assertEqual(CommonVariables.backup_slice_file_error, copy_task.resume_copy())
+
+    def test_native_copy_failure(self):
+        ongoing_item_config = self._create_ongoing_item_config(4096, 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config)
+
+        self.assertEqual(CommonVariables.copy_data_error, copy_task.begin_copy())
+        self.assertEqual(0, copy_task.current_slice_index)
+
+    def test_dd_copy_from_end_with_shift(self):
+        content = self._write_source(5 * 1024 + 512)
+        self._write_destination(len(content) + 1024)
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd})
+        # the destination is written in place, at an offset
+        copy_task.destination = self.destination_path + '_shifted'
+        os.symlink(self.destination_path, copy_task.destination)
+        ongoing_item_config.get_current_destination.return_value = copy_task.destination
+
+        with mock.patch.object(copy_task, 'get_skip_block', side_effect=lambda i: copy_task.total_slice_size - i - 1):
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(content + b'\0' * 1024, self._read_file(self.destination_path))
+        self.assertEqual(len(content), copy_task.copied_bytes)
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+
+    def test_dd_copy_from_start(self):
+        content = self._write_source(4 * 1024 + 512)
+        self._write_destination(len(content) + 2048)
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd})
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        # the rest of the destination is not truncated
+        self.assertEqual(content + b'\0' * 2048, self._read_file(self.destination_path))
+
+    def test_dd_copy_stages_slices_in_process_buffer(self):
+        self._write_source(2048)
+        self._write_destination(2048)
+        ongoing_item_config = self._create_ongoing_item_config(2048, 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd})
+
+        with mock.patch('TransactionalCopyTask.Popen', wraps=subprocess.Popen) as popen_mock, \
+                mock.patch('CommandExecutor.CommandExecutor.Execute') as execute_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+
+        self.assertFalse(execute_mock.called)
+        commands = [' '.join(c[0][0]) for c in popen_mock.call_args_list]
+        self.assertEqual(4, len(commands))
+        self.assertEqual('dd if={0} bs=1024 skip=1 count=1'.format(self.source_path), commands[0])
+        self.assertEqual('dd of={0} ibs={1} obs=1024 seek=1 conv=notrunc'.format(self.destination_path, CommonVariables.dd_pipe_block_size), commands[1])
+
+    def test_dd_copy_reads_tail_in_one_request(self):
+        content = self._write_source(2048 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd})
+        self.assertEqual(hasattr(os, 'preadv'), copy_task.vectored_io_enabled)
+
+        with mock.patch('TransactionalCopyTask.Popen', wraps=subprocess.Popen) as popen_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+
+        self.assertEqual(content, self._read_file(self.destination_path))
+        commands = [' '.join(c[0][0]) for c in popen_mock.call_args_list]
+        if copy_task.vectored_io_enabled:
+            # only the two full slices go through dd
+            self.assertEqual(4, len(commands))
+            self.assertFalse([command for command in commands if 'bs=512' in command])
+
+    def test_dd_copy_tail_in_512_byte_blocks_without_vectored_io(self):
+        content = self._write_source(2048 + 512)
+        self._write_destination(len(content))
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'True')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd,
+                                                                 CommonVariables.CopyVectoredIOKey: 'false'})
+        self.assertFalse(copy_task.vectored_io_enabled)
+
+        with mock.patch('TransactionalCopyTask.Popen', wraps=subprocess.Popen) as popen_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+
+        self.assertEqual(content, self._read_file(self.destination_path))
+        commands = [' '.join(c[0][0]) for c in popen_mock.call_args_list]
+        self.assertEqual('dd if={0} bs=512 skip=4 count=1'.format(self.source_path), commands[0])
+
+    @unittest.skipUnless(hasattr(os, 'preadv'), "needs preadv")
+    def test_dd_resume_from_partial_backup_in_one_request(self):
+        content = self._write_source(4 * 1024)
+        self._write_destination(len(content))
+        with open(self.encryption_environment.copy_slice_item_backup_file, 'wb') as f:
+            f.write(content[1024:1024 + 512])
+        ongoing_item_config = self._create_ongoing_item_config(len(content), 1024, 'False', slice_index=1)
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd})
+
+        with mock.patch('CommandExecutor.CommandExecutor.Execute') as execute_mock:
+            self.assertEqual(CommonVariables.process_success, copy_task.resume_copy())
+
+        self.assertFalse(execute_mock.called)
+        self.assertEqual(2, copy_task.current_slice_index)
+        self.assertEqual(content[1024:2048], self._read_file(self.destination_path)[1024:2048])
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+
+    def test_dd_copy_failure(self):
+        self._write_destination(2048)
+        ongoing_item_config = self._create_ongoing_item_config(2048, 1024, 'False')
+        copy_task = self._create_copy_task(ongoing_item_config, {CommonVariables.CopyEngineKey: CommonVariables.CopyEngineDd})
+
+        self.assertNotEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(0, copy_task.current_slice_index)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from UdevDatabase import UdevDatabase
+
+from console_logger import ConsoleLogger
+
+
+class Test_UdevDatabase(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.temp_dir = tempfile.mkdtemp()
+        self.udev_database = UdevDatabase(self.logger)
+        self.udev_database.udev_data_path = os.path.join(self.temp_dir, 'udev_data')
+        self.udev_database.sys_path = os.path.join(self.temp_dir, 'sys')
+        self.udev_database.sys_dev_block_path = os.path.join(self.udev_database.sys_path, 'dev', 'block')
+        os.makedirs(self.udev_database.udev_data_path)
+        os.makedirs(self.udev_database.sys_dev_block_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _add_udev_data(self, majmin, content):
+        with open(os.path.join(self.udev_database.udev_data_path, 'b' + majmin), 'w') as f:
+            f.write(content)
+
+    def _add_sys_device(self, majmin, device_path, device_id=None):
+        """ device_path is relative to sys/devices, and device_id is written to its first component """
+        sys_devices_path = os.path.join(self.udev_database.sys_path, 'devices')
+        os.makedirs(os.path.join(sys_devices_path, device_path))
+        if device_id is not None:
+            with open(os.path.join(sys_devices_path, device_path.split('/')[0], 'device_id'), 'w') as f:
+                f.write(device_id + '\n')
+        os.symlink(os.path.join(sys_devices_path, device_path), os.path.join(self.udev_database.sys_dev_block_path, majmin))
+
+    def test_get_properties(self):
+        self._add_udev_data('8:16', 'S:disk/azure/scsi1/lun0\nI:1234\nE:ID_FS_TYPE=ext4\nE:ID_FS_LABEL=a=b\n')
+        self._add_udev_data('253:0', 'E:DM_NAME=data\n')
+        self._add_udev_data('8:32', 'E:ID_FS_TYPE=xfs\n')
+        with open(os.path.join(self.udev_database.udev_data_path, 'c10:1'), 'w') as f:
+            f.write('E:ID_FS_TYPE=none\n')
+
+        self.assertEqual({'ID_FS_TYPE': 'ext4', 'ID_FS_LABEL': 'a=b'}, self.udev_database.get_properties('8:16'))
+        self.assertEqual({'DM_NAME': 'data'}, self.udev_database.get_properties('253:0'))
+        self.assertIsNone(self.udev_database.get_properties('10:1'))
+        self.assertEqual(set(['8:16', '253:0', '8:32']), set(self.udev_database.properties))
+
+        # read again once udev changed its database
+        os.remove(os.path.join(self.udev_database.udev_data_path, 'b8:32'))
+        os.utime(self.udev_database.udev_data_path, (1, 1))
+        self.assertIsNone(self.udev_database.get_properties('8:32'))
+
+    def test_get_properties_without_udev(self):
+        shutil.rmtree(self.udev_database.udev_data_path)
+        self.assertIsNone(self.udev_database.get_properties('8:16'))
+
+    def test_get_device_id(self):
+        self._add_sys_device('8:16', 'f8b3781b-1e82-4818-a1c3-63d806ec15bb/host3/target3:0:0/3:0:0:0/block/sdb',
+                             device_id='{f8b3781b-1e82-4818-a1c3-63d806ec15bb}')
+        self._add_sys_device('8:17', 'f8b3781b-1e82-4818-a1c3-63d806ec15bb/host3/target3:0:0/3:0:0:0/block/sdb/sdb1')
+        self._add_sys_device('253:0', 'virtual/block/dm-0')
+
+        self.assertEqual('f8b3781b-1e82-4818-a1c3-63d806ec15bb', self.udev_database.get_device_id('8:16'))
+        self.assertEqual('f8b3781b-1e82-4818-a1c3-63d806ec15bb', self.udev_database.get_device_id('8:17'))
+        self.assertEqual('', self.udev_database.get_device_id('253:0'))
+        self.assertEqual('', self.udev_database.get_device_id('8:48'))
+        self.assertEqual('', self.udev_database.get_device_id(None))
+
+if __name__ == '__main__':
+    unittest.main()
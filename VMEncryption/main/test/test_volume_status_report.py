@@ -0,0 +1,58 @@
+import unittest
+import threading
+import time
+
+from VolumeStatusReport import VolumeStatusReport
+from Common import CommonVariables
+
+try:
+    import unittest.mock as mock  # python 3+
+except ImportError:
+    import mock  # python2
+
+
+class Test_VolumeStatusReport(unittest.TestCase):
+    def setUp(self):
+        self.hutil = mock.Mock()
+        self.volume_status_report = VolumeStatusReport(self.hutil, 3)
+
+    def _report(self, volume_num, message):
+        self.volume_status_report.get_reporter(volume_num).do_status_report(operation='DataCopy',
+                                                                           status=CommonVariables.extension_success_status,
+                                                                           status_code=str(CommonVariables.success),
+                                                                           message=message)
+
+    def test_report(self):
+        self._report(2, 'Encrypting data volume 3/3: 10%')
+        self.hutil.do_status_report.assert_called_with(operation='DataCopy',
+                                                       status=CommonVariables.extension_success_status,
+                                                       status_code=str(CommonVariables.success),
+                                                       message='Encrypting data volume 3/3: 10%')
+        self._report(0, 'Encrypting data volume 1/3: 50%')
+        self._report(2, 'Encrypting data volume 3/3: 20%')
+        self.assertEqual('Encrypting data volume 1/3: 50%; Encrypting data volume 3/3: 20%',
+                         self.hutil.do_status_report.call_args[1]['message'])
+
+    def test_report_in_turns(self):
+        in_report = []
+        overlaps = []
+
+        def do_status_report(**kwargs):
+            if in_report:
+                overlaps.append(kwargs['message'])
+            in_report.append(kwargs['message'])
+            time.sleep(0.01)
+            in_report.pop()
+        self.hutil.do_status_report.side_effect = do_status_report
+
+        workers = [threading.Thread(target=self._report, args=(volume_num, 'volume {0}'.format(volume_num)))
+                   for volume_num in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([], overlaps)
+        self.assertEqual('volume 0; volume 1; volume 2', self.volume_status_report.get_message())
+
+if __name__ == '__main__':
+    unittest.main()